@@ -164,7 +164,8 @@ object PdfExporter {
                         val serverFilename = jsonResponse.optString("filename", "family_tree.pdf")
                         Log.d(TAG, "[$candidateType] storage=$storage")
 
-                        if (storage == "google_drive") {
+                        val hasDownloadLink = jsonResponse.optString("download_url", "").isNotBlank()
+                        if (storage != "base64" && hasDownloadLink) {
                             val downloadPath = jsonResponse.getString("download_url")
                             val viewUrl = jsonResponse.optString("view_url", "")
                             val origin = originFromBaseUrl(baseUrl)
@@ -0,0 +1,551 @@
+"""
+Воспроизводимый бенчмарк конвейера распознавания лиц.
+
+Этапы (в процессе, функции telegram_service):
+    decode     - decode_base64_image (base64 + PIL + уменьшение)
+    detection  - detect_faces_optimized (кэш обнаружения сбрасывается)
+    encoding   - face_recognition.face_encodings (num_jitters=NUM_JITTERS)
+    match      - match_face_encodings по GalleryIndex на галереях случайных
+                 кодировок (float32 и int8 с точным пересчётом кандидатов)
+
+Нагрузка (--load): N параллельных клиентов шлют /api/recognize_face на
+локально запущенный сервер (или --server-url), считаются пропускная
+способность, перцентили задержки и коды ответов.
+
+Изображения: синтетические (одно лицо, группа, 12 Мп JPEG) генерируются
+из --seed; фикстуры из --fixtures DIR (*.jpg/*.png) заменяют синтетику с
+тем же именем (single_face, group, large_12mp) или добавляются к ней.
+На синтетике детектор лиц обычно ничего не находит - кодировки считаются
+по нарисованным рамкам, а под нагрузкой сервер отвечает 400 после
+обнаружения. Полный путь до поиска по галерее - только на фикстурах.
+
+Примеры:
+    python bench_face_pipeline.py --output bench.json
+    python bench_face_pipeline.py --fixtures bench_fixtures --gallery-sizes 100,10000
+    python bench_face_pipeline.py --skip-stages --skip-match --load --clients 1,4,16 --duration 20
+
+Сервис импортируется с ENCODINGS_FILE и GALLERY_DB_FILE во временной папке,
+рабочая база лиц не читается и не перезаписывается.
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BASE_DIR = Path(__file__).resolve().parent
+SYNTHETIC_IMAGES = ('single_face', 'group', 'large_12mp')
+ENCODING_SIZE = 128
+
+
+# ========================================
+# ИЗМЕРЕНИЯ
+# ========================================
+
+def summarize(samples):
+    """Сводка по задержкам в миллисекундах"""
+    if not samples:
+        return {'count': 0}
+    values = np.array(samples, dtype=np.float64) * 1000
+    return {
+        'count': len(samples),
+        'mean_ms': round(float(values.mean()), 3),
+        'min_ms': round(float(values.min()), 3),
+        'p50_ms': round(float(np.percentile(values, 50)), 3),
+        'p95_ms': round(float(np.percentile(values, 95)), 3),
+        'p99_ms': round(float(np.percentile(values, 99)), 3),
+        'max_ms': round(float(values.max()), 3)
+    }
+
+
+def measure(func, repeat, warmup, before=None):
+    """Выполняет func warmup + repeat раз, возвращает (последний результат, длительности)"""
+    result = None
+    samples = []
+    for iteration in range(warmup + repeat):
+        if before is not None:
+            before()
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        if iteration >= warmup:
+            samples.append(elapsed)
+    return result, samples
+
+
+def peak_rss_mb(pid=None):
+    """Пиковый RSS процесса в МБ (None, если платформа не даёт его узнать)"""
+    if pid is not None:
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return round(int(line.split()[1]) / 1024, 1)
+        except OSError:
+            pass
+        return None
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт КБ, macOS - байты
+    divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return round(peak / divisor, 1)
+
+
+# ========================================
+# ИЗОБРАЖЕНИЯ И ГАЛЕРЕИ
+# ========================================
+
+def draw_synthetic_faces(size, boxes, rng):
+    """Шумный фон и овалы «лиц» с глазами и ртом в заданных рамках (top, right, bottom, left)"""
+    width, height = size
+    noise = rng.integers(40, 200, size=(height // 8 + 1, width // 8 + 1, 3), dtype=np.uint8)
+    image = Image.fromarray(noise).resize((width, height), Image.BILINEAR)
+    draw = ImageDraw.Draw(image)
+    for top, right, bottom, left in boxes:
+        face_width = right - left
+        face_height = bottom - top
+        draw.ellipse((left, top, right, bottom), fill=(224, 182, 150))
+        eye_y = top + face_height * 0.38
+        eye_r = max(2, face_width // 14)
+        for eye_x in (left + face_width * 0.32, left + face_width * 0.68):
+            draw.ellipse((eye_x - eye_r, eye_y - eye_r, eye_x + eye_r, eye_y + eye_r), fill=(40, 30, 30))
+        mouth_y = top + face_height * 0.72
+        draw.line((left + face_width * 0.35, mouth_y, left + face_width * 0.65, mouth_y), fill=(150, 60, 60), width=max(2, eye_r // 2))
+    return image
+
+
+def grid_boxes(size, rows, cols, face_size):
+    width, height = size
+    boxes = []
+    for row in range(rows):
+        for col in range(cols):
+            center_x = int(width * (col + 0.5) / cols)
+            center_y = int(height * (row + 0.5) / rows)
+            half = face_size // 2
+            boxes.append((center_y - half, center_x + half, center_y + half, center_x - half))
+    return boxes
+
+
+def make_synthetic_image(name, rng):
+    """Возвращает (PIL.Image, рамки лиц в координатах исходника)"""
+    if name == 'single_face':
+        size = (640, 480)
+        boxes = grid_boxes(size, 1, 1, 220)
+    elif name == 'group':
+        size = (1920, 1080)
+        boxes = grid_boxes(size, 2, 4, 200)
+    elif name == 'large_12mp':
+        size = (4000, 3000)
+        boxes = grid_boxes(size, 1, 2, 900)
+    else:
+        raise ValueError(name)
+    return draw_synthetic_faces(size, boxes, rng), boxes
+
+
+def encode_jpeg_base64(image, quality=90):
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality)
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def load_images(fixtures_dir, seed):
+    """Список кейсов {name, source, base64, size, boxes}"""
+    rng = np.random.default_rng(seed)
+    cases = {}
+    for name in SYNTHETIC_IMAGES:
+        image, boxes = make_synthetic_image(name, rng)
+        cases[name] = {
+            'name': name,
+            'source': 'synthetic',
+            'base64': encode_jpeg_base64(image),
+            'size': image.size,
+            'boxes': boxes
+        }
+
+    if fixtures_dir:
+        for path in sorted(Path(fixtures_dir).iterdir()):
+            if path.suffix.lower() not in ('.jpg', '.jpeg', '.png'):
+                continue
+            with Image.open(path) as image:
+                size = image.size
+            cases[path.stem] = {
+                'name': path.stem,
+                'source': str(path),
+                'base64': base64.b64encode(path.read_bytes()).decode('ascii'),
+                'size': size,
+                'boxes': []
+            }
+    return list(cases.values())
+
+
+def scale_boxes(boxes, source_size, image_shape):
+    ratio = image_shape[1] / source_size[0]
+    height, width = image_shape[:2]
+    scaled = []
+    for top, right, bottom, left in boxes:
+        scaled.append((
+            max(0, int(top * ratio)),
+            min(width - 1, int(right * ratio)),
+            min(height - 1, int(bottom * ratio)),
+            max(0, int(left * ratio))
+        ))
+    return scaled
+
+
+def make_random_gallery(size, rng):
+    """Галерея в формате снимка: member_id -> {name, encoding, image_hash}"""
+    # Кодировки dlib - векторы с нормой около 1, компоненты порядка ±0.1
+    encodings = rng.normal(0, 0.09, size=(size, ENCODING_SIZE)).astype(np.float32)
+    return {
+        f'bench_{index}': {
+            'name': f'Bench {index}',
+            'encoding': encodings[index],
+            'image_hash': ''
+        }
+        for index in range(size)
+    }
+
+
+# ========================================
+# ЭТАПЫ В ПРОЦЕССЕ
+# ========================================
+
+def bench_stages(ts, cases, repeat, warmup):
+    results = {}
+    for case in cases:
+        image, decode_samples = measure(lambda: ts.decode_base64_image(case['base64']), repeat, warmup)
+        if image is None:
+            results[case['name']] = {'source': case['source'], 'error': 'decode failed'}
+            continue
+
+        locations, detection_samples = measure(
+            lambda: ts.detect_faces_optimized(image), repeat, warmup,
+            before=ts.face_detection_cache.clear
+        )
+
+        # Кодируем найденные лица, а на синтетике без находок - нарисованные рамки
+        encode_locations = list(locations) or scale_boxes(case['boxes'], case['size'], image.shape)
+        encoding_samples = []
+        if encode_locations:
+            _, encoding_samples = measure(
+                lambda: ts.face_recognition.face_encodings(image, encode_locations, num_jitters=ts.NUM_JITTERS),
+                repeat, warmup
+            )
+
+        results[case['name']] = {
+            'source': case['source'],
+            'source_size': list(case['size']),
+            'decoded_shape': list(image.shape),
+            'payload_bytes': len(case['base64']),
+            'faces_detected': len(locations),
+            'faces_encoded': len(encode_locations),
+            'decode': summarize(decode_samples),
+            'detection': summarize(detection_samples),
+            'encoding': summarize(encoding_samples)
+        }
+    return results
+
+
+def bench_match(ts, gallery_sizes, repeat, warmup, seed):
+    results = {}
+    for size in gallery_sizes:
+        for quantized in (False, True):
+            # Одинаковые кодировки и проба для float32 и int8
+            rng = np.random.default_rng(seed + size)
+            gallery = make_random_gallery(size, rng)
+
+            # Проба - зашумлённая кодировка случайного участника, чтобы совпадение находилось
+            target_id = f'bench_{int(rng.integers(size))}'
+            probe = gallery[target_id]['encoding'] + rng.normal(0, 0.01, ENCODING_SIZE)
+            probe_location = (0, 1, 1, 0)
+
+            # В int8 точные кодировки берутся из хранилища - здесь из самой галереи
+            float_source = None
+            if quantized:
+                float_source = lambda member_ids: {member_id: gallery[member_id]['encoding'] for member_id in member_ids}
+
+            build_started = time.perf_counter()
+            index = ts.GalleryIndex.build(gallery, quantized, float_source)
+            build_seconds = time.perf_counter() - build_started
+
+            matches, samples = measure(
+                lambda: ts.match_face_encodings(index, None, [probe], [probe_location], 0.6),
+                repeat, warmup
+            )
+            results[f"{size}_{'int8' if quantized else 'float32'}"] = {
+                'gallery_size': size,
+                'index': index.stats(),
+                'index_build_seconds': round(build_seconds, 3),
+                'matched_expected': bool(matches) and matches[0]['member_id'] == target_id,
+                'match': summarize(samples),
+                'peak_rss_mb': peak_rss_mb()
+            }
+            del gallery, index
+    return results
+
+
+# ========================================
+# НАГРУЗКА НА СЕРВЕР
+# ========================================
+
+def get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def write_gallery_file(path, gallery):
+    data = {
+        member_id: {
+            'name': info['name'],
+            'encoding': info['encoding'].tolist(),
+            'image_hash': info['image_hash']
+        }
+        for member_id, info in gallery.items()
+    }
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+
+def wait_for_server(base_url, process, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f'Сервер завершился с кодом {process.returncode}')
+        try:
+            with urllib.request.urlopen(f'{base_url}/api/health', timeout=2) as response:
+                if response.status == 200:
+                    return
+        except (urllib.error.URLError, OSError):
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f'Сервер не ответил на /api/health за {timeout} с')
+
+
+def start_local_server(workdir, gallery_size, role, seed):
+    """Запускает telegram_service.py на свободном порту с отдельной галереей"""
+    encodings_file = os.path.join(workdir, 'face_encodings.json')
+    write_gallery_file(encodings_file, make_random_gallery(gallery_size, np.random.default_rng(seed)))
+
+    port = get_free_port()
+    env = dict(os.environ)
+    env.update({
+        'API_HOST': '127.0.0.1',
+        'API_PORT': str(port),
+        'SERVICE_ROLE': role,
+        'GALLERY_BACKEND': 'json',
+        'ENCODINGS_FILE': encodings_file,
+        'DEVICE_RATE_LIMIT_PER_MINUTE': '0',
+        # 12 Мп JPEG в base64 не влезает в лимит по умолчанию
+        'MAX_CONTENT_LENGTH_MB': '64'
+    })
+    log_path = os.path.join(workdir, 'server.log')
+    log_file = open(log_path, 'wb')
+    process = subprocess.Popen(
+        [sys.executable, str(BASE_DIR / 'telegram_service.py')],
+        cwd=str(BASE_DIR), env=env, stdout=log_file, stderr=subprocess.STDOUT
+    )
+    log_file.close()
+    return process, f'http://127.0.0.1:{port}', log_path
+
+
+def post_json(url, body, timeout):
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'}, method='POST')
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        return e.code
+    except (urllib.error.URLError, OSError):
+        return 'error'
+
+
+def run_load_level(base_url, bodies, clients, duration, timeout):
+    """clients потоков шлют запросы по кругу в течение duration секунд"""
+    url = f'{base_url}/api/recognize_face'
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(offset):
+        index = offset
+        local_latencies = []
+        local_statuses = {}
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            status = post_json(url, bodies[index % len(bodies)], timeout)
+            local_latencies.append(time.perf_counter() - started)
+            local_statuses[str(status)] = local_statuses.get(str(status), 0) + 1
+            index += 1
+        with lock:
+            latencies.extend(local_latencies)
+            for status, count in local_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(offset,), daemon=True) for offset in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    return {
+        'clients': clients,
+        'duration_seconds': round(elapsed, 3),
+        'requests': len(latencies),
+        'throughput_rps': round(len(latencies) / elapsed, 3) if elapsed else 0,
+        'statuses': statuses,
+        'latency': summarize(latencies)
+    }
+
+
+def bench_load(args, cases):
+    bodies = [json.dumps({'image': case['base64'], 'threshold': 0.6}).encode('utf-8') for case in cases]
+    process = None
+    log_path = None
+    with tempfile.TemporaryDirectory(prefix='bench_face_') as workdir:
+        if args.server_url:
+            base_url = args.server_url.rstrip('/')
+        else:
+            process, base_url, log_path = start_local_server(workdir, args.load_gallery_size, args.server_role, args.seed)
+        try:
+            wait_for_server(base_url, process, args.server_start_timeout)
+            levels = [
+                run_load_level(base_url, bodies, clients, args.duration, args.request_timeout)
+                for clients in args.clients
+            ]
+            server_pid = process.pid if process is not None else None
+            return {
+                'server_url': base_url,
+                'started_locally': process is not None,
+                'server_role': args.server_role if process is not None else None,
+                'gallery_size': args.load_gallery_size if process is not None else None,
+                'images': [case['name'] for case in cases],
+                'levels': levels,
+                'server_peak_rss_mb': peak_rss_mb(server_pid) if server_pid else None
+            }
+        except RuntimeError as e:
+            log_tail = ''
+            if log_path and os.path.exists(log_path):
+                with open(log_path, 'rb') as f:
+                    log_tail = f.read()[-4000:].decode('utf-8', 'replace')
+            return {'server_url': base_url, 'error': str(e), 'server_log_tail': log_tail}
+        finally:
+            if process is not None:
+                process.terminate()
+                try:
+                    process.wait(timeout=15)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+
+
+# ========================================
+# MAIN
+# ========================================
+
+def parse_int_list(value):
+    return [int(item) for item in value.split(',') if item.strip()]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк конвейера распознавания лиц (JSON-отчёт)')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--fixtures', help='папка с фото-фикстурами (single_face.jpg, group.jpg, large_12mp.jpg, ...)')
+    parser.add_argument('--repeat', type=int, default=5, help='замеров на этап и изображение')
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--gallery-sizes', type=parse_int_list, default=[100, 10000, 100000])
+    parser.add_argument('--match-repeat', type=int, default=20)
+    parser.add_argument('--skip-stages', action='store_true', help='не замерять этапы в процессе')
+    parser.add_argument('--skip-match', action='store_true', help='не замерять поиск по галерее')
+    parser.add_argument('--load', action='store_true', help='нагрузочный прогон против сервера')
+    parser.add_argument('--server-url', help='уже запущенный сервер вместо локального')
+    parser.add_argument('--server-role', default='combined', choices=('combined', 'router'))
+    parser.add_argument('--server-start-timeout', type=int, default=120)
+    parser.add_argument('--load-gallery-size', type=int, default=10000)
+    parser.add_argument('--clients', type=parse_int_list, default=[1, 4, 16])
+    parser.add_argument('--duration', type=float, default=15, help='секунд на каждый уровень нагрузки')
+    parser.add_argument('--request-timeout', type=float, default=60)
+    parser.add_argument('--output', help='файл для JSON (по умолчанию stdout)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    cases = load_images(args.fixtures, args.seed)
+
+    report = {
+        'meta': {
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__,
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'warmup': args.warmup
+        }
+    }
+
+    run_match = bool(args.gallery_sizes) and not args.skip_match
+    if not args.skip_stages or run_match:
+        with tempfile.TemporaryDirectory(prefix='bench_face_state_') as state_dir:
+            # Пути базы лиц читаются при импорте - подменяем их до него
+            os.environ['ENCODINGS_FILE'] = os.path.join(state_dir, 'face_encodings.json')
+            os.environ['GALLERY_DB_FILE'] = os.path.join(state_dir, 'face_gallery.sqlite3')
+            import logging
+            import telegram_service as ts
+
+            # Логи сервиса на каждый кадр исказят замеры
+            logging.getLogger(ts.logger.name).setLevel(logging.WARNING)
+            report['meta'].update({
+                'face_model': ts.FACE_MODEL,
+                'num_jitters': ts.NUM_JITTERS,
+                'max_image_size': ts.MAX_IMAGE_SIZE,
+                'use_cuda': ts.USE_CUDA
+            })
+
+            if not args.skip_stages:
+                report['stages'] = bench_stages(ts, cases, args.repeat, args.warmup)
+                report['stages_peak_rss_mb'] = peak_rss_mb()
+            if run_match:
+                report['match'] = bench_match(ts, args.gallery_sizes, args.match_repeat, args.warmup, args.seed)
+
+    if args.load:
+        report['load'] = bench_load(args, cases)
+
+    report['peak_rss_mb'] = peak_rss_mb()
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
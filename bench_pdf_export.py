@@ -0,0 +1,375 @@
+"""
+Бенчмарк экспорта семейного древа в PDF и генератор синтетических семей.
+
+Генератор строит граф семьи как в приложении: id, fatherId/motherId,
+роли относительно владельца древа (GRANDFATHER ... GRANDDAUGHTER, OTHER),
+даты, у части участников - photoBase64 (каждое фото уникально, иначе
+reportlab положит в PDF одну копию и размер будет занижен).
+
+Этапы берутся из гистограмм metrics telegram_service за время прогона
+render_family_tree_pdf:
+    grouping  - pdf_grouping (group_by_generation)
+    layout    - pdf_layout (упорядочивание поколений)
+    photos    - photo_processing (декодирование, обрезка, ресайз фото)
+    save      - pdf_save (сериализация canvas)
+    drawing   - остаток: фон, карточки, линии связей
+плюс размер PDF и пиковый RSS.
+
+Примеры:
+    python bench_pdf_export.py --output pdf_bench.json
+    python bench_pdf_export.py --sizes 10,100,1000,5000 --photo-qualities high,low,none
+    python bench_pdf_export.py --generate-only --sizes 500 --save-family family_500.json
+    python bench_pdf_export.py --family test_import.json
+"""
+import argparse
+import base64
+import io
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import time
+from pathlib import Path
+
+from PIL import Image, ImageDraw
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BASE_DIR = Path(__file__).resolve().parent
+MAX_GENERATION = 3  # Поколения 0..3: бабушки/дедушки ... внуки
+PDF_STAGES = ('pdf_grouping', 'pdf_layout', 'photo_processing', 'pdf_save', 'pdf_render')
+
+PATRONYMICS = {
+    'Александр': ('Александрович', 'Александровна'), 'Марат': ('Маратович', 'Маратовна'),
+    'Иван': ('Иванович', 'Ивановна'), 'Шамиль': ('Шамилевич', 'Шамилевна'),
+    'Раис': ('Раисович', 'Раисовна'), 'Дмитрий': ('Дмитриевич', 'Дмитриевна'),
+    'Тимур': ('Тимурович', 'Тимуровна'), 'Олег': ('Олегович', 'Олеговна'),
+    'Рустам': ('Рустамович', 'Рустамовна'), 'Павел': ('Павлович', 'Павловна'),
+}
+MALE_NAMES = list(PATRONYMICS)
+FEMALE_NAMES = ['Альбина', 'Мария', 'Елена', 'Гульнара', 'Анна', 'Ольга', 'Лилия', 'Наталья', 'Диана', 'Ирина']
+LAST_NAMES = ['Гарипов', 'Иванов', 'Байталов', 'Смирнов', 'Хасанов', 'Петров', 'Сафин', 'Кузнецов']
+
+# Роли по поколению: прямая линия владельца древа и боковые ветви
+ROLES = {
+    (0, True): ('GRANDFATHER', 'GRANDMOTHER'),
+    (0, False): ('GRANDFATHER', 'GRANDMOTHER'),
+    (1, True): ('FATHER', 'MOTHER'),
+    (1, False): ('UNCLE', 'AUNT'),
+    (2, True): ('SON', 'DAUGHTER'),
+    (2, False): ('NEPHEW', 'NIECE'),
+    (3, True): ('GRANDSON', 'GRANDDAUGHTER'),
+    (3, False): ('GRANDSON', 'GRANDDAUGHTER'),
+}
+
+
+# ========================================
+# ГЕНЕРАТОР СЕМЬИ
+# ========================================
+
+def make_photo_base64(rng, pixels, quality=85):
+    """Уникальное «портретное» фото: шумный фон и овал лица"""
+    background = tuple(rng.randrange(60, 220) for _ in range(3))
+    image = Image.new('RGB', (pixels, pixels), background)
+    draw = ImageDraw.Draw(image)
+    for _ in range(24):
+        x, y = rng.randrange(pixels), rng.randrange(pixels)
+        radius = rng.randrange(pixels // 20 + 1, pixels // 6 + 2)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=color)
+    margin = pixels // 5
+    draw.ellipse((margin, margin, pixels - margin, pixels - margin // 2), fill=(224, 182, 150))
+
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality)
+    return 'data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def format_date(rng, year):
+    return f"{rng.randint(1, 28):02d}.{rng.randint(1, 12):02d}.{year}"
+
+
+class FamilyGenerator:
+    """
+    Семьи растут поколениями от корневой пары: у каждой пары 1-4 ребёнка,
+    у части детей появляется супруг(а) без родителей в древе - новая пара
+    следующего поколения. Когда глубина исчерпана, заводится ещё одна
+    корневая линия, пока не наберётся нужное число участников.
+    """
+
+    def __init__(self, seed, photo_ratio, photo_pixels, other_ratio=0.03):
+        self.rng = random.Random(seed)
+        self.photo_ratio = photo_ratio
+        self.photo_pixels = photo_pixels
+        self.other_ratio = other_ratio
+        self.members = []
+        self.by_id = {}
+        self.next_id = 1
+
+    def add_member(self, gender, generation, main_line, last_name, birth_year, father_id=None, mother_id=None):
+        male_role, female_role = ROLES[(generation, main_line)]
+        role = male_role if gender == 'MALE' else female_role
+        if self.rng.random() < self.other_ratio:
+            role = 'OTHER'
+
+        first_name = self.rng.choice(MALE_NAMES if gender == 'MALE' else FEMALE_NAMES)
+        patronymic = ''
+        if father_id:
+            male_patronymic, female_patronymic = PATRONYMICS[self.by_id[father_id]['firstName']]
+            patronymic = male_patronymic if gender == 'MALE' else female_patronymic
+        member = {
+            'id': self.next_id,
+            'firstName': first_name,
+            'lastName': last_name if gender == 'MALE' else f"{last_name}а",
+            'patronymic': patronymic,
+            'gender': gender,
+            'birthDate': format_date(self.rng, birth_year),
+            'role': role,
+            'phoneNumber': '',
+            'fatherId': father_id,
+            'motherId': mother_id,
+            'weddingDate': '',
+            'maidenName': ''
+        }
+        if self.rng.random() < self.photo_ratio:
+            member['photoBase64'] = make_photo_base64(self.rng, self.photo_pixels)
+        self.next_id += 1
+        self.members.append(member)
+        self.by_id[member['id']] = member
+        return member
+
+    def add_couple(self, generation, main_line, last_name, birth_year):
+        husband = self.add_member('MALE', generation, main_line, last_name, birth_year)
+        wife = self.add_member('FEMALE', generation, main_line, self.rng.choice(LAST_NAMES), birth_year + self.rng.randint(-3, 3))
+        wedding_year = birth_year + self.rng.randint(20, 30)
+        husband['weddingDate'] = wife['weddingDate'] = format_date(self.rng, wedding_year)
+        return husband, wife
+
+    def generate(self, member_count):
+        while len(self.members) < member_count:
+            self._grow_line(member_count, main_line=not self.members)
+        return self.members[:member_count]
+
+    def _grow_line(self, member_count, main_line):
+        root_year = 1930 + self.rng.randint(0, 10)
+        couples = [(*self.add_couple(0, True, self.rng.choice(LAST_NAMES), root_year), main_line, root_year)]
+
+        for generation in range(1, MAX_GENERATION + 1):
+            next_couples = []
+            for father, mother, couple_main, couple_year in couples:
+                for child_index in range(self.rng.randint(1, 4)):
+                    if len(self.members) >= member_count:
+                        return
+                    # Прямая линия владельца древа продолжается через первого ребёнка,
+                    # но все дети родителей владельца - уже SON/DAUGHTER
+                    child_main = couple_main and child_index == 0
+                    role_main = couple_main and (child_main or generation >= 2)
+                    child_year = couple_year + self.rng.randint(22, 32)
+                    gender = self.rng.choice(('MALE', 'FEMALE'))
+                    child = self.add_member(gender, generation, role_main, father['lastName'], child_year, father['id'], mother['id'])
+
+                    married = child_main or self.rng.random() < 0.7
+                    if generation < MAX_GENERATION and married and len(self.members) < member_count:
+                        spouse_gender = 'FEMALE' if gender == 'MALE' else 'MALE'
+                        spouse = self.add_member(spouse_gender, generation, role_main, self.rng.choice(LAST_NAMES), child_year + self.rng.randint(-3, 3))
+                        husband, wife = (child, spouse) if gender == 'MALE' else (spouse, child)
+                        husband['weddingDate'] = wife['weddingDate'] = format_date(self.rng, child_year + self.rng.randint(20, 30))
+                        next_couples.append((husband, wife, child_main, child_year))
+            couples = next_couples
+            if not couples:
+                return
+
+
+def generate_family(member_count, seed=1234, photo_ratio=0.7, photo_pixels=480):
+    """Синтетическая семья из member_count участников"""
+    return FamilyGenerator(seed, photo_ratio, photo_pixels).generate(member_count)
+
+
+# ========================================
+# ЗАМЕРЫ
+# ========================================
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return round(peak / divisor, 1)
+
+
+def summarize_seconds(samples):
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+    return {
+        'count': len(samples),
+        'mean_ms': round(sum(samples) / len(samples) * 1000, 3),
+        'min_ms': round(ordered[0] * 1000, 3),
+        'p50_ms': round(ordered[len(ordered) // 2] * 1000, 3),
+        'max_ms': round(ordered[-1] * 1000, 3)
+    }
+
+
+def render_once(ts, members, pagesize, photo_quality):
+    """Один рендер в память: (секунды по этапам, размер PDF)"""
+    before = ts.metrics.stage_totals()
+    buffer = io.BytesIO()
+    started = time.perf_counter()
+    ts.render_family_tree_pdf(buffer, members, pagesize, photo_quality)
+    total = time.perf_counter() - started
+    after = ts.metrics.stage_totals()
+
+    stages = {
+        stage: after.get(stage, (0.0, 0))[0] - before.get(stage, (0.0, 0))[0]
+        for stage in PDF_STAGES
+    }
+    photos_drawn = after.get('photo_processing', (0.0, 0))[1] - before.get('photo_processing', (0.0, 0))[1]
+    result = {
+        'total': total,
+        'grouping': stages['pdf_grouping'],
+        'layout': stages['pdf_layout'],
+        'photos': stages['photo_processing'],
+        'save': stages['pdf_save'],
+    }
+    result['drawing'] = max(0.0, stages['pdf_render'] - result['grouping'] - result['layout'] - result['photos'] - result['save'])
+    return result, buffer.getbuffer().nbytes, photos_drawn
+
+
+def bench_family(ts, members, pagesize, photo_quality, repeat, warmup):
+    samples = {}
+    pdf_size = 0
+    photos_drawn = 0
+    for iteration in range(warmup + repeat):
+        stages, pdf_size, photos_drawn = render_once(ts, members, pagesize, photo_quality)
+        if iteration < warmup:
+            continue
+        for stage, seconds in stages.items():
+            samples.setdefault(stage, []).append(seconds)
+
+    return {
+        'photo_quality': photo_quality,
+        'pdf_bytes': pdf_size,
+        'photos_drawn': photos_drawn,
+        'stages': {stage: summarize_seconds(values) for stage, values in samples.items()},
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def describe_family(members):
+    roles = {}
+    for member in members:
+        roles[member.get('role', 'OTHER')] = roles.get(member.get('role', 'OTHER'), 0) + 1
+    photos = [m['photoBase64'] for m in members if m.get('photoBase64')]
+    return {
+        'members': len(members),
+        'with_parents': sum(1 for m in members if m.get('fatherId') or m.get('motherId')),
+        'photos': len(photos),
+        'photo_payload_bytes': sum(len(photo) for photo in photos),
+        'roles': dict(sorted(roles.items()))
+    }
+
+
+# ========================================
+# MAIN
+# ========================================
+
+def parse_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк экспорта PDF на синтетических семьях (JSON-отчёт)')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--sizes', type=lambda v: [int(x) for x in parse_list(v)], default=[10, 100, 1000, 5000])
+    parser.add_argument('--family', help='JSON со списком участников вместо генератора (например test_import.json)')
+    parser.add_argument('--photo-ratio', type=float, default=0.7, help='доля участников с фото')
+    parser.add_argument('--photo-pixels', type=int, default=480, help='сторона синтетического фото, px')
+    parser.add_argument('--photo-qualities', type=parse_list, default=['high', 'medium', 'none'])
+    parser.add_argument('--page-format', default='A4_LANDSCAPE')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--generate-only', action='store_true', help='только сгенерировать семью (--save-family)')
+    parser.add_argument('--save-family', help='куда сохранить сгенерированную семью (при нескольких размерах - суффикс _<N>)')
+    parser.add_argument('--output', help='файл для JSON (по умолчанию stdout)')
+    return parser.parse_args(argv)
+
+
+def save_family(path, members, suffix):
+    target = Path(path)
+    if suffix:
+        target = target.with_name(f"{target.stem}_{suffix}{target.suffix}")
+    with open(target, 'w', encoding='utf-8') as f:
+        json.dump(members, f, ensure_ascii=False, indent=2)
+    return str(target)
+
+
+def load_families(args):
+    """[(метка, участники)]"""
+    if args.family:
+        with open(args.family, 'r', encoding='utf-8') as f:
+            return [(Path(args.family).name, json.load(f))]
+
+    families = []
+    for size in args.sizes:
+        generated_started = time.perf_counter()
+        members = generate_family(size, args.seed, args.photo_ratio, args.photo_pixels)
+        families.append((str(size), members))
+        print(f"Семья {size}: сгенерирована за {time.perf_counter() - generated_started:.1f}s", file=sys.stderr)
+        if args.save_family:
+            save_family(args.save_family, members, size if len(args.sizes) > 1 else None)
+    return families
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    families = load_families(args)
+    if args.generate_only:
+        return
+
+    import telegram_service as ts
+
+    # Предупреждения на каждую карточку исказят замеры
+    logging.getLogger(ts.logger.name).setLevel(logging.ERROR)
+    pagesize = ts.resolve_page_size(args.page_format)
+
+    report = {
+        'meta': {
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'warmup': args.warmup,
+            'page_format': args.page_format,
+            'photo_pixels': args.photo_pixels if not args.family else None,
+            'pdf_template_version': ts.PDF_TEMPLATE_VERSION
+        },
+        'families': {}
+    }
+
+    for label, members in families:
+        entry = describe_family(members)
+        entry['runs'] = [
+            bench_family(ts, members, pagesize, ts.PHOTO_QUALITY_ALIASES.get(quality, quality), args.repeat, args.warmup)
+            for quality in args.photo_qualities
+        ]
+        report['families'][label] = entry
+
+    report['peak_rss_mb'] = peak_rss_mb()
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,46 +4,148 @@ Combined Server для приложения Семейное Древо
 БЕЗ ПОТЕРИ ФУНКЦИОНАЛЬНОСТИ
 """
 
-from flask import Flask, request, jsonify, send_file, Response
+from flask import Flask, request, jsonify, send_file, Response, redirect, g
 from flask_cors import CORS
-import face_recognition
 import numpy as np
 import base64
+import bisect
+import functools
+import importlib
+import importlib.util
 import io
+import math
 from PIL import Image
 import os
+import sys
 import json
 import logging
+import logging.handlers
+import atexit
+import signal
 from datetime import datetime
 import time
 import pickle
+import queue
+import random
 import hashlib
+import hmac
+import http.client
 import re
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http import HTTPStatus
 from pathlib import Path
+from types import MappingProxyType
+from urllib.parse import quote
+from werkzeug.exceptions import HTTPException
+
+# Настройка логирования
+# Потоки запросов только кладут запись в очередь; форматирование и вывод -
+# в отдельном потоке QueueListener
+class InProcessQueueHandler(logging.handlers.QueueHandler):
+    """Запись уходит в очередь как есть, сообщение собирается в потоке QueueListener"""
+
+    def prepare(self, record):
+        return record
+
+
+log_queue = queue.SimpleQueue()
+_log_output_handler = logging.StreamHandler()
+_log_output_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+log_listener = logging.handlers.QueueListener(log_queue, _log_output_handler, respect_handler_level=True)
+logging.basicConfig(level=logging.INFO, handlers=[InProcessQueueHandler(log_queue)])
+log_listener.start()
+atexit.register(log_listener.stop)
+
+logger = logging.getLogger(__name__)
+access_logger = logging.getLogger(f"{__name__}.access")
+
+
+class JsonLogMessage:
+    """Сообщение лога, сериализуемое в JSON только при выводе"""
+
+    __slots__ = ('fields',)
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __str__(self):
+        return json.dumps(self.fields, ensure_ascii=False, default=str)
+
+
+class LazyModule:
+    """
+    Модуль, который импортируется при первом обращении к атрибуту.
+    Тяжёлые библиотеки (dlib, reportlab, Google API) не грузятся в процессах,
+    которым они не нужны, и не замедляют старт.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    started = time.time()
+                    module = importlib.import_module(self._name)
+                    logger.info(f"Загружен модуль {self._name} за {time.time() - started:.2f} с")
+                    self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+
+def is_module_installed(name):
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+
+# Face recognition (dlib + модели)
+face_recognition = LazyModule('face_recognition')
 
 # Google Drive imports
-try:
-    from google.oauth2.credentials import Credentials
-    from google_auth_oauthlib.flow import InstalledAppFlow
-    from google.auth.transport.requests import Request
-    from googleapiclient.discovery import build
-    from googleapiclient.http import MediaFileUpload
-    GOOGLE_DRIVE_AVAILABLE = True
-except ImportError:
-    GOOGLE_DRIVE_AVAILABLE = False
+google_auth_requests = LazyModule('google.auth.transport.requests')
+google_auth_flow = LazyModule('google_auth_oauthlib.flow')
+googleapiclient_discovery = LazyModule('googleapiclient.discovery')
+googleapiclient_http = LazyModule('googleapiclient.http')
+google_auth_httplib2 = LazyModule('google_auth_httplib2')
+httplib2 = LazyModule('httplib2')
+GOOGLE_DRIVE_AVAILABLE = all(
+    is_module_installed(name)
+    for name in ('googleapiclient', 'google_auth_oauthlib', 'google_auth_httplib2', 'httplib2')
+)
+if not GOOGLE_DRIVE_AVAILABLE:
     logging.warning("Google Drive API не установлен. Используйте: pip install google-api-python-client google-auth-oauthlib")
 
-# PDF imports
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import A4, A3, landscape
-from reportlab.lib.units import mm
-from reportlab.pdfgen import canvas
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
+# S3-совместимое хранилище (опционально)
+boto3 = LazyModule('boto3')
+botocore_config = LazyModule('botocore.config')
+botocore_exceptions = LazyModule('botocore.exceptions')
+S3_AVAILABLE = is_module_installed('boto3')
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+# PDF imports
+pagesizes = LazyModule('reportlab.lib.pagesizes')
+canvas = LazyModule('reportlab.pdfgen.canvas')
+pdfmetrics = LazyModule('reportlab.pdfbase.pdfmetrics')
+ttfonts = LazyModule('reportlab.pdfbase.ttfonts')
+reportlab_utils = LazyModule('reportlab.lib.utils')
 
 BASE_DIR = Path(__file__).resolve().parent
 
@@ -75,6 +177,17 @@ def env_int(name, default):
         return default
 
 
+def env_float(name, default):
+    raw = os.environ.get(name)
+    if raw is None:
+        return default
+    try:
+        return float(raw)
+    except ValueError:
+        logger.warning(f"Некорректное значение {name}={raw!r}, используется {default}")
+        return default
+
+
 def resolve_backend_path(path_value):
     path = Path(path_value)
     if not path.is_absolute():
@@ -97,22 +210,132 @@ CORS_ORIGINS = [
     'http://127.0.0.1:4173',
 ]
 
+# Подсистемы процесса: face - распознавание лиц, pdf - генерация и выдача
+# экспортов, drive - Google Drive. Роуты выключенных подсистем отвечают 503.
+# SUBSYSTEM_PRELOAD=1 - загрузить модули включённых подсистем при старте,
+# а не на первом запросе.
+ALL_SUBSYSTEMS = ('face', 'pdf', 'drive')
+
+# Роль процесса: combined - всё в одном процессе и одном пуле потоков;
+# router - запускает воркеры face и pdf отдельными процессами со своими
+# пулами и проксирует в них запросы по прежним URL; face / pdf - воркеры.
+SERVICE_ROLE = os.environ.get('SERVICE_ROLE', 'combined').strip().lower()
+ROLE_SUBSYSTEMS = {
+    'combined': ALL_SUBSYSTEMS,
+    'router': (),
+    'face': ('face',),
+    'pdf': ('pdf', 'drive'),
+}
+if SERVICE_ROLE not in ROLE_SUBSYSTEMS:
+    logger.warning(f"Неизвестная роль SERVICE_ROLE={SERVICE_ROLE!r}, используется combined")
+    SERVICE_ROLE = 'combined'
+
+SERVICE_SUBSYSTEMS = {
+    name.strip().lower()
+    for name in os.environ.get('SERVICE_SUBSYSTEMS', ','.join(ROLE_SUBSYSTEMS[SERVICE_ROLE])).split(',')
+    if name.strip()
+}
+SUBSYSTEM_PRELOAD = os.environ.get('SUBSYSTEM_PRELOAD', '1') != '0'
+SUBSYSTEM_MODULES = {
+    'face': [face_recognition],
+    'pdf': [pagesizes, canvas, pdfmetrics, ttfonts, reportlab_utils],
+    'drive': [google_auth_requests, googleapiclient_discovery, googleapiclient_http, google_auth_httplib2, httplib2],
+}
+
+for unknown_subsystem in sorted(SERVICE_SUBSYSTEMS - set(ALL_SUBSYSTEMS)):
+    logger.warning(f"Неизвестная подсистема в SERVICE_SUBSYSTEMS: {unknown_subsystem}")
+
+# Воркеры роли router: порт на 127.0.0.1, потоки (параллельные запросы)
+# и очередь (сколько ещё запросов router держит в ожидании, остальным - 503)
+COMBINED_THREADS = 8
+WORKER_CONFIG = {
+    'face': {
+        'port': env_int('FACE_WORKER_PORT', API_PORT + 1),
+        'threads': env_int('FACE_WORKER_THREADS', 2),
+        'queue': env_int('FACE_WORKER_QUEUE', 8),
+    },
+    'pdf': {
+        'port': env_int('PDF_WORKER_PORT', API_PORT + 2),
+        'threads': env_int('PDF_WORKER_THREADS', 4),
+        'queue': env_int('PDF_WORKER_QUEUE', 16),
+    },
+}
+SUBSYSTEM_ROLES = {'face': 'face', 'pdf': 'pdf', 'drive': 'pdf'}
+# Куда router отправляет роуты без подсистемы (метрики, профилировщик и т.п.)
+ROUTER_DEFAULT_ROLE = os.environ.get('ROUTER_DEFAULT_ROLE', 'pdf').strip().lower()
+if ROUTER_DEFAULT_ROLE not in WORKER_CONFIG:
+    raise ValueError(f"ROUTER_DEFAULT_ROLE должен быть одним из: {', '.join(WORKER_CONFIG)}")
+ROUTER_THREADS = env_int(
+    'ROUTER_THREADS',
+    sum(config['threads'] + config['queue'] for config in WORKER_CONFIG.values()) + 4
+)
+ROUTER_PROXY_TIMEOUT = env_int('ROUTER_PROXY_TIMEOUT', 300)
+ROUTER_CHUNK_SIZE = 64 * 1024
+WORKER_RESTART_DELAY_SECONDS = 2
+
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH_BYTES
 CORS(app, resources={r'/*': {'origins': CORS_ORIGINS}})
 
 
+def subsystem_enabled(name):
+    return name in SERVICE_SUBSYSTEMS
+
+
+def requires_subsystem(name):
+    """Роут доступен, только если подсистема включена в этом процессе"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not subsystem_enabled(name):
+                return make_response_json({
+                    'success': False,
+                    'error': f'Подсистема {name} отключена на этом сервере'
+                }, 503)
+            return view(*args, **kwargs)
+        # По этой отметке router выбирает воркер для роута
+        wrapper.subsystem = name
+        return wrapper
+    return decorator
+
+
+def get_subsystems_info():
+    return {
+        name: {
+            'enabled': subsystem_enabled(name),
+            'loaded': all(module.loaded for module in SUBSYSTEM_MODULES[name])
+        }
+        for name in ALL_SUBSYSTEMS
+    }
+
+
+def preload_subsystems():
+    """Загружает модули включённых подсистем заранее (вызывается при старте)"""
+    for name in ALL_SUBSYSTEMS:
+        if not subsystem_enabled(name):
+            continue
+        if name == 'drive' and not GOOGLE_DRIVE_AVAILABLE:
+            continue
+        for module in SUBSYSTEM_MODULES[name]:
+            try:
+                module.load()
+            except ImportError as e:
+                logger.error(f"Не удалось загрузить модуль подсистемы {name}: {e}")
+        if name == 'pdf':
+            ensure_pdf_fonts()
+
+
 def make_response_json(data, status=200):
     """
     Создает JSON ответ с явным Content-Length.
     Это исправляет проблему chunked encoding через Cloudflare Tunnel.
     """
-    response_data = json.dumps(data, ensure_ascii=False)
+    response_data = json.dumps(data, ensure_ascii=False).encode('utf-8')
     return Response(
         response_data,
         status=status,
         mimetype='application/json',
-        headers={'Content-Length': str(len(response_data.encode('utf-8')))}
+        headers={'Content-Length': str(len(response_data))}
     )
 
 
@@ -120,40 +343,431 @@ def make_response_json(data, status=200):
 # MIDDLEWARE для решения проблемы с ngrok
 # ========================================
 
+# Журнал запросов: одна JSON-строка на запрос. Заголовки - только в доле
+# ACCESS_LOG_HEADERS_SAMPLE_RATE запросов (и всегда при уровне DEBUG)
+ACCESS_LOG_ENABLED = os.environ.get('ACCESS_LOG_ENABLED', '1') != '0'
+ACCESS_LOG_HEADERS_SAMPLE_RATE = env_float('ACCESS_LOG_HEADERS_SAMPLE_RATE', 0.01)
+ACCESS_LOG_REDACTED_HEADERS = frozenset(('authorization', 'cookie', 'x-admin-token', 'x-api-key'))
+
+
 @app.before_request
-def log_request_info():
-    """Логируем детали каждого входящего запроса для отладки"""
-    logger.info(f"=== Входящий запрос ===")
-    logger.info(f"Метод: {request.method}")
-    logger.info(f"URL: {request.url}")
-    logger.info(f"Path: {request.path}")
-    logger.info(f"Headers: {dict(request.headers)}")
-    if request.method == 'POST':
-        logger.info(f"Content-Type: {request.content_type}")
-        logger.info(f"Content-Length: {request.content_length}")
+def start_request_timer():
+    g.request_started_at = time.perf_counter()
+
+
+@app.after_request
+def log_access(response):
+    """Запись журнала запросов (регистрируется первой, поэтому выполняется последней)"""
+    if not ACCESS_LOG_ENABLED or not access_logger.isEnabledFor(logging.INFO):
+        return response
+
+    started_at = g.get('request_started_at')
+    fields = {
+        'ts': round(time.time(), 3),
+        'method': request.method,
+        'path': request.path,
+        'status': response.status_code,
+        'duration_ms': round((time.perf_counter() - started_at) * 1000, 1) if started_at else None,
+        'bytes_in': request.content_length,
+        'bytes_out': response.content_length,
+        'remote': request.headers.get('CF-Connecting-IP') or request.remote_addr,
+        'role': SERVICE_ROLE
+    }
+    if access_logger.isEnabledFor(logging.DEBUG) or random.random() < ACCESS_LOG_HEADERS_SAMPLE_RATE:
+        fields['query'] = request.query_string.decode('latin-1')
+        fields['headers'] = {
+            name: '***' if name.lower() in ACCESS_LOG_REDACTED_HEADERS else value
+            for name, value in request.headers.items()
+        }
+    access_logger.info(JsonLogMessage(fields))
+    return response
+
 
 @app.after_request
 def after_request(response):
     """Добавляем заголовки для правильной работы с ngrok"""
     # Отключаем буферизацию nginx/ngrok
     response.headers['X-Accel-Buffering'] = 'no'
-    # Кэширование
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+    # Кэширование (ответы с ETag можно хранить, но только с перепроверкой)
+    if response.headers.get('ETag'):
+        response.headers['Cache-Control'] = 'no-cache, must-revalidate'
+    else:
+        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
     response.headers['Pragma'] = 'no-cache'
     response.headers['Expires'] = '0'
     return response
 
+# ========================================
+# МЕТРИКИ
+# ========================================
+# Гистограммы длительности этапов обработки, счётчики и значения состояния
+# сервиса в формате Prometheus (/api/metrics). В роли router метрики
+# снимаются с воркеров напрямую (FACE_WORKER_PORT / PDF_WORKER_PORT).
+# Доступ - по Bearer-токену METRICS_TOKEN (по умолчанию ADMIN_TOKEN); без
+# токена метрики отдаются только локальным запросам без заголовков прокси.
+METRICS_PREFIX = 'familyone'
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN') or os.environ.get('ADMIN_TOKEN', '')
+LOOPBACK_ADDRESSES = ('127.0.0.1', '::1')
+PROXY_HEADERS = ('X-Forwarded-For', 'Forwarded', 'CF-Connecting-IP')
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRIC_STAGES = (
+    'base64_decode', 'image_decode', 'face_detection', 'face_encoding', 'index_search',
+    'duplicate_check', 'index_build', 'persistence', 'pdf_grouping', 'pdf_layout', 'photo_processing', 'pdf_save', 'pdf_render',
+    'drive_upload', 'drive_download'
+)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+
+class MetricsRegistry:
+    """
+    Метрики процесса: гистограммы этапов, счётчики и сборщики, которые
+    читают текущее состояние (размер базы, очереди) в момент запроса метрик.
+    """
+
+    def __init__(self, prefix, buckets, stages):
+        self.prefix = prefix
+        self.buckets = buckets
+        self._stages = {stage: Histogram(buckets) for stage in stages}
+        self._counters = {}  # (имя, метки) -> значение
+        self._help = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        histogram = self._stages.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self._stages.setdefault(stage, Histogram(self.buckets))
+        histogram.observe(seconds)
+
+    @contextmanager
+    def time_stage(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def timed(self, stage):
+        """Декоратор: длительность вызова функции - в гистограмму этапа"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.time_stage(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def stage_totals(self):
+        """stage -> (сумма секунд, число замеров) - для разницы до/после прогона"""
+        with self._lock:
+            stages = list(self._stages.items())
+        return {stage: histogram.snapshot()[1:] for stage, histogram in stages}
+
+    def inc(self, name, help_text, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+            self._help.setdefault(name, help_text)
+
+    def register_collector(self, collector):
+        """collector() -> [(имя, тип, описание, [(метки, значение), ...]), ...]"""
+        self._collectors.append(collector)
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        parts = []
+        for key, value in labels:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            parts.append(f'{key}="{value}"')
+        return '{' + ','.join(parts) + '}'
+
+    def render(self):
+        """Текст в формате Prometheus exposition 0.0.4"""
+        lines = []
+        name = f"{self.prefix}_stage_duration_seconds"
+        lines.append(f"# HELP {name} Длительность этапов обработки запросов")
+        lines.append(f"# TYPE {name} histogram")
+        for stage, histogram in sorted(self._stages.items()):
+            counts, total_sum, total_count = histogram.snapshot()
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {total_count}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {total_sum}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {total_count}')
+
+        families = OrderedDict()
+        with self._lock:
+            for (counter_name, labels), value in sorted(self._counters.items()):
+                family = families.setdefault(counter_name, ('counter', self._help[counter_name], []))
+                family[2].append((labels, value))
+        for collector in self._collectors:
+            try:
+                for family_name, family_type, help_text, samples in collector():
+                    family = families.setdefault(family_name, (family_type, help_text, []))
+                    family[2].extend((tuple(sorted(labels.items())), value) for labels, value in samples)
+            except Exception as e:
+                logger.warning(f"Ошибка сбора метрик: {e}")
+
+        for family_name, (family_type, help_text, samples) in families.items():
+            full_name = f"{self.prefix}_{family_name}"
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {family_type}")
+            for labels, value in samples:
+                lines.append(f"{full_name}{self._format_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry(METRICS_PREFIX, METRICS_BUCKETS, METRIC_STAGES)
+
+
+def collect_service_metrics():
+    """Текущее состояние сервиса для /api/metrics"""
+    families = []
+    if subsystem_enabled('face'):
+        families.append(('gallery_members', 'gauge', 'Лиц в базе', [({}, len(get_gallery_snapshot()))]))
+        families.append(('gallery_version', 'gauge', 'Версия базы лиц', [({}, gallery_changelog.version)]))
+        if gallery_store is None:
+            families.append((
+                'gallery_pending_writes', 'gauge', 'Изменения базы лиц, ещё не записанные на диск',
+                [({}, gallery_persister.stats()['pending_changes'])]
+            ))
+
+    if subsystem_enabled('pdf'):
+        cache_samples, cache_bytes = [], []
+        for cache_name, cache in (('pdf_result', pdf_result_cache), ('drive_download', drive_download_cache)):
+            stats = cache.stats()
+            cache_samples.append(({'cache': cache_name, 'result': 'hit'}, stats['hits']))
+            cache_samples.append(({'cache': cache_name, 'result': 'miss'}, stats['misses']))
+            cache_bytes.append(({'cache': cache_name}, stats['bytes']))
+        families.append(('cache_requests_total', 'counter', 'Обращения к кэшам', cache_samples))
+        families.append(('cache_bytes', 'gauge', 'Размер файловых кэшей', cache_bytes))
+        families.append(('temp_dir_bytes', 'gauge', 'Размер TEMP_DIR', [({}, scratch_area.stats()['bytes'])]))
+
+        upload_stats = drive_upload_queue.stats()
+        families.append(('drive_upload_queue_depth', 'gauge', 'Загрузки в Drive в очереди', [({}, upload_stats['queued'])]))
+        families.append((
+            'drive_upload_jobs', 'gauge', 'Задания загрузки в Drive по состояниям',
+            [({'state': state}, count) for state, count in upload_stats['jobs'].items()]
+        ))
+
+    in_flight, waiting, rejected = [], [], []
+    for name, gate in admission_gates.items():
+        stats = gate.stats()
+        in_flight.append(({'endpoint': name}, stats['active']))
+        waiting.append(({'endpoint': name}, stats['waiting']))
+        rejected.append(({'endpoint': name, 'reason': 'queue_full'}, stats['rejected']))
+        rejected.append(({'endpoint': name, 'reason': 'timeout'}, stats['timed_out']))
+    families.append(('admission_in_flight', 'gauge', 'Запросы в работе', in_flight))
+    families.append(('admission_waiting', 'gauge', 'Запросы в очереди ожидания', waiting))
+    families.append(('admission_rejected_total', 'counter', 'Отклонённые из-за перегрузки запросы', rejected))
+    families.append((
+        'rate_limited_total', 'counter', 'Запросы, отклонённые лимитом устройства',
+        [({}, device_rate_limiter.stats()['limited'])]
+    ))
+    return families
+
+
+metrics.register_collector(collect_service_metrics)
+
+# ========================================
+# ПРОФИЛИРОВАНИЕ
+# ========================================
+# Статистический профайлер для диагностики в production. Доступен только
+# при заданном ADMIN_TOKEN (заголовок X-Admin-Token):
+# - /api/admin/profile?seconds=N - стеки всех потоков за N секунд;
+# - заголовок X-Profile: 1 - стеки одного запроса, результат по
+#   /api/admin/profiles/<X-Profile-Id из ответа>.
+# Формат - collapsed stacks (flamegraph.pl, speedscope). Без ADMIN_TOKEN
+# хуки не регистрируются и ничего не стоят.
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+PROFILE_REQUEST_HEADER = 'X-Profile'
+PROFILER_DEFAULT_INTERVAL_MS = 5
+PROFILER_MAX_SECONDS = 60
+PROFILER_KEEP_REQUEST_PROFILES = 20
+
+# Листовые функции ожидающих потоков (простаивающий пул waitress, очереди)
+PROFILER_IDLE_LEAVES = frozenset((
+    ('threading.py', 'wait'),
+    ('threading.py', '_wait_for_tstate_lock'),
+    ('queue.py', 'get'),
+    ('selectors.py', 'select'),
+    ('wasyncore.py', 'poll'),
+))
+
+
+class StackSampler:
+    """
+    Периодически снимает стеки потоков через sys._current_frames()
+    и считает одинаковые стеки. Сами запросы не замедляются, пока
+    сэмплер не запущен.
+    """
+
+    def __init__(self, interval_seconds, thread_ids=None, include_idle=False):
+        self.interval_seconds = interval_seconds
+        self.thread_ids = thread_ids
+        self.include_idle = include_idle
+        self.samples = 0
+        self.started_at = None
+        self.duration = 0.0
+        self._counts = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.duration = time.perf_counter() - self.started_at
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval_seconds):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or (self.thread_ids and thread_id not in self.thread_ids):
+                    continue
+                leaf = (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+                if not self.include_idle and leaf in PROFILER_IDLE_LEAVES:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                key = ';'.join(reversed(stack))
+                self._counts[key] = self._counts.get(key, 0) + 1
+            self.samples += 1
+
+    def collapsed(self):
+        """Строки "поток;функция;...;функция N" - по убыванию числа сэмплов"""
+        counts = sorted(self._counts.items(), key=lambda item: -item[1])
+        return ''.join(f"{stack} {count}\n" for stack, count in counts)
+
+
+_thread_profile_lock = threading.Lock()  # Одновременно - один профиль всех потоков
+_request_profiles_lock = threading.Lock()
+request_profiles = OrderedDict()  # profile_id -> collapsed stacks
+
+
+def is_admin_request():
+    token = request.headers.get('X-Admin-Token', '')
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8'))
+
+
+def start_request_profile():
+    if PROFILE_REQUEST_HEADER not in request.headers or not is_admin_request():
+        return
+    sampler = StackSampler(PROFILER_DEFAULT_INTERVAL_MS / 1000, thread_ids={threading.get_ident()})
+    sampler.start()
+    g.request_profiler = sampler
+
+
+def finish_request_profile(response):
+    sampler = g.pop('request_profiler', None)
+    if sampler is None:
+        return response
+    sampler.stop()
+
+    profile_id = uuid.uuid4().hex[:12]
+    with _request_profiles_lock:
+        request_profiles[profile_id] = sampler.collapsed()
+        while len(request_profiles) > PROFILER_KEEP_REQUEST_PROFILES:
+            request_profiles.popitem(last=False)
+    response.headers['X-Profile-Id'] = profile_id
+    response.headers['X-Profile-Samples'] = str(sampler.samples)
+    return response
+
+
+def make_profile_response(collapsed, name):
+    body = collapsed.encode('utf-8')
+    return Response(body, mimetype='text/plain; charset=utf-8', headers={
+        'Content-Length': str(len(body)),
+        'Content-Disposition': f'attachment; filename="{name}.folded"'
+    })
+
+
+if ADMIN_TOKEN:
+    app.before_request(start_request_profile)
+    app.after_request(finish_request_profile)
+
 # ========================================
 # FACE RECOGNITION - Конфигурация
 # ========================================
 REFERENCE_PHOTOS_DIR = str(BASE_DIR / 'reference_photos')
 UPLOADED_PHOTOS_DIR = str(BASE_DIR / 'uploaded_photos')
-ENCODINGS_FILE = str(BASE_DIR / 'face_encodings.json')
-
-os.makedirs(REFERENCE_PHOTOS_DIR, exist_ok=True)
-os.makedirs(UPLOADED_PHOTOS_DIR, exist_ok=True)
-
-face_encodings_db = {}
+ENCODINGS_FILE = resolve_backend_path(os.environ.get('ENCODINGS_FILE', 'face_encodings.json'))
+
+# Эталонные фото: вырезанное лицо с полями, JPEG с заданным качеством.
+# Раскладка: REFERENCE_PHOTOS_DIR/<device_id|_shared>/<2 символа хэша>/<member_id>.jpg
+REFERENCE_PHOTO_QUALITY = env_int('REFERENCE_PHOTO_QUALITY', 85)
+REFERENCE_PHOTO_MAX_SIZE = env_int('REFERENCE_PHOTO_MAX_SIZE', 256)
+REFERENCE_PHOTO_MARGIN = 0.4  # Поля вокруг лица (доля от размера лица)
+REFERENCE_PHOTO_SHARED_SCOPE = '_shared'
+
+# Запись и удаление эталонных фото - в одном фоновом потоке, по порядку
+reference_photo_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='reference-photo')
+
+# База лиц - неизменяемый снимок вместе с поисковым индексом (GalleryIndex).
+# Читатели берут ссылку на текущую пару и работают с ней без блокировок;
+# писатели под _gallery_write_lock делают копию, правят её и публикуют новую
+# пару (снимок, индекс) одной операцией присваивания. Кодировки хранятся
+# только в индексе, в опубликованных записях снимка их нет.
+_gallery_state = (MappingProxyType({}), None)  # Пустой индекс - после GalleryIndex
+_gallery_write_lock = threading.Lock()
+
+# Отложенная запись ENCODINGS_FILE: не чаще раза в интервал или после N изменений
+GALLERY_FLUSH_INTERVAL_SECONDS = 2
+GALLERY_FLUSH_MAX_PENDING = env_int('GALLERY_FLUSH_MAX_PENDING', 50)
+
+# Хранилище базы лиц: 'json' - ENCODINGS_FILE целиком, 'sqlite' - таблица
+# с индексами по device_id, имени и хэшу фото (запись сразу, без write-behind)
+GALLERY_BACKEND = os.environ.get('GALLERY_BACKEND', 'json').strip().lower()
+GALLERY_DB_FILE = resolve_backend_path(os.environ.get('GALLERY_DB_FILE', 'face_gallery.sqlite3'))
+
+# Кодировки в памяти - float32, поиск идёт по одной непрерывной матрице.
+# GALLERY_QUANTIZATION=int8 (только с GALLERY_BACKEND=sqlite) оставляет в памяти
+# int8 с масштабом на строку; GALLERY_RESCORE_TOP лучших кандидатов каждого
+# поиска пересчитываются точно по float-кодировкам из SQLite.
+ENCODING_SIZE = 128
+ENCODING_DTYPE = np.float32
+GALLERY_QUANTIZATION = os.environ.get('GALLERY_QUANTIZATION', 'none').strip().lower()
+GALLERY_RESCORE_TOP = max(1, min(env_int('GALLERY_RESCORE_TOP', 32), 500))
+GALLERY_INDEX_CHUNK_ROWS = 16384  # Строк матрицы на блок при поиске
+
+# Синхронизация list_faces: журнал изменений для since=<gallery_version>
+# (в памяти; после перезапуска или переполнения клиент делает полную выгрузку)
+GALLERY_CHANGELOG_MAX = env_int('GALLERY_CHANGELOG_MAX', 10000)
+LIST_FACES_MAX_LIMIT = 1000
 
 # ========================================
 # CUDA / GPU Настройки
@@ -184,11 +798,344 @@ CACHE_MAX_SIZE = 100
 
 logger.info(f"Face Recognition настроен: model={FACE_MODEL}, CUDA={'включен' if USE_CUDA else 'выключен'}")
 
+# ========================================
+# ФАЙЛОВЫЙ КЭШ
+# ========================================
+
+class FileCache:
+    """
+    Кэш файлов на диске с ограничением по суммарному размеру и возрасту.
+
+    Ключ - имя файла без расширения. Вытесняются давно не использованные
+    записи (LRU). Метаданные записей хранятся только в памяти: после
+    перезапуска файлы остаются в кэше, но без метаданных.
+    """
+
+    KEY_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,128}$')
+
+    def __init__(self, directory, max_bytes, max_age_seconds, suffix=''):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> {'size', 'created_at', 'meta'}
+        self._total_bytes = 0
+        self._loaded = False
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}{self.suffix}")
+
+    def _ensure_loaded(self):
+        """Папка создаётся и сканируется при первом обращении к кэшу"""
+        if self._loaded or not self.enabled:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+        os.makedirs(self.directory, exist_ok=True)
+        self._load_existing()
+
+    def _load_existing(self):
+        """Подхватывает файлы, оставшиеся с прошлого запуска (старые - первыми)"""
+        found = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or not entry.name.endswith(self.suffix):
+                continue
+            key = entry.name[:len(entry.name) - len(self.suffix)] if self.suffix else entry.name
+            if not self.KEY_PATTERN.match(key):
+                continue
+            stat = entry.stat()
+            found.append((stat.st_mtime, key, stat.st_size))
+
+        with self._lock:
+            for mtime, key, size in sorted(found):
+                self._entries[key] = {'size': size, 'created_at': mtime, 'meta': {}}
+                self._total_bytes += size
+            self._evict_locked()
+
+    def get(self, key):
+        """Возвращает (путь, метаданные) или None"""
+        if not self.enabled or not self.KEY_PATTERN.match(str(key)):
+            return None
+
+        self._ensure_loaded()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry['created_at'] > self.max_age_seconds:
+                self._remove_locked(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._path(key), dict(entry['meta'])
+
+    def put_file(self, key, source_path, meta=None, move=False, link=False):
+        """
+        Кладёт готовый файл в кэш. Возвращает путь в кэше или None.
+        move - переместить файл, link - жёсткая ссылка (копия, если не вышло).
+        Файл больше max_bytes в кэш не попадает, исходный файл остаётся на месте.
+        """
+        if not self.enabled or not self.KEY_PATTERN.match(str(key)):
+            return None
+        try:
+            if os.path.getsize(source_path) > self.max_bytes:
+                return None
+        except OSError:
+            return None
+
+        self._ensure_loaded()
+        target_path = self._path(key)
+        temp_path = f"{target_path}.{threading.get_ident()}.tmp"
+        try:
+            if move:
+                shutil.move(source_path, temp_path)
+            elif link:
+                try:
+                    os.link(source_path, temp_path)
+                except OSError:
+                    shutil.copyfile(source_path, temp_path)
+            else:
+                shutil.copyfile(source_path, temp_path)
+            os.replace(temp_path, target_path)
+        except OSError as e:
+            logger.warning(f"Не удалось записать в кэш {self.directory}: {e}")
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return None
+
+        size = os.path.getsize(target_path)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._total_bytes -= old['size']
+            self._entries[key] = {'size': size, 'created_at': time.time(), 'meta': dict(meta or {})}
+            self._total_bytes += size
+            self._evict_locked(keep=key)
+        return target_path
+
+    def update_meta(self, key, **meta):
+        self._ensure_loaded()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry['meta'].update(meta)
+
+    def discard(self, key):
+        self._ensure_loaded()
+        with self._lock:
+            self._remove_locked(key)
+
+    def _remove_locked(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._total_bytes -= entry['size']
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict_locked(self, keep=None):
+        """keep - только что записанный ключ, он не вытесняется"""
+        now = time.time()
+        expired = [key for key, entry in self._entries.items() if now - entry['created_at'] > self.max_age_seconds]
+        for key in expired:
+            if key != keep:
+                self._remove_locked(key)
+        for key in list(self._entries):
+            if self._total_bytes <= self.max_bytes:
+                break
+            if key != keep:
+                self._remove_locked(key)
+
+    def stats(self):
+        self._ensure_loaded()
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+# ========================================
+# ВРЕМЕННЫЕ ФАЙЛЫ
+# ========================================
+
+class ScratchArea:
+    """
+    Рабочая папка для временных файлов заданий.
+
+    Каждое задание получает уникальное имя. Фоновый поток удаляет файлы
+    старше max_age_seconds, а при превышении квоты - самые старые, пока
+    папка не уложится в max_bytes. Файлы, с которыми идёт работа, не трогаются.
+    """
+
+    def __init__(self, directory, max_bytes, max_age_seconds, reap_interval_seconds):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.reap_interval_seconds = reap_interval_seconds
+        self._lock = threading.Lock()
+        self._active = set()
+        self._usage_bytes = 0
+        self._files_count = 0
+        self._reaped_files = 0
+        self._reaped_bytes = 0
+        self._reaper_started = False
+
+    def new_path(self, prefix, suffix):
+        """Уникальный путь для файла задания (помечается как занятый до release)"""
+        self.start_reaper()
+        if self._usage_bytes > self.max_bytes:
+            self.reap()
+
+        path = os.path.join(self.directory, f"{prefix}_{uuid.uuid4().hex}{suffix}")
+        with self._lock:
+            self._active.add(path)
+        return path
+
+    def release(self, path):
+        """Задание завершено: файл удаляется, если его не забрали (move)"""
+        with self._lock:
+            self._active.discard(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # Например, файл ещё открыт на Windows - его уберёт фоновая очистка
+            logger.debug("Временный файл пока не удалён: %s: %s", path, e)
+
+    def start_reaper(self):
+        if self._reaper_started:
+            return
+        with self._lock:
+            if self._reaper_started:
+                return
+            self._reaper_started = True
+        os.makedirs(self.directory, exist_ok=True)
+        threading.Thread(target=self._reaper_loop, name='scratch-reaper', daemon=True).start()
+
+    def _reaper_loop(self):
+        while True:
+            try:
+                self.reap()
+            except Exception as e:
+                logger.error(f"Ошибка очистки {self.directory}: {e}")
+            time.sleep(self.reap_interval_seconds)
+
+    def reap(self):
+        """Удаляет устаревшие файлы и самые старые при превышении квоты"""
+        now = time.time()
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, entry.path, stat.st_size))
+        files.sort()
+
+        usage = sum(size for _, _, size in files)
+        remaining = len(files)
+        reaped_files = 0
+        reaped_bytes = 0
+        for mtime, path, size in files:
+            expired = now - mtime > self.max_age_seconds
+            if not expired and usage <= self.max_bytes:
+                break
+            # Занятость проверяется под блокировкой непосредственно перед удалением:
+            # new_path() мог выдать этот путь уже после сканирования
+            with self._lock:
+                if path in self._active:
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+            usage -= size
+            remaining -= 1
+            reaped_files += 1
+            reaped_bytes += size
+
+        with self._lock:
+            self._usage_bytes = usage
+            self._files_count = remaining
+            self._reaped_files += reaped_files
+            self._reaped_bytes += reaped_bytes
+
+        if reaped_files:
+            logger.info(f"Очистка {self.directory}: удалено {reaped_files} файлов, {reaped_bytes} байт")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'files': self._files_count,
+                'bytes': self._usage_bytes,
+                'max_bytes': self.max_bytes,
+                'active': len(self._active),
+                'reaped_files': self._reaped_files,
+                'reaped_bytes': self._reaped_bytes
+            }
+
+
 # ========================================
 # PDF - Конфигурация
 # ========================================
-TEMP_DIR = str(BASE_DIR / 'temp_pdf')
-os.makedirs(TEMP_DIR, exist_ok=True)
+TEMP_DIR = str(BASE_DIR / 'temp_pdf')  # Создаётся при первом задании
+
+# Квота и очистка TEMP_DIR
+TEMP_DIR_MAX_BYTES = env_int('TEMP_DIR_MAX_MB', 500) * 1024 * 1024
+TEMP_DIR_MAX_AGE_SECONDS = env_int('TEMP_DIR_MAX_AGE_MINUTES', 60) * 60
+TEMP_DIR_REAP_INTERVAL_SECONDS = 300
+
+scratch_area = ScratchArea(TEMP_DIR, TEMP_DIR_MAX_BYTES, TEMP_DIR_MAX_AGE_SECONDS, TEMP_DIR_REAP_INTERVAL_SECONDS)
+
+# Потоковая отдача PDF (delivery='stream')
+PDF_SPOOL_MAX_MEMORY_BYTES = env_int('PDF_SPOOL_MAX_MEMORY_MB', 16) * 1024 * 1024
+PDF_STREAM_CHUNK_SIZE = 256 * 1024
+
+# Кэш готовых PDF по содержимому дерева
+# Увеличивайте PDF_TEMPLATE_VERSION при любом изменении оформления PDF
+PDF_TEMPLATE_VERSION = '3'
+PDF_CACHE_DIR = resolve_backend_path(os.environ.get('PDF_CACHE_DIR', 'pdf_cache'))
+PDF_CACHE_MAX_BYTES = env_int('PDF_CACHE_MAX_MB', 200) * 1024 * 1024
+PDF_CACHE_MAX_AGE_SECONDS = env_int('PDF_CACHE_MAX_AGE_HOURS', 24) * 3600
+
+pdf_result_cache = FileCache(PDF_CACHE_DIR, PDF_CACHE_MAX_BYTES, PDF_CACHE_MAX_AGE_SECONDS, suffix='.pdf')
+
+# Качество фото в PDF (photo_quality из приложения: low / medium / high)
+# 'none' - только аватары, JPEG - миниатюры под печатное разрешение,
+# PNG - исходный вариант с прозрачностью и 3-кратным запасом по размеру
+PHOTO_QUALITY_TIERS = {
+    'none': None,
+    'low': {'format': 'JPEG', 'dpi': 96, 'jpeg_quality': 60, 'bytes_per_pixel': 0.15},
+    'medium': {'format': 'JPEG', 'dpi': 150, 'jpeg_quality': 75, 'bytes_per_pixel': 0.25},
+    'high': {'format': 'PNG', 'oversample': 3, 'bytes_per_pixel': 2.5},
+}
+PHOTO_QUALITY_ALIASES = {'avatars': 'none', 'thumbnail': 'medium', 'full': 'high'}
+PHOTO_QUALITY_ORDER = ['high', 'medium', 'low', 'none']
+DEFAULT_PHOTO_QUALITY = 'high'
+PDF_PHOTO_SIZE = 45  # Размер фото на карточке, pt
+PDF_BASE_SIZE_ESTIMATE_BYTES = 80 * 1024  # PDF без фото: фон, шрифты, карточки
 
 # Цвета
 PURPLE = (94/255, 67/255, 236/255)
@@ -200,6 +1147,11 @@ GRAY_TEXT = (100/255, 100/255, 100/255)
 LINE_COLOR = (160/255, 140/255, 200/255)
 CARD_BORDER = (180/255, 160/255, 220/255)
 WHITE = (1, 1, 1)
+WHITE_RGB = (255, 255, 255)
+
+# Разводка линий связей
+BARYCENTER_SWEEPS = 3  # Проходы вниз/вверх/вниз при упорядочивании поколений
+BUS_LANE_GAP = 4  # Расстояние между шинами разных семей в одном промежутке
 
 # ========================================
 # GOOGLE DRIVE - Конфигурация
@@ -208,75 +1160,201 @@ GOOGLE_DRIVE_FOLDER_ID = os.environ.get('GOOGLE_DRIVE_FOLDER_ID', '1DuNnC5uQbAIs
 GOOGLE_CREDENTIALS_FILE = resolve_backend_path(os.environ.get('GOOGLE_CREDENTIALS_FILE', 'oauth_credentials.json'))
 GOOGLE_TOKEN_FILE = resolve_backend_path(os.environ.get('GOOGLE_TOKEN_FILE', 'token.pickle'))
 GOOGLE_SCOPES = ['https://www.googleapis.com/auth/drive.file']
+DRIVE_PROXY_CHUNK_SIZE = 1024 * 1024  # Размер куска при проксировании из Drive
+
+# Локальный кэш файлов, загруженных в Drive (ключ - drive_id)
+# /download_pdf/<drive_id> отдаёт файл с диска, Drive - только запасной путь
+DRIVE_CACHE_DIR = resolve_backend_path(os.environ.get('DRIVE_CACHE_DIR', 'drive_cache'))
+DRIVE_CACHE_MAX_BYTES = env_int('DRIVE_CACHE_MAX_MB', 500) * 1024 * 1024
+DRIVE_CACHE_MAX_AGE_SECONDS = env_int('DRIVE_CACHE_MAX_AGE_HOURS', 24 * 7) * 3600
+
+drive_download_cache = FileCache(DRIVE_CACHE_DIR, DRIVE_CACHE_MAX_BYTES, DRIVE_CACHE_MAX_AGE_SECONDS, suffix='.bin')
+
+# Фоновая загрузка в Drive: клиент сразу получает локальную ссылку,
+# после подтверждения загрузки ссылка переключается на Drive
+DRIVE_UPLOAD_ASYNC = os.environ.get('DRIVE_UPLOAD_ASYNC', '1') != '0'
+DRIVE_UPLOAD_SPOOL_DIR = resolve_backend_path(os.environ.get('DRIVE_UPLOAD_SPOOL_DIR', 'drive_uploads'))
+DRIVE_UPLOAD_JOURNAL_FILE = resolve_backend_path(os.environ.get('DRIVE_UPLOAD_JOURNAL_FILE', 'drive_upload_journal.json'))
+DRIVE_UPLOAD_WORKERS = env_int('DRIVE_UPLOAD_WORKERS', 2)
+DRIVE_UPLOAD_MAX_ATTEMPTS = env_int('DRIVE_UPLOAD_MAX_ATTEMPTS', 8)
+DRIVE_UPLOAD_RETRY_BASE_SECONDS = 2
+DRIVE_UPLOAD_RETRY_MAX_SECONDS = 300
+DRIVE_UPLOAD_JOURNAL_RETENTION_SECONDS = 24 * 3600  # Сколько помнить завершённые загрузки
 
-# Кэшированный сервис Google Drive
-_google_drive_service = None
+# ========================================
+# ХРАНИЛИЩЕ ЭКСПОРТОВ - Конфигурация
+# ========================================
+# google_drive - Drive (+ локальный кэш), local - папка на сервере, s3 - S3-совместимое хранилище
+EXPORT_STORAGE = os.environ.get('EXPORT_STORAGE', 'google_drive').strip().lower()
+LOCAL_EXPORT_DIR = resolve_backend_path(os.environ.get('LOCAL_EXPORT_DIR', 'exports'))
+# Квота и срок хранения экспортов в LOCAL_EXPORT_DIR (0 - без ограничения)
+LOCAL_EXPORT_MAX_BYTES = env_int('LOCAL_EXPORT_MAX_MB', 2048) * 1024 * 1024
+LOCAL_EXPORT_MAX_AGE_SECONDS = env_int('LOCAL_EXPORT_MAX_AGE_HOURS', 24 * 7) * 3600
+LOCAL_EXPORT_REAP_INTERVAL_SECONDS = 600
+S3_BUCKET = os.environ.get('S3_BUCKET', '')
+S3_PREFIX = os.environ.get('S3_PREFIX', 'exports/')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL') or None  # Например, локальный MinIO
+S3_REGION = os.environ.get('S3_REGION') or None
+S3_PRESIGNED_REDIRECT = os.environ.get('S3_PRESIGNED_REDIRECT', '0') == '1'
+S3_PRESIGNED_EXPIRES_SECONDS = env_int('S3_PRESIGNED_EXPIRES_SECONDS', 3600)
+EXPORT_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,128}$')
+
+DRIVE_HTTP_TIMEOUT = env_int('DRIVE_HTTP_TIMEOUT', 60)
+
+# Учётные данные общие для всех потоков, обновляются под блокировкой.
+# Клиент Drive (httplib2 не потокобезопасен) - свой в каждом потоке,
+# соединение внутри него переиспользуется между запросами.
+_google_credentials = None
+_google_credentials_lock = threading.Lock()
+_google_drive_clients = threading.local()
+
+
+def save_google_token(creds):
+    """Атомарно сохраняет токен (вызывается под _google_credentials_lock)"""
+    temp_path = f"{GOOGLE_TOKEN_FILE}.tmp"
+    try:
+        with open(temp_path, 'wb') as token:
+            pickle.dump(creds, token)
+        os.replace(temp_path, GOOGLE_TOKEN_FILE)
+        logger.info("Токен Google Drive сохранён")
+    except Exception as e:
+        logger.warning(f"Ошибка сохранения токена: {e}")
 
 
-def get_google_drive_service():
+def get_google_credentials():
     """
-    Получает авторизованный сервис Google Drive.
+    Возвращает действующие учётные данные Google.
+    Загрузка, обновление и сохранение токена выполняются одним потоком за раз.
     При первом запуске откроет браузер для авторизации.
     """
-    global _google_drive_service
-    
-    if not GOOGLE_DRIVE_AVAILABLE:
-        logger.warning("Google Drive API не доступен")
-        return None
-    
-    if _google_drive_service is not None:
-        return _google_drive_service
-    
-    creds = None
-    
-    # Загружаем сохранённый токен
-    if os.path.exists(GOOGLE_TOKEN_FILE):
-        try:
-            with open(GOOGLE_TOKEN_FILE, 'rb') as token:
-                creds = pickle.load(token)
-        except Exception as e:
-            logger.warning(f"Ошибка загрузки токена: {e}")
-    
-    # Если токен невалидный - обновляем или запрашиваем новый
-    if not creds or not creds.valid:
+    global _google_credentials
+
+    creds = _google_credentials
+    if creds is not None and creds.valid:
+        return creds
+
+    with _google_credentials_lock:
+        creds = _google_credentials
+        # Пока ждали блокировку, токен мог обновить другой поток
+        if creds is not None and creds.valid:
+            return creds
+
+        # Загружаем сохранённый токен
+        if creds is None and os.path.exists(GOOGLE_TOKEN_FILE):
+            try:
+                with open(GOOGLE_TOKEN_FILE, 'rb') as token:
+                    creds = pickle.load(token)
+            except Exception as e:
+                logger.warning(f"Ошибка загрузки токена: {e}")
+
+        if creds is not None and creds.valid:
+            _google_credentials = creds
+            return creds
+
+        # Если токен невалидный - обновляем или запрашиваем новый
         if creds and creds.expired and creds.refresh_token:
             try:
-                creds.refresh(Request())
+                creds.refresh(google_auth_requests.Request())
                 logger.info("Токен Google Drive обновлён")
             except Exception as e:
                 logger.warning(f"Ошибка обновления токена: {e}")
                 creds = None
-        
+        else:
+            creds = None
+
         if not creds:
             if not os.path.exists(GOOGLE_CREDENTIALS_FILE):
                 logger.error(f"Файл {GOOGLE_CREDENTIALS_FILE} не найден!")
                 return None
-            
+
             try:
-                flow = InstalledAppFlow.from_client_secrets_file(
+                flow = google_auth_flow.InstalledAppFlow.from_client_secrets_file(
                     GOOGLE_CREDENTIALS_FILE, GOOGLE_SCOPES)
                 creds = flow.run_local_server(port=0, open_browser=True)
                 logger.info("Авторизация Google Drive успешна")
             except Exception as e:
                 logger.error(f"Ошибка авторизации Google Drive: {e}")
                 return None
-        
+
         # Сохраняем токен
+        save_google_token(creds)
+        _google_credentials = creds
+        return creds
+
+
+def refresh_google_credentials(rejected_token):
+    """
+    Обновляет токен, который Drive отклонил (401), и сохраняет его.
+    Если другой поток уже обновил токен, повторно не обновляет.
+    """
+    with _google_credentials_lock:
+        creds = _google_credentials
+        if creds is None or creds.token != rejected_token or not creds.refresh_token:
+            return
         try:
-            with open(GOOGLE_TOKEN_FILE, 'wb') as token:
-                pickle.dump(creds, token)
-            logger.info("Токен Google Drive сохранён")
+            creds.refresh(google_auth_requests.Request())
         except Exception as e:
-            logger.warning(f"Ошибка сохранения токена: {e}")
-    
+            logger.warning(f"Ошибка обновления токена: {e}")
+            return
+        logger.info("Токен Google Drive обновлён")
+        save_google_token(creds)
+
+
+class SharedGoogleCredentials:
+    """
+    Учётные данные для транспорта потока (AuthorizedHttp).
+
+    Транспорт сам вызывает refresh() при истёкшем токене и на 401. Здесь
+    обновление всегда идёт через get_google_credentials() и
+    refresh_google_credentials() под _google_credentials_lock с сохранением
+    токена - общий объект учётных данных транспорт напрямую не обновляет.
+    """
+
+    def __init__(self):
+        self._token = None  # Токен, отправленный последним запросом этого потока
+
+    def before_request(self, request, method, url, headers):
+        creds = get_google_credentials()
+        if creds is None:
+            raise RuntimeError('Нет действующих учётных данных Google Drive')
+        self._token = creds.token
+        headers['authorization'] = f'Bearer {self._token}'
+
+    def refresh(self, request):
+        refresh_google_credentials(self._token)
+
+
+def get_google_drive_service():
+    """
+    Получает авторизованный сервис Google Drive для текущего потока.
+    """
+    if not GOOGLE_DRIVE_AVAILABLE:
+        logger.warning("Google Drive API не доступен")
+        return None
+
+    if get_google_credentials() is None:
+        return None
+
+    # Клиент потока не привязан к объекту учётных данных: токен берётся
+    # из общих учётных данных перед каждым запросом
+    service = getattr(_google_drive_clients, 'service', None)
+    if service is not None:
+        return service
+
     try:
-        _google_drive_service = build('drive', 'v3', credentials=creds)
-        return _google_drive_service
+        authorized_http = google_auth_httplib2.AuthorizedHttp(
+            SharedGoogleCredentials(), http=httplib2.Http(timeout=DRIVE_HTTP_TIMEOUT)
+        )
+        service = googleapiclient_discovery.build('drive', 'v3', http=authorized_http, cache_discovery=False)
     except Exception as e:
         logger.error(f"Ошибка создания сервиса Google Drive: {e}")
         return None
 
+    _google_drive_clients.service = service
+    return service
 
+
+@metrics.timed('drive_upload')
 def upload_to_google_drive(filepath, filename, mimetype='application/pdf'):
     """
     Загружает файл в Google Drive и создаёт публичную ссылку.
@@ -302,7 +1380,7 @@ def upload_to_google_drive(filepath, filename, mimetype='application/pdf'):
         }
         
         # Загружаем файл
-        media = MediaFileUpload(filepath, mimetype=mimetype, resumable=True)
+        media = googleapiclient_http.MediaFileUpload(filepath, mimetype=mimetype, resumable=True)
         file = service.files().create(
             body=file_metadata,
             media_body=media,
@@ -329,8 +1407,13 @@ def upload_to_google_drive(filepath, filename, mimetype='application/pdf'):
         # Дополнительная ссылка для просмотра в браузере
         view_url = f"https://drive.google.com/file/d/{file_id}/view?usp=sharing"
         
-        logger.info(f"Файл загружен в Google Drive: {filename} (ID: {file_id})")
-        logger.info(f"Download URL: {download_url}")
+        logger.info("Файл загружен в Google Drive: %s (ID: %s)", filename, file_id)
+        logger.info("Download URL: %s", download_url)
+
+        # Копия для быстрой отдачи через /download_pdf/<drive_id>
+        drive_download_cache.put_file(
+            file_id, filepath, meta={'filename': filename, 'mimetype': mimetype}, link=True
+        )
         
         return {
             'drive_id': file_id,
@@ -345,44 +1428,716 @@ def upload_to_google_drive(filepath, filename, mimetype='application/pdf'):
         traceback.print_exc()
         return None
 
-def setup_fonts():
-    """Настройка шрифтов с поддержкой кириллицы"""
+class DriveUploadQueue:
+    """
+    Очередь фоновой загрузки файлов в Google Drive.
+
+    Задания хранятся в журнале (JSON), поэтому незавершённые загрузки
+    переживают перезапуск сервера. Неудачная попытка повторяется с
+    экспоненциальной задержкой, после max_attempts задание помечается failed.
+    Пока загрузка не подтверждена, файл лежит в spool_dir и отдаётся локально.
+
+    Состояния: pending (ждёт попытки), uploading (загружается сейчас),
+    done, failed. pending и uploading - незавершённые.
+    """
+
+    ACTIVE_STATES = ('pending', 'uploading')
+
+    def __init__(self, spool_dir, journal_path, workers, max_attempts):
+        self.spool_dir = spool_dir
+        self.journal_path = journal_path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self._jobs = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self):
+        """Загружает журнал и запускает рабочие потоки (один раз)"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            os.makedirs(self.spool_dir, exist_ok=True)
+            self._load_journal_locked()
+            now = time.time()
+            pending = []
+            for export_id, job in self._jobs.items():
+                if job['state'] not in self.ACTIVE_STATES:
+                    continue
+                # Загрузка прервалась вместе с процессом - повторяем её
+                job['state'] = 'pending'
+                pending.append((export_id, job.get('next_attempt_at', now) - now))
+
+        # Отложенные повторы ждут оставшуюся часть задержки
+        for export_id, delay in pending:
+            self._schedule(export_id, delay)
+        if pending:
+            logger.info(f"Возобновлено {len(pending)} загрузок в Google Drive из журнала")
+
+        for index in range(max(1, self.workers)):
+            threading.Thread(target=self._worker, name=f'drive-upload-{index}', daemon=True).start()
+
+    def enqueue(self, export_id, source_path, filename, cache_key=None, move=False):
+        """Ставит файл в очередь. Повторный вызов для того же export_id вернёт существующее задание"""
+        self.start()
+
+        # Проверка и постановка - под одной блокировкой, иначе два одновременных
+        # запроса одного экспорта поставят две загрузки. Файл обычно переносится
+        # жёсткой ссылкой или move, так что блокировка держится недолго.
+        with self._lock:
+            job = self._jobs.get(export_id)
+            if job is not None and job['state'] in self.ACTIVE_STATES + ('done',):
+                return dict(job)
+
+            spool_path = os.path.join(self.spool_dir, f"{export_id}.pdf")
+            temp_path = f"{spool_path}.{threading.get_ident()}.tmp"
+            if move:
+                shutil.move(source_path, temp_path)
+            else:
+                try:
+                    os.link(source_path, temp_path)
+                except OSError:
+                    shutil.copyfile(source_path, temp_path)
+            os.replace(temp_path, spool_path)
+
+            job = {
+                'export_id': export_id,
+                'filename': filename,
+                'path': spool_path,
+                'cache_key': cache_key,
+                'state': 'pending',
+                'attempts': 0,
+                'created_at': time.time(),
+                'next_attempt_at': time.time(),
+                'drive': None
+            }
+            self._jobs[export_id] = job
+            self._save_journal_locked()
+
+        self._queue.put(export_id)
+        return dict(job)
+
+    def get_job(self, export_id):
+        with self._lock:
+            job = self._jobs.get(export_id)
+            return dict(job) if job is not None else None
+
+    def _worker(self):
+        while True:
+            export_id = self._queue.get()
+            with self._lock:
+                job = self._jobs.get(export_id)
+                if job is None or job['state'] != 'pending':
+                    continue
+                # Повторная постановка того же задания не запустит вторую загрузку
+                job['state'] = 'uploading'
+                path, filename = job['path'], job['filename']
+
+            if not os.path.exists(path):
+                self._finish(export_id, 'failed', error='Файл для загрузки не найден')
+                continue
+
+            drive_result = upload_to_google_drive(path, filename)
+            if drive_result:
+                self._finish(export_id, 'done', drive=drive_result)
+                continue
+
+            with self._lock:
+                job['attempts'] += 1
+                attempts = job['attempts']
+                if attempts >= self.max_attempts:
+                    job['state'] = 'failed'
+                    job['completed_at'] = time.time()
+                else:
+                    delay = min(DRIVE_UPLOAD_RETRY_MAX_SECONDS, DRIVE_UPLOAD_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+                    delay += random.uniform(0, delay / 4)
+                    job['state'] = 'pending'
+                    job['next_attempt_at'] = time.time() + delay
+                self._save_journal_locked()
+
+            if attempts >= self.max_attempts:
+                logger.error(f"Загрузка {filename} в Google Drive не удалась после {attempts} попыток")
+            else:
+                logger.warning(f"Загрузка {filename} в Google Drive не удалась, повтор через {delay:.0f}s")
+                self._schedule(export_id, delay)
+
+    def _schedule(self, export_id, delay):
+        if delay <= 0:
+            self._queue.put(export_id)
+            return
+        timer = threading.Timer(delay, self._queue.put, args=(export_id,))
+        timer.daemon = True
+        timer.start()
+
+    def _finish(self, export_id, state, drive=None, error=None):
+        with self._lock:
+            job = self._jobs.get(export_id)
+            if job is None:
+                return
+            job['state'] = state
+            job['drive'] = drive
+            job['error'] = error
+            job['completed_at'] = time.time()
+            cache_key = job.get('cache_key')
+            path = job['path']
+            self._save_journal_locked()
+
+        if state == 'done':
+            # Файл уже в drive_download_cache (жёсткая ссылка), локальная копия больше не нужна
+            if cache_key:
+                pdf_result_cache.update_meta(
+                    cache_key, storage={'backend': GoogleDriveStorage.name, 'response': drive_link_fields(drive)}
+                )
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            logger.info("Фоновая загрузка подтверждена: %s -> %s", export_id[:12], drive['drive_id'])
+
+    def _load_journal_locked(self):
+        if not os.path.exists(self.journal_path):
+            return
+        try:
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                jobs = json.load(f)
+            if isinstance(jobs, dict):
+                self._jobs = jobs
+        except Exception as e:
+            logger.error(f"Ошибка чтения журнала загрузок: {e}")
+
+    def _save_journal_locked(self):
+        """Атомарно перезаписывает журнал, заодно забывая старые завершённые задания"""
+        now = time.time()
+        for export_id, job in list(self._jobs.items()):
+            if job['state'] not in self.ACTIVE_STATES and now - job.get('completed_at', now) > DRIVE_UPLOAD_JOURNAL_RETENTION_SECONDS:
+                del self._jobs[export_id]
+                if job['state'] == 'failed' and os.path.exists(job['path']):
+                    os.remove(job['path'])
+
+        temp_path = f"{self.journal_path}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._jobs, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.journal_path)
+        except OSError as e:
+            logger.error(f"Ошибка записи журнала загрузок: {e}")
+
+    def stats(self):
+        with self._lock:
+            states = {}
+            for job in self._jobs.values():
+                states[job['state']] = states.get(job['state'], 0) + 1
+            return {'started': self._started, 'queued': self._queue.qsize(), 'jobs': states}
+
+
+drive_upload_queue = DriveUploadQueue(
+    DRIVE_UPLOAD_SPOOL_DIR, DRIVE_UPLOAD_JOURNAL_FILE, DRIVE_UPLOAD_WORKERS, DRIVE_UPLOAD_MAX_ATTEMPTS
+)
+
+
+# ========================================
+# ХРАНИЛИЩЕ ЭКСПОРТОВ
+# ========================================
+
+def drive_link_fields(drive_result):
+    """Поля ответа для файла, загруженного в Drive"""
+    drive_id = drive_result['drive_id']
+    return {
+        'download_url': f"/download_pdf/{drive_id}",  # Прокси через сервер (обходит перехват Android)
+        'direct_drive_url': drive_result['download_url'],  # Прямая ссылка Drive
+        'drive_id': drive_id,
+        'view_url': drive_result.get('view_url'),
+        'storage': 'google_drive'
+    }
+
+
+def send_export_file(path, filename, etag):
+    """Отдача файла с диска: sendfile, Range и If-None-Match делает send_file"""
+    return send_file(
+        path,
+        mimetype='application/pdf',
+        as_attachment=True,
+        download_name=filename,
+        conditional=True,
+        etag=etag
+    )
+
+
+class ExportStorage:
+    """
+    Хранилище готовых экспортов.
+
+    store() сохраняет файл и возвращает поля ответа generate_pdf
+    (download_url, storage, ...) или None при ошибке.
+    serve() отдаёт экспорт по /exports/<export_id> или None, если его нет.
+    """
+
+    name = ''
+
+    def store(self, export_id, source_path, filename, move=False, cache_key=None):
+        raise NotImplementedError
+
+    def serve(self, export_id):
+        raise NotImplementedError
+
+    def has(self, export_id):
+        return True
+
+    def stats(self):
+        return {'backend': self.name}
+
+
+class GoogleDriveStorage(ExportStorage):
+    """Google Drive: фоновая (или синхронная) загрузка, отдача через локальный кэш и прокси"""
+
+    name = 'google_drive'
+
+    def store(self, export_id, source_path, filename, move=False, cache_key=None):
+        if DRIVE_UPLOAD_ASYNC:
+            job = drive_upload_queue.enqueue(export_id, source_path, filename, cache_key=cache_key, move=move)
+            if job['state'] == 'done':
+                return drive_link_fields(job['drive'])
+            # storage остаётся 'google_drive': приложение откроет download_url,
+            # который отдаёт локальную копию, а после загрузки - файл из Drive
+            return {
+                'download_url': f"/exports/{export_id}",
+                'status_url': f"/exports/{export_id}/status",
+                'export_id': export_id,
+                'upload_state': job['state'],
+                'storage': 'google_drive'
+            }
+
+        drive_result = upload_to_google_drive(source_path, filename)
+        if not drive_result:
+            return None
+        if move:
+            os.remove(source_path)
+        return drive_link_fields(drive_result)
+
+    def serve(self, export_id):
+        job = drive_upload_queue.get_job(export_id)
+        if job is None:
+            return None
+        if job['state'] == 'done':
+            return redirect(f"/download_pdf/{job['drive']['drive_id']}")
+        if not os.path.exists(job['path']):
+            return None
+        return send_export_file(job['path'], job['filename'], export_id)
+
+    def stats(self):
+        return {'backend': self.name, 'uploads': drive_upload_queue.stats(), 'cache': drive_download_cache.stats()}
+
+
+class LocalFsStorage(ExportStorage):
+    """
+    Папка на сервере. Файлы раскладываются по подкаталогам по первым
+    символам хэша (ab/cd/<export_id>.pdf), рядом - JSON с именем файла.
+
+    Фоновый поток удаляет экспорты старше max_age_seconds, а при
+    превышении квоты - самые старые, пока папка не уложится в max_bytes.
+    """
+
+    name = 'local'
+
+    # Недописанные .tmp (например, после падения процесса) удаляются через час
+    STALE_TEMP_SECONDS = 3600
+
+    def __init__(self, root_dir, max_bytes=0, max_age_seconds=0, reap_interval_seconds=600):
+        self.root_dir = root_dir
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.reap_interval_seconds = reap_interval_seconds
+        self._lock = threading.Lock()
+        self._usage_bytes = 0
+        self._exports_count = 0
+        self._reaped_files = 0
+        self._reaped_bytes = 0
+        self._reaper_started = False
+
+    def _base_path(self, export_id):
+        shard = hashlib.sha256(export_id.encode('utf-8')).hexdigest()
+        return os.path.join(self.root_dir, shard[:2], shard[2:4], export_id)
+
+    def store(self, export_id, source_path, filename, move=False, cache_key=None):
+        self.start_reaper()
+        base_path = self._base_path(export_id)
+        temp_path = f"{base_path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(base_path), exist_ok=True)
+            if move:
+                shutil.move(source_path, temp_path)
+            else:
+                try:
+                    os.link(source_path, temp_path)
+                except OSError:
+                    shutil.copyfile(source_path, temp_path)
+            os.replace(temp_path, f"{base_path}.pdf")
+            with open(f"{base_path}.json", 'w', encoding='utf-8') as f:
+                json.dump({'filename': filename, 'created_at': time.time()}, f, ensure_ascii=False)
+        except OSError as e:
+            logger.error(f"Ошибка сохранения экспорта {export_id}: {e}")
+            return None
+
+        with self._lock:
+            self._usage_bytes += os.path.getsize(f"{base_path}.pdf")
+            self._exports_count += 1
+            over_quota = self.max_bytes and self._usage_bytes > self.max_bytes
+        if over_quota:
+            self.reap(keep=base_path)
+
+        return {
+            'download_url': f"/exports/{export_id}",
+            'export_id': export_id,
+            'storage': self.name
+        }
+
+    def serve(self, export_id):
+        self.start_reaper()
+        base_path = self._base_path(export_id)
+        if not os.path.exists(f"{base_path}.pdf"):
+            return None
+        filename = f"{export_id[:16]}.pdf"
+        try:
+            with open(f"{base_path}.json", 'r', encoding='utf-8') as f:
+                filename = json.load(f).get('filename', filename)
+        except (OSError, ValueError):
+            pass
+        return send_export_file(f"{base_path}.pdf", filename, export_id)
+
+    def has(self, export_id):
+        return os.path.exists(f"{self._base_path(export_id)}.pdf")
+
+    def start_reaper(self):
+        if self._reaper_started:
+            return
+        with self._lock:
+            if self._reaper_started:
+                return
+            self._reaper_started = True
+        threading.Thread(target=self._reaper_loop, name='export-reaper', daemon=True).start()
+
+    def _reaper_loop(self):
+        while True:
+            try:
+                self.reap()
+            except Exception as e:
+                logger.error(f"Ошибка очистки {self.root_dir}: {e}")
+            time.sleep(self.reap_interval_seconds)
+
+    def reap(self, keep=None):
+        """
+        Удаляет устаревшие экспорты и самые старые при превышении квоты.
+        keep - базовый путь только что сохранённого экспорта, его не трогаем.
+        """
+        now = time.time()
+        exports = {}  # базовый путь -> [mtime, размер, [(путь, mtime)]]
+        temp_bytes = 0
+        for dirpath, _, filenames in os.walk(self.root_dir):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if name.endswith('.tmp'):
+                    if now - stat.st_mtime > self.STALE_TEMP_SECONDS:
+                        try:
+                            os.remove(path)
+                            continue
+                        except OSError:
+                            pass
+                    temp_bytes += stat.st_size
+                    continue
+                base_path, ext = os.path.splitext(path)
+                if ext not in ('.pdf', '.json'):
+                    continue
+                item = exports.setdefault(base_path, [0, 0, []])
+                item[0] = max(item[0], stat.st_mtime)
+                item[1] += stat.st_size
+                item[2].append((path, stat.st_mtime))
+
+        ordered = sorted(exports.items(), key=lambda kv: kv[1][0])
+        usage = temp_bytes + sum(item[1] for _, item in ordered)
+        remaining = len(ordered)
+        reaped_files = 0
+        reaped_bytes = 0
+        for base_path, (mtime, size, files) in ordered:
+            expired = self.max_age_seconds and now - mtime > self.max_age_seconds
+            over_quota = self.max_bytes and usage > self.max_bytes
+            if not expired and not over_quota:
+                break
+            if base_path == keep:
+                continue
+            removed = False
+            for path, file_mtime in files:
+                try:
+                    # Экспорт могли перезаписать после сканирования - не удаляем
+                    if os.stat(path).st_mtime != file_mtime:
+                        continue
+                    os.remove(path)
+                    removed = True
+                except OSError:
+                    continue
+            if not removed:
+                continue
+            usage -= size
+            remaining -= 1
+            reaped_files += 1
+            reaped_bytes += size
+
+        with self._lock:
+            self._usage_bytes = usage
+            self._exports_count = remaining
+            self._reaped_files += reaped_files
+            self._reaped_bytes += reaped_bytes
+
+        if reaped_files:
+            logger.info(f"Очистка {self.root_dir}: удалено {reaped_files} экспортов, {reaped_bytes} байт")
+
+    def stats(self):
+        self.start_reaper()
+        with self._lock:
+            return {
+                'backend': self.name,
+                'root': self.root_dir,
+                'exports': self._exports_count,
+                'bytes': self._usage_bytes,
+                'max_bytes': self.max_bytes,
+                'max_age_seconds': self.max_age_seconds,
+                'reaped_exports': self._reaped_files,
+                'reaped_bytes': self._reaped_bytes
+            }
+
+
+class S3Storage(ExportStorage):
+    """
+    S3-совместимое хранилище (AWS S3, MinIO и т.п.).
+    S3_ENDPOINT_URL позволяет направить клиент на локальный сервер.
+    Скачивание идёт через сервер потоком (с Range) или редиректом на
+    подписанную ссылку, если S3_PRESIGNED_REDIRECT=1.
+    """
+
+    name = 's3'
+
+    def __init__(self, bucket, prefix, endpoint_url=None, region=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self.region = region
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    def _get_client(self):
+        # Клиент boto3 потокобезопасен - один на процесс
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = boto3.client(
+                        's3',
+                        endpoint_url=self.endpoint_url,
+                        region_name=self.region,
+                        config=botocore_config.Config(retries={'max_attempts': 3, 'mode': 'standard'})
+                    )
+        return self._client
+
+    def _key(self, export_id):
+        return f"{self.prefix}{export_id[:2]}/{export_id}.pdf"
+
+    def store(self, export_id, source_path, filename, move=False, cache_key=None):
+        try:
+            self._get_client().upload_file(
+                source_path,
+                self.bucket,
+                self._key(export_id),
+                ExtraArgs={
+                    'ContentType': 'application/pdf',
+                    'ContentDisposition': f'attachment; filename="{filename}"'
+                }
+            )
+        except Exception as e:
+            logger.error(f"Ошибка загрузки экспорта в S3: {e}")
+            return None
+
+        if move:
+            os.remove(source_path)
+        return {
+            'download_url': f"/exports/{export_id}",
+            'export_id': export_id,
+            'storage': self.name
+        }
+
+    def serve(self, export_id):
+        client = self._get_client()
+        params = {'Bucket': self.bucket, 'Key': self._key(export_id)}
+
+        if S3_PRESIGNED_REDIRECT:
+            return redirect(client.generate_presigned_url(
+                'get_object', Params=params, ExpiresIn=S3_PRESIGNED_EXPIRES_SECONDS
+            ))
+
+        range_header = request.headers.get('Range')
+        if range_header:
+            params['Range'] = range_header
+        try:
+            obj = client.get_object(**params)
+        except botocore_exceptions.ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code in ('NoSuchKey', '404'):
+                return None
+            if code == 'InvalidRange':
+                return Response(status=416, headers={'Accept-Ranges': 'bytes'})
+            raise
+
+        headers = {
+            'Content-Length': str(obj['ContentLength']),
+            'Accept-Ranges': 'bytes'
+        }
+        if obj.get('ContentDisposition'):
+            headers['Content-Disposition'] = obj['ContentDisposition']
+        if obj.get('ContentRange'):
+            headers['Content-Range'] = obj['ContentRange']
+        if obj.get('ETag'):
+            headers['ETag'] = obj['ETag']
+
+        return Response(
+            obj['Body'].iter_chunks(PDF_STREAM_CHUNK_SIZE),
+            status=206 if obj.get('ContentRange') else 200,
+            mimetype='application/pdf',
+            headers=headers,
+            direct_passthrough=True
+        )
+
+    def stats(self):
+        return {'backend': self.name, 'bucket': self.bucket, 'endpoint': self.endpoint_url}
+
+
+_export_storage = None
+_export_storage_lock = threading.Lock()
+
+
+def create_export_storage(backend):
+    """Создаёт хранилище по имени; недоступный бэкенд заменяется локальной папкой"""
+    if backend == GoogleDriveStorage.name:
+        if GOOGLE_DRIVE_AVAILABLE and subsystem_enabled('drive'):
+            return GoogleDriveStorage()
+        logger.warning("Google Drive API не доступен или отключён, экспорты хранятся локально")
+    elif backend == S3Storage.name:
+        if S3_AVAILABLE and S3_BUCKET:
+            return S3Storage(S3_BUCKET, S3_PREFIX, S3_ENDPOINT_URL, S3_REGION)
+        logger.warning("S3 не настроен (нужны boto3 и S3_BUCKET), экспорты хранятся локально")
+    elif backend != LocalFsStorage.name:
+        logger.warning(f"Неизвестное хранилище EXPORT_STORAGE={backend!r}, экспорты хранятся локально")
+    return LocalFsStorage(
+        LOCAL_EXPORT_DIR, LOCAL_EXPORT_MAX_BYTES, LOCAL_EXPORT_MAX_AGE_SECONDS, LOCAL_EXPORT_REAP_INTERVAL_SECONDS
+    )
+
+
+def get_export_storage():
+    global _export_storage
+    if _export_storage is None:
+        with _export_storage_lock:
+            if _export_storage is None:
+                _export_storage = create_export_storage(EXPORT_STORAGE)
+                logger.info(f"Хранилище экспортов: {_export_storage.name}")
+    return _export_storage
+
+
+def get_font_candidates():
+    """Наборы (обычный, жирный, курсив): сначала из .env, затем системные"""
+    font_paths = []
+
+    custom_regular = os.environ.get('PDF_FONT_REGULAR')
+    if custom_regular:
+        font_paths.append((
+            resolve_backend_path(custom_regular),
+            resolve_backend_path(os.environ.get('PDF_FONT_BOLD', custom_regular)),
+            resolve_backend_path(os.environ.get('PDF_FONT_ITALIC', custom_regular)),
+        ))
+
     # Шрифты с поддержкой кириллицы
-    font_paths = [
+    font_paths.extend([
         ("C:/Windows/Fonts/arial.ttf", "C:/Windows/Fonts/arialbd.ttf", "C:/Windows/Fonts/ariali.ttf"),
         ("C:/Windows/Fonts/times.ttf", "C:/Windows/Fonts/timesbd.ttf", "C:/Windows/Fonts/timesi.ttf"),
         ("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", "/usr/share/fonts/truetype/dejavu/DejaVuSans-Oblique.ttf"),
         ("/usr/share/fonts/truetype/dejavu/DejaVuSerif.ttf", "/usr/share/fonts/truetype/dejavu/DejaVuSerif-Bold.ttf", "/usr/share/fonts/truetype/dejavu/DejaVuSerif-Italic.ttf"),
-    ]
+    ])
+    return font_paths
 
+
+def setup_fonts():
+    """
+    Настройка шрифтов с поддержкой кириллицы.
+
+    Возвращает (обычный, жирный, курсив, путь к выбранному шрифту).
+    TTFont в reportlab встраивает в PDF только подмножество реально
+    использованных глифов, поэтому регистрация полного TTF на размер
+    документа не влияет.
+    """
     regular_font = 'Helvetica'
     bold_font = 'Helvetica-Bold'
     italic_font = 'Helvetica'
 
-    for regular, bold, italic in font_paths:
+    for regular, bold, italic in get_font_candidates():
         if os.path.exists(regular):
             try:
-                pdfmetrics.registerFont(TTFont('CustomFont', regular))
+                pdfmetrics.registerFont(ttfonts.TTFont('CustomFont', regular))
                 regular_font = 'CustomFont'
                 if os.path.exists(bold):
-                    pdfmetrics.registerFont(TTFont('CustomBold', bold))
+                    pdfmetrics.registerFont(ttfonts.TTFont('CustomBold', bold))
                     bold_font = 'CustomBold'
                 else:
-                    pdfmetrics.registerFont(TTFont('CustomBold', regular))
+                    pdfmetrics.registerFont(ttfonts.TTFont('CustomBold', regular))
                     bold_font = 'CustomBold'
                 if os.path.exists(italic):
-                    pdfmetrics.registerFont(TTFont('CustomItalic', italic))
+                    pdfmetrics.registerFont(ttfonts.TTFont('CustomItalic', italic))
                     italic_font = 'CustomItalic'
                 else:
                     italic_font = regular_font
                 logger.info(f"Загружены шрифты: {regular}")
-                break
+                return regular_font, bold_font, italic_font, regular
             except Exception as e:
                 logger.warning(f"Ошибка шрифта: {e}")
 
-    return regular_font, bold_font, italic_font
+    logger.warning("Шрифты с кириллицей не найдены, используется Helvetica")
+    return regular_font, bold_font, italic_font, None
+
+
+# Шрифты загружаются один раз при первой генерации PDF (см. ensure_pdf_fonts)
+FONT_REGULAR, FONT_BOLD, FONT_ITALIC = 'Helvetica', 'Helvetica-Bold', 'Helvetica'
+_pdf_fonts_source = None
+_pdf_fonts_loaded = False
+_pdf_fonts_lock = threading.Lock()
 
-FONT_REGULAR, FONT_BOLD, FONT_ITALIC = setup_fonts()
+
+def ensure_pdf_fonts():
+    """Регистрирует шрифты при первом обращении (потокобезопасно)"""
+    global FONT_REGULAR, FONT_BOLD, FONT_ITALIC, _pdf_fonts_source, _pdf_fonts_loaded
+
+    if _pdf_fonts_loaded:
+        return
+
+    with _pdf_fonts_lock:
+        if _pdf_fonts_loaded:
+            return
+        FONT_REGULAR, FONT_BOLD, FONT_ITALIC, _pdf_fonts_source = setup_fonts()
+        _pdf_fonts_loaded = True
+
+
+def get_pdf_fonts_info():
+    """Информация о выбранных шрифтах для /api/health"""
+    if not _pdf_fonts_loaded:
+        return {'loaded': False}
+    return {
+        'loaded': True,
+        'regular': FONT_REGULAR,
+        'bold': FONT_BOLD,
+        'italic': FONT_ITALIC,
+        'source': _pdf_fonts_source
+    }
 
 
 # ========================================
@@ -393,41 +2148,167 @@ FACE_DUPLICATE_NAME_DISTANCE = 0.42
 LEGACY_MEMBER_ID_MOD = 1_000_000
 STABLE_SERVER_MEMBER_ID_PATTERN = re.compile(r'^fo1_(\d+)_([0-9a-f]{16})$', re.IGNORECASE)
 
+@contextmanager
+def gallery_transaction():
+    """
+    Изменение базы лиц: копия текущего снимка -> правки -> публикация.
+    При исключении внутри блока снимок не меняется.
+    """
+    global _gallery_state
+    with _gallery_write_lock:
+        previous, previous_index = _gallery_state
+        draft = dict(previous)
+        yield draft
+
+        changed_ids = [member_id for member_id, info in draft.items() if previous.get(member_id) is not info]
+        changed_ids.extend(member_id for member_id in previous if member_id not in draft)
+
+        index = previous_index
+        if changed_ids:
+            with metrics.time_stage('index_build'):
+                index = previous_index.updated(draft, changed_ids)
+            # Кодировки переехали в индекс - записи черновика (ещё не
+            # опубликованные) заменяем копиями без них
+            for member_id in changed_ids:
+                info = draft.get(member_id)
+                if info is not None and 'encoding' in info:
+                    draft[member_id] = {key: value for key, value in info.items() if key != 'encoding'}
+
+        _gallery_state = (MappingProxyType(draft), index)
+        if changed_ids:
+            gallery_changelog.record(changed_ids)
+
+
+def get_gallery_snapshot():
+    """Текущий снимок базы лиц (не меняется, можно обходить без блокировок)"""
+    return _gallery_state[0]
+
+
+def get_gallery_index():
+    """Поисковый индекс текущего снимка"""
+    return _gallery_state[1]
+
+
+def get_gallery_state():
+    """Согласованная пара (снимок, индекс)"""
+    return _gallery_state
+
+
+class GalleryChangeLog:
+    """
+    Журнал изменений базы лиц для инкрементальной синхронизации.
+
+    Каждая транзакция увеличивает версию и записывает изменённые member_id.
+    Версия для клиента - "<epoch>-<номер>": epoch меняется при перезапуске,
+    поэтому старые версии распознаются и требуют полной выгрузки.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.epoch = uuid.uuid4().hex[:8]
+        self.version = 0
+        self._entries = deque()
+        self._floor = 0  # Изменения с версией <= floor могли быть вытеснены
+        self._lock = threading.Lock()
+
+    def record(self, member_ids):
+        with self._lock:
+            self.version += 1
+            for member_id in member_ids:
+                self._entries.append((self.version, member_id))
+            while len(self._entries) > self.max_entries:
+                self._floor = self._entries.popleft()[0]
+
+    def token(self, version=None):
+        return f"{self.epoch}-{self.version if version is None else version}"
+
+    def parse_token(self, token):
+        """Номер версии из токена или None, если токен чужой или некорректный"""
+        epoch, _, raw_version = str(token or '').strip().rpartition('-')
+        if epoch != self.epoch or not raw_version.isdigit():
+            return None
+        version = int(raw_version)
+        return version if version <= self.version else None
+
+    def changed_since(self, version):
+        """(текущая версия, множество member_id) или None, если журнал уже не полный"""
+        with self._lock:
+            if version < self._floor:
+                return None
+            changed = {member_id for entry_version, member_id in self._entries if entry_version > version}
+            return self.version, changed
+
+
+gallery_changelog = GalleryChangeLog(GALLERY_CHANGELOG_MAX)
+
+
+def to_stored_encoding(raw_encoding):
+    """Кодировка в формате хранения: непрерывный float32-вектор из ENCODING_SIZE чисел"""
+    return np.ascontiguousarray(raw_encoding, dtype=ENCODING_DTYPE).reshape(ENCODING_SIZE)
+
+
+def read_encodings_file():
+    """Чтение ENCODINGS_FILE в словарь member_id -> {name, encoding, image_hash}"""
+    with open(ENCODINGS_FILE, 'r') as f:
+        data = json.load(f)
+
+    parsed = {}
+    for member_id, info in data.items():
+        if not isinstance(info, dict):
+            continue
+        raw_encoding = info.get('encoding')
+        if raw_encoding is None:
+            continue
+        try:
+            parsed[str(member_id)] = {
+                'name': str(info.get('name', '')).strip(),
+                'encoding': to_stored_encoding(raw_encoding),
+                'image_hash': str(info.get('image_hash', '')).strip()
+            }
+        except Exception:
+            continue
+    return parsed
+
+
 def load_encodings():
     """Загрузка сохраненных кодировок лиц"""
-    global face_encodings_db
-    if os.path.exists(ENCODINGS_FILE):
-        try:
-            with open(ENCODINGS_FILE, 'r') as f:
-                data = json.load(f)
-                parsed = {}
-                for member_id, info in data.items():
-                    if not isinstance(info, dict):
-                        continue
-                    raw_encoding = info.get('encoding')
-                    if raw_encoding is None:
-                        continue
-                    try:
-                        parsed[str(member_id)] = {
-                            'name': str(info.get('name', '')).strip(),
-                            'encoding': np.array(raw_encoding),
-                            'image_hash': str(info.get('image_hash', '')).strip()
-                        }
-                    except Exception:
-                        continue
-                face_encodings_db = parsed
-            logger.info(f"Загружено {len(face_encodings_db)} кодировок лиц")
-        except Exception as e:
-            logger.error(f"Ошибка загрузки кодировок: {e}")
-            face_encodings_db = {}
+    try:
+        if gallery_store is not None:
+            parsed = gallery_store.load_all()
+            if not parsed and os.path.exists(ENCODINGS_FILE):
+                # Первый запуск с SQLite - переносим базу из JSON
+                parsed = read_encodings_file()
+                gallery_store.upsert_many(parsed.items())
+                # Убираем JSON, иначе после очистки SQLite база вернётся из него
+                os.replace(ENCODINGS_FILE, f"{ENCODINGS_FILE}.migrated")
+                logger.info(f"База лиц перенесена из {ENCODINGS_FILE} в {GALLERY_DB_FILE}")
+        elif os.path.exists(ENCODINGS_FILE):
+            parsed = read_encodings_file()
+        else:
+            return
+
+        with gallery_transaction() as gallery:
+            gallery.clear()
+            gallery.update(parsed)
+        logger.info(f"Загружено {len(parsed)} кодировок лиц")
+    except Exception as e:
+        logger.error(f"Ошибка загрузки кодировок: {e}")
+        with gallery_transaction() as gallery:
+            gallery.clear()
 
 
+@metrics.timed('persistence')
 def save_encodings():
-    """Сохранение кодировок лиц"""
+    """
+    Сохранение кодировок лиц.
+    Пишет во временный файл и атомарно подменяет ENCODINGS_FILE,
+    поэтому при сбое на диске остаётся либо старая, либо новая версия.
+    """
     try:
         data = {}
-        for member_id, info in face_encodings_db.items():
-            encoding = info.get('encoding')
+        gallery, index = get_gallery_state()
+        for member_id, info in gallery.items():
+            encoding = index.encoding_of(member_id)
             if encoding is None:
                 continue
             data[str(member_id)] = {
@@ -435,11 +2316,281 @@ def save_encodings():
                 'encoding': encoding.tolist(),
                 'image_hash': str(info.get('image_hash', '')).strip()
             }
-        with open(ENCODINGS_FILE, 'w') as f:
+        temp_path = f"{ENCODINGS_FILE}.tmp"
+        with open(temp_path, 'w') as f:
             json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, ENCODINGS_FILE)
         logger.info("Кодировки сохранены")
+        return True
     except Exception as e:
         logger.error(f"Ошибка сохранения кодировок: {e}")
+        return False
+
+
+class GalleryPersister:
+    """
+    Отложенная запись базы лиц (write-behind).
+
+    Изменения только помечают базу "грязной". Фоновый поток сохраняет её
+    раз в interval_seconds или сразу после max_pending изменений, так что
+    серия регистраций стоит одной записи. При остановке - финальный flush.
+    """
+
+    def __init__(self, save_func, interval_seconds, max_pending):
+        self.save_func = save_func
+        self.interval_seconds = interval_seconds
+        self.max_pending = max_pending
+        self.flushes = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._started = False
+
+    def mark_dirty(self):
+        self._start()
+        with self._lock:
+            self._pending += 1
+            pending = self._pending
+        if pending >= self.max_pending:
+            self._wakeup.set()
+
+    def flush(self):
+        """Сохраняет базу, если есть несохранённые изменения"""
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = 0
+            if not pending:
+                return
+            if self.save_func():
+                self.flushes += 1
+            else:
+                # Не получилось - повторим в следующий раз
+                with self._lock:
+                    self._pending += pending
+
+    def _start(self):
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._loop, name='gallery-persister', daemon=True).start()
+        atexit.register(self.flush)
+
+    def _loop(self):
+        while True:
+            self._wakeup.wait(self.interval_seconds)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка отложенного сохранения кодировок: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {'pending_changes': self._pending, 'flushes': self.flushes}
+
+
+gallery_persister = GalleryPersister(save_encodings, GALLERY_FLUSH_INTERVAL_SECONDS, GALLERY_FLUSH_MAX_PENDING)
+
+
+class SqliteGalleryStore:
+    """
+    База лиц в SQLite.
+
+    Кодировки хранятся BLOB (float32; старые записи - float64, читаются
+    как есть и переписываются при следующем сохранении), метаданные - в
+    индексированных колонках, поэтому выборка по устройству, поиск
+    дубликатов и удаление не требуют обхода всей базы. Соединение - своё
+    в каждом потоке.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS faces (
+                    member_id TEXT PRIMARY KEY,
+                    device_id TEXT NOT NULL DEFAULT '',
+                    name TEXT NOT NULL DEFAULT '',
+                    name_norm TEXT NOT NULL DEFAULT '',
+                    image_hash TEXT NOT NULL DEFAULT '',
+                    encoding BLOB NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS faces_device_idx ON faces (device_id, member_id);
+                CREATE INDEX IF NOT EXISTS faces_name_idx ON faces (name_norm);
+                CREATE INDEX IF NOT EXISTS faces_hash_idx ON faces (image_hash);
+            ''')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _decode_encoding(blob):
+        legacy = len(blob) == ENCODING_SIZE * np.dtype(np.float64).itemsize
+        return to_stored_encoding(np.frombuffer(blob, dtype=np.float64 if legacy else ENCODING_DTYPE))
+
+    def _row_to_info(self, row):
+        return {
+            'name': row[1],
+            'encoding': self._decode_encoding(row[3]),
+            'image_hash': row[2]
+        }
+
+    def load_all(self):
+        rows = self._connect().execute(
+            'SELECT member_id, name, image_hash, encoding FROM faces'
+        ).fetchall()
+        return {row[0]: self._row_to_info(row) for row in rows}
+
+    @metrics.timed('persistence')
+    def upsert_many(self, items):
+        now = time.time()
+        rows = [
+            (
+                str(member_id),
+                get_device_id_from_member_id(member_id),
+                str(info.get('name', '')).strip(),
+                normalize_member_name(info.get('name', '')),
+                str(info.get('image_hash', '')).strip(),
+                to_stored_encoding(info['encoding']).tobytes(),
+                now
+            )
+            for member_id, info in items
+        ]
+        with self._connect() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO faces '
+                '(member_id, device_id, name, name_norm, image_hash, encoding, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                rows
+            )
+
+    def upsert(self, member_id, info):
+        self.upsert_many([(member_id, info)])
+
+    def delete_members(self, member_ids):
+        """Удаляет записи одной транзакцией, возвращает число удалённых"""
+        with self._connect() as conn:
+            cursor = conn.executemany(
+                'DELETE FROM faces WHERE member_id = ?',
+                [(str(member_id),) for member_id in member_ids]
+            )
+            return cursor.rowcount
+
+    def delete_device(self, device_id):
+        """Удаляет все записи устройства, возвращает их member_id"""
+        with self._connect() as conn:
+            member_ids = [
+                row[0] for row in conn.execute(
+                    'SELECT member_id FROM faces WHERE device_id = ?', (device_id,)
+                )
+            ]
+            conn.execute('DELETE FROM faces WHERE device_id = ?', (device_id,))
+        return member_ids
+
+    def clear(self):
+        with self._connect() as conn:
+            return conn.execute('DELETE FROM faces').rowcount
+
+    def get_encodings(self, member_ids):
+        """member_id -> float-кодировка (точный пересчёт кандидатов поиска)"""
+        if not member_ids:
+            return {}
+        placeholders = ','.join('?' * len(member_ids))
+        rows = self._connect().execute(
+            f'SELECT member_id, encoding FROM faces WHERE member_id IN ({placeholders})',
+            [str(member_id) for member_id in member_ids]
+        ).fetchall()
+        return {row[0]: self._decode_encoding(row[1]) for row in rows}
+
+    def find_duplicate_candidates(self, member_id, image_hash, normalized_name):
+        """Записи с тем же хэшем фото или тем же именем (кроме самого member_id)"""
+        rows = self._connect().execute(
+            'SELECT member_id, name, image_hash, encoding FROM faces '
+            'WHERE member_id != ? AND ((? != \'\' AND image_hash = ?) OR (? != \'\' AND name_norm = ?))',
+            (member_id, image_hash, image_hash, normalized_name, normalized_name)
+        ).fetchall()
+        return [(row[0], self._row_to_info(row)) for row in rows]
+
+    def list_members(self, device_id=None, after=None, limit=None):
+        """
+        Метаданные без кодировок, по возрастанию member_id.
+        after - последний member_id предыдущей страницы.
+        """
+        query = 'SELECT member_id, name FROM faces'
+        conditions, params = [], []
+        if device_id:
+            conditions.append('device_id = ?')
+            params.append(device_id)
+        if after:
+            conditions.append('member_id > ?')
+            params.append(after)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY member_id'
+        if limit:
+            query += ' LIMIT ?'
+            params.append(int(limit))
+        return self._connect().execute(query, params).fetchall()
+
+    def stats(self):
+        count = self._connect().execute('SELECT COUNT(*) FROM faces').fetchone()[0]
+        return {'backend': 'sqlite', 'path': self.path, 'members': count}
+
+
+def create_gallery_store(backend):
+    """Хранилище базы лиц по имени бэкенда (None - JSON-файл)"""
+    if backend == 'sqlite':
+        try:
+            return SqliteGalleryStore(GALLERY_DB_FILE)
+        except Exception as e:
+            logger.error(f"SQLite-база лиц недоступна, используем {ENCODINGS_FILE}: {e}")
+    elif backend != 'json':
+        logger.warning(f"Неизвестный GALLERY_BACKEND={backend}, используем json")
+    return None
+
+
+gallery_store = create_gallery_store(GALLERY_BACKEND) if subsystem_enabled('face') else None
+
+# int8 без SQLite негде взять точные кодировки для пересчёта кандидатов
+GALLERY_QUANTIZED = GALLERY_QUANTIZATION == 'int8' and gallery_store is not None
+if subsystem_enabled('face'):
+    if GALLERY_QUANTIZATION == 'int8' and not GALLERY_QUANTIZED:
+        logger.warning("GALLERY_QUANTIZATION=int8 требует GALLERY_BACKEND=sqlite, используем float32")
+    elif GALLERY_QUANTIZATION not in ('none', 'int8'):
+        logger.warning(f"Неизвестный GALLERY_QUANTIZATION={GALLERY_QUANTIZATION}, используем float32")
+
+
+def mark_gallery_changed():
+    """JSON-база пишется отложенно, SQLite уже записана в транзакции"""
+    if gallery_store is None:
+        gallery_persister.mark_dirty()
+
+
+def get_gallery_storage_info():
+    if gallery_store is not None:
+        info = gallery_store.stats()
+    else:
+        info = {'backend': 'json', 'path': ENCODINGS_FILE, **gallery_persister.stats()}
+    info['index'] = get_gallery_index().stats()
+    return info
 
 
 def normalize_member_name(name):
@@ -484,24 +2635,273 @@ def get_device_id_from_member_id(raw_member_id):
     return ''
 
 
-def get_known_faces_for_device_scope(device_id):
+def get_known_faces_for_device_scope(device_id, gallery=None):
+    if gallery is None:
+        gallery = get_gallery_snapshot()
+
     normalized_device_id = normalize_device_id(device_id)
     if not normalized_device_id:
-        return list(face_encodings_db.items())
+        return list(gallery.items())
 
     scoped_faces = []
-    for known_member_id, info in face_encodings_db.items():
+    for known_member_id, info in gallery.items():
         member_device_id = get_device_id_from_member_id(known_member_id)
         if member_device_id and member_device_id == normalized_device_id:
             scoped_faces.append((known_member_id, info))
     return scoped_faces
 
 
-def find_existing_face_duplicate(member_id, member_name, image_hash, face_encoding):
+# Отсортированные member_id для постраничной выдачи - пересчёт только при смене снимка
+_gallery_sorted_ids = (None, [])
+
+
+def get_sorted_member_ids(gallery):
+    global _gallery_sorted_ids
+    cached_gallery, member_ids = _gallery_sorted_ids
+    if cached_gallery is not gallery:
+        member_ids = sorted(gallery)
+        _gallery_sorted_ids = (gallery, member_ids)
+    return member_ids
+
+
+class GalleryIndex:
+    """
+    Поисковый индекс базы лиц - единственное место, где в памяти лежат кодировки.
+
+    Одна непрерывная матрица (строка на участника): float32 или int8 с
+    масштабом на строку. Индекс не меняется после создания: транзакция базы
+    строит новый через updated() - неизменённые строки копируются блоком,
+    кодируются только добавленные и изменённые. Копирование матрицы - O(N)
+    на каждую запись (memcpy, порядка 10 мс на 100k строк float32).
+    Грубый поиск - скалярные произведения по блокам матрицы, лучшие
+    кандидаты пересчитываются точно во float64.
+    """
+
+    def __init__(self, member_ids, names, device_ids, matrix, scales, norms, quantized=False, float_source=None, rows_by_id=None):
+        self.member_ids = member_ids
+        self.names = names
+        self.device_ids = device_ids  # device_id строки ('' - без устройства)
+        self.matrix = matrix
+        self.scales = scales
+        self.norms = norms  # Квадраты норм строк: |x - p|^2 = |x|^2 - 2 x.p + |p|^2
+        self.quantized = quantized
+        self.float_source = float_source  # member_ids -> {member_id: float-кодировка}
+        if rows_by_id is None:
+            rows_by_id = dict(zip(member_ids, range(len(member_ids))))
+        self.rows_by_id = rows_by_id
+        self.matrix.flags.writeable = False
+
+    @classmethod
+    def empty(cls, quantized=False, float_source=None):
+        return cls(
+            [], [], np.array([], dtype=str),
+            np.empty((0, ENCODING_SIZE), dtype=np.int8 if quantized else ENCODING_DTYPE),
+            np.ones(0, dtype=ENCODING_DTYPE), np.empty(0, dtype=ENCODING_DTYPE),
+            quantized, float_source
+        )
+
+    @classmethod
+    def build(cls, gallery, quantized=False, float_source=None):
+        """Индекс по записям с кодировками: member_id -> {name, encoding, ...}"""
+        return cls.empty(quantized, float_source).updated(gallery, list(gallery))
+
+    def _encode(self, vectors):
+        """float-векторы -> (строки матрицы, масштабы, квадраты норм)"""
+        vectors = np.asarray(vectors, dtype=ENCODING_DTYPE).reshape(-1, ENCODING_SIZE)
+        if not self.quantized:
+            return vectors, np.ones(len(vectors), dtype=ENCODING_DTYPE), np.einsum('ij,ij->i', vectors, vectors)
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        rows = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+        restored = rows.astype(ENCODING_DTYPE) * scales[:, None]
+        return rows, scales.astype(ENCODING_DTYPE), np.einsum('ij,ij->i', restored, restored)
+
+    def updated(self, gallery, changed_ids):
+        """
+        Новый индекс после изменения базы: gallery - новое содержимое,
+        changed_ids - добавленные, изменённые и удалённые member_id.
+        Запись без encoding сохраняет кодировку из текущего индекса.
+        """
+        dropped_rows = [self.rows_by_id[member_id] for member_id in changed_ids if member_id in self.rows_by_id]
+        added_ids, vectors = [], []
+        for member_id in changed_ids:
+            info = gallery.get(member_id)
+            if info is None:
+                continue
+            encoding = info.get('encoding')
+            if encoding is None:
+                encoding = self.encoding_of(member_id)
+            if encoding is None:
+                logger.warning(f"Нет кодировки для {member_id}, запись не попадёт в поиск")
+                continue
+            added_ids.append(member_id)
+            vectors.append(encoding)
+
+        if dropped_rows:
+            keep = np.ones(len(self), dtype=bool)
+            keep[dropped_rows] = False
+            kept_rows = np.flatnonzero(keep)
+            member_ids = [self.member_ids[row] for row in kept_rows]
+            names = [self.names[row] for row in kept_rows]
+            device_ids, matrix = self.device_ids[keep], self.matrix[keep]
+            scales, norms = self.scales[keep], self.norms[keep]
+            rows_by_id = None
+        else:
+            # Только добавления - номера старых строк не сдвигаются
+            member_ids, names = list(self.member_ids), list(self.names)
+            device_ids, matrix, scales, norms = self.device_ids, self.matrix, self.scales, self.norms
+            rows_by_id = dict(self.rows_by_id)
+            rows_by_id.update(zip(added_ids, range(len(member_ids), len(member_ids) + len(added_ids))))
+
+        new_rows, new_scales, new_norms = self._encode(vectors)
+        new_device_ids = np.array([get_device_id_from_member_id(member_id) for member_id in added_ids], dtype=str)
+        return GalleryIndex(
+            member_ids + added_ids,
+            names + [gallery[member_id]['name'] for member_id in added_ids],
+            np.concatenate([device_ids, new_device_ids]),
+            np.concatenate([matrix, new_rows]),
+            np.concatenate([scales, new_scales]),
+            np.concatenate([norms, new_norms]),
+            self.quantized,
+            self.float_source,
+            rows_by_id
+        )
+
+    def __len__(self):
+        return len(self.member_ids)
+
+    def encoding_of(self, member_id):
+        """Кодировка участника (в int8 - восстановленная из квантованной), None если нет"""
+        row = self.rows_by_id.get(member_id)
+        if row is None:
+            return None
+        if not self.quantized:
+            return self.matrix[row]
+        return self.matrix[row].astype(ENCODING_DTYPE) * self.scales[row]
+
+    def scope_rows(self, device_id):
+        """Строки участников устройства (None - вся база)"""
+        if not device_id:
+            return None
+        return np.flatnonzero(self.device_ids == device_id)
+
+    def _blocks(self, rows):
+        """(срез результата, блок строк матрицы) по GALLERY_INDEX_CHUNK_ROWS"""
+        total = len(self) if rows is None else len(rows)
+        for start in range(0, total, GALLERY_INDEX_CHUNK_ROWS):
+            stop = min(total, start + GALLERY_INDEX_CHUNK_ROWS)
+            block = self.matrix[start:stop] if rows is None else self.matrix[rows[start:stop]]
+            yield slice(start, stop), block
+
+    def _coarse_distances(self, probe, rows):
+        """Приближённые квадраты расстояний до probe для строк rows"""
+        dots = np.empty(len(self) if rows is None else len(rows), dtype=ENCODING_DTYPE)
+        for out, block in self._blocks(rows):
+            dots[out] = np.asarray(block, dtype=ENCODING_DTYPE) @ probe
+        if rows is None:
+            scales, norms = self.scales, self.norms
+        else:
+            scales, norms = self.scales[rows], self.norms[rows]
+        return norms - 2 * scales * dots + probe @ probe
+
+    def _exact_distances(self, rows, encoding):
+        encoding = np.asarray(encoding, dtype=np.float64)
+        if not self.quantized:
+            vectors = self.matrix[rows].astype(np.float64)
+        else:
+            member_ids = [self.member_ids[row] for row in rows]
+            exact = self.float_source(member_ids) if self.float_source is not None else {}
+            # Запись могли удалить из хранилища после сборки - берём восстановленную из int8
+            vectors = np.array([
+                exact[member_id] if member_id in exact else self.matrix[row] * self.scales[row]
+                for member_id, row in zip(member_ids, rows)
+            ], dtype=np.float64)
+        return np.linalg.norm(vectors - encoding, axis=1)
+
+    def nearest(self, encoding, rows=None):
+        """(строка, расстояние) ближайшего участника среди rows, None если искать не в ком"""
+        count = len(self) if rows is None else len(rows)
+        if count == 0:
+            return None
+        probe = to_stored_encoding(encoding)
+        coarse = self._coarse_distances(probe, rows)
+
+        top = min(GALLERY_RESCORE_TOP, count)
+        candidates = np.argpartition(coarse, top - 1)[:top] if top < count else np.arange(count)
+        candidate_rows = candidates if rows is None else rows[candidates]
+
+        distances = self._exact_distances(candidate_rows, encoding)
+        best = int(np.argmin(distances))
+        return int(candidate_rows[best]), float(distances[best])
+
+    def stats(self):
+        return {
+            'members': len(self),
+            'dtype': str(self.matrix.dtype),
+            'matrix_bytes': int(self.matrix.nbytes + self.scales.nbytes + self.norms.nbytes)
+        }
+
+
+# Начальное состояние: пустая база и пустой индекс
+_gallery_state = (
+    MappingProxyType({}),
+    GalleryIndex.empty(GALLERY_QUANTIZED, gallery_store.get_encodings if GALLERY_QUANTIZED else None)
+)
+
+
+def list_gallery_members(device_id=None, after=None, limit=None):
+    """
+    Страница (member_id, name) по возрастанию member_id.
+    Возвращает (строки, есть ли продолжение).
+    """
+    fetch_limit = limit + 1 if limit else None
+    if gallery_store is not None:
+        rows = gallery_store.list_members(device_id, after, fetch_limit)
+    else:
+        gallery = get_gallery_snapshot()
+        member_ids = get_sorted_member_ids(gallery)
+        start = bisect.bisect_right(member_ids, after) if after else 0
+        rows = []
+        for member_id in member_ids[start:]:
+            if device_id and get_device_id_from_member_id(member_id) != device_id:
+                continue
+            rows.append((member_id, gallery[member_id]['name']))
+            if fetch_limit and len(rows) >= fetch_limit:
+                break
+
+    has_more = bool(limit) and len(rows) > limit
+    return (rows[:limit] if limit else rows), has_more
+
+
+def encode_list_cursor(member_id):
+    return base64.urlsafe_b64encode(str(member_id).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_list_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    return base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8')
+
+
+def find_existing_face_duplicate(member_id, member_name, image_hash, face_encoding, gallery=None, index=None):
+    """
+    gallery - снимок или черновик транзакции, index - индекс снимка, на котором
+    он основан (по умолчанию текущий: под _gallery_write_lock это он и есть).
+    """
+    if gallery is None:
+        gallery, index = get_gallery_state()
+    elif index is None:
+        index = get_gallery_index()
+
     normalized_name = normalize_member_name(member_name)
     member_id = str(member_id).strip()
 
-    for existing_member_id, info in face_encodings_db.items():
+    if gallery_store is not None:
+        # Кандидаты по индексам хэша и имени вместо обхода всей базы
+        candidates = gallery_store.find_duplicate_candidates(member_id, image_hash, normalized_name)
+    else:
+        candidates = gallery.items()
+
+    for existing_member_id, info in candidates:
         existing_member_id = str(existing_member_id).strip()
         if existing_member_id == member_id:
             continue
@@ -521,7 +2921,11 @@ def find_existing_face_duplicate(member_id, member_name, image_hash, face_encodi
         if existing_name != normalized_name:
             continue
 
+        # Кодировка есть у кандидатов из SQLite и у новых записей черновика,
+        # у опубликованных записей - только в индексе
         existing_encoding = info.get('encoding')
+        if existing_encoding is None:
+            existing_encoding = index.encoding_of(existing_member_id)
         if existing_encoding is None:
             continue
 
@@ -541,6 +2945,36 @@ def find_existing_face_duplicate(member_id, member_name, image_hash, face_encodi
     return None
 
 
+@metrics.timed('index_search')
+def match_face_encodings(index, rows, face_encodings, face_locations, threshold):
+    """
+    Сопоставляет лица с фото с известными лицами.
+    index - GalleryIndex снимка, rows - строки области поиска (None - вся база),
+    результат - совпадения с confidence и location.
+    """
+    results = []
+    for face_encoding, face_location in zip(face_encodings, face_locations):
+        # Ближайшее известное лицо
+        nearest = index.nearest(face_encoding, rows)
+        if nearest is None:
+            continue
+
+        best_row, distance = nearest
+        if distance <= threshold:
+            results.append({
+                'member_id': str(index.member_ids[best_row]),
+                'member_name': index.names[best_row],
+                'confidence': float(1 - distance),
+                'location': {
+                    'top': face_location[0],
+                    'right': face_location[1],
+                    'bottom': face_location[2],
+                    'left': face_location[3]
+                }
+            })
+    return results
+
+
 def get_image_hash(image_array):
     """Получает хэш изображения для кэширования"""
     return hash(image_array.tobytes())
@@ -560,7 +2994,7 @@ def optimize_image_for_gpu(image):
         pil_image = Image.fromarray(image)
         pil_image = pil_image.resize((new_width, new_height), Image.LANCZOS)
         image = np.array(pil_image)
-        logger.info(f"Изображение оптимизировано: {width}x{height} → {new_width}x{new_height}")
+        logger.info("Изображение оптимизировано: %sx%s → %sx%s", width, height, new_width, new_height)
 
     return image
 
@@ -571,21 +3005,24 @@ def detect_faces_optimized(image):
     img_hash = get_image_hash(image)
     if img_hash in face_detection_cache:
         logger.info("Использован кэш для обнаружения лиц")
+        metrics.inc('cache_requests_total', 'Обращения к кэшам', cache='face_detection', result='hit')
         return face_detection_cache[img_hash]
+    metrics.inc('cache_requests_total', 'Обращения к кэшам', cache='face_detection', result='miss')
 
     # Оптимизируем изображение
     optimized_image = optimize_image_for_gpu(image)
 
     # Обнаруживаем лица
-    start_time = time.time()
+    start_time = time.perf_counter()
     face_locations = face_recognition.face_locations(
         optimized_image,
         model=FACE_MODEL,
         number_of_times_to_upsample=NUMBER_OF_TIMES_TO_UPSAMPLE
     )
-    detection_time = time.time() - start_time
+    detection_time = time.perf_counter() - start_time
+    metrics.observe('face_detection', detection_time)
 
-    logger.info(f"Обнаружение лиц: {detection_time:.3f}s, найдено: {len(face_locations)}")
+    logger.info("Обнаружение лиц: %.3fs, найдено: %s", detection_time, len(face_locations))
 
     # Сохраняем в кэш
     if len(face_detection_cache) >= CACHE_MAX_SIZE:
@@ -604,7 +3041,10 @@ def decode_base64_image(base64_string):
         if ',' in base64_string:
             base64_string = base64_string.split(',')[1]
 
-        image_data = base64.b64decode(base64_string)
+        with metrics.time_stage('base64_decode'):
+            image_data = base64.b64decode(base64_string)
+
+        decode_started = time.perf_counter()
         image = Image.open(io.BytesIO(image_data))
 
         # Исправляем ориентацию по EXIF (Android камеры часто сохраняют повёрнутые фото)
@@ -625,14 +3065,296 @@ def decode_base64_image(base64_string):
             new_width = int(width * ratio)
             new_height = int(height * ratio)
             image = image.resize((new_width, new_height), Image.LANCZOS)
-            logger.info(f"Изображение уменьшено с {width}x{height} до {new_width}x{new_height}")
+            logger.info("Изображение уменьшено с %sx%s до %sx%s", width, height, new_width, new_height)
 
-        return np.array(image)
+        image_array = np.array(image)
+        metrics.observe('image_decode', time.perf_counter() - decode_started)
+        return image_array
     except Exception as e:
         logger.error(f"Ошибка декодирования изображения: {e}")
         return None
 
 
+def get_reference_photo_scope_dir(device_id):
+    return os.path.join(REFERENCE_PHOTOS_DIR, device_id or REFERENCE_PHOTO_SHARED_SCOPE)
+
+
+def get_reference_photo_path(member_id):
+    """Путь эталонного фото: папка устройства и подпапка по хэшу member_id"""
+    member_id = str(member_id)
+    shard = hashlib.sha1(member_id.encode('utf-8')).hexdigest()[:2]
+    scope_dir = get_reference_photo_scope_dir(get_device_id_from_member_id(member_id))
+    return os.path.join(scope_dir, shard, f"{member_id}.jpg")
+
+
+def get_legacy_reference_photo_path(member_id):
+    """Старая плоская раскладка (до разбиения по папкам)"""
+    return os.path.join(REFERENCE_PHOTOS_DIR, f"{member_id}.jpg")
+
+
+def crop_face_for_reference(image, face_location):
+    """Вырезает лицо с полями и уменьшает до REFERENCE_PHOTO_MAX_SIZE"""
+    top, right, bottom, left = face_location
+    height, width = image.shape[:2]
+    margin_y = int((bottom - top) * REFERENCE_PHOTO_MARGIN)
+    margin_x = int((right - left) * REFERENCE_PHOTO_MARGIN)
+
+    face_image = image[
+        max(0, top - margin_y):min(height, bottom + margin_y),
+        max(0, left - margin_x):min(width, right + margin_x)
+    ]
+    return face_image.copy()
+
+
+def _write_reference_photo(member_id, face_image):
+    try:
+        photo_path = get_reference_photo_path(member_id)
+        os.makedirs(os.path.dirname(photo_path), exist_ok=True)
+
+        pil_image = Image.fromarray(face_image)
+        pil_image.thumbnail((REFERENCE_PHOTO_MAX_SIZE, REFERENCE_PHOTO_MAX_SIZE), Image.LANCZOS)
+        temp_path = f"{photo_path}.tmp"
+        pil_image.save(temp_path, 'JPEG', quality=REFERENCE_PHOTO_QUALITY, optimize=True)
+        os.replace(temp_path, photo_path)
+
+        legacy_path = get_legacy_reference_photo_path(member_id)
+        if os.path.exists(legacy_path):
+            os.remove(legacy_path)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения эталонного фото {member_id}: {e}")
+
+
+def _remove_reference_photos(member_ids):
+    for member_id in member_ids:
+        for photo_path in (get_reference_photo_path(member_id), get_legacy_reference_photo_path(member_id)):
+            try:
+                os.remove(photo_path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Не удалось удалить эталонное фото {photo_path}: {e}")
+
+
+def _remove_reference_photo_dirs(scope_dir, legacy_member_ids):
+    shutil.rmtree(scope_dir, ignore_errors=True)
+    _remove_reference_photos(legacy_member_ids)
+
+
+def save_reference_photo_async(member_id, image, face_location):
+    """Сохраняет эталонное фото (лицо) в фоне, не задерживая ответ"""
+    face_image = crop_face_for_reference(image, face_location)
+    reference_photo_executor.submit(_write_reference_photo, str(member_id), face_image)
+
+
+def delete_reference_photos_async(member_ids):
+    reference_photo_executor.submit(_remove_reference_photos, [str(m) for m in member_ids])
+
+
+def delete_device_reference_photos_async(device_id, member_ids):
+    """Все фото устройства - удалением одной папки (плюс файлы старой раскладки)"""
+    legacy_ids = [str(m) for m in member_ids if os.path.exists(get_legacy_reference_photo_path(m))]
+    reference_photo_executor.submit(_remove_reference_photo_dirs, get_reference_photo_scope_dir(device_id), legacy_ids)
+
+
+def clear_reference_photos_async():
+    def clear():
+        shutil.rmtree(REFERENCE_PHOTOS_DIR, ignore_errors=True)
+        os.makedirs(REFERENCE_PHOTOS_DIR, exist_ok=True)
+    reference_photo_executor.submit(clear)
+
+
+
+# ========================================
+# КОНТРОЛЬ НАГРУЗКИ
+# ========================================
+# Тяжёлые роуты: не больше max_concurrent запросов в работе и max_queue
+# в ожидании (не дольше ADMISSION_QUEUE_TIMEOUT_SECONDS). Остальным - сразу
+# 503 с Retry-After, чтобы задержка не росла до таймаута Cloudflare Tunnel.
+ADMISSION_LIMITS = {
+    'register_face': (env_int('REGISTER_FACE_MAX_CONCURRENT', 2), env_int('REGISTER_FACE_MAX_QUEUE', 4)),
+    'recognize_face': (env_int('RECOGNIZE_FACE_MAX_CONCURRENT', 2), env_int('RECOGNIZE_FACE_MAX_QUEUE', 8)),
+    'generate_pdf': (env_int('GENERATE_PDF_MAX_CONCURRENT', 3), env_int('GENERATE_PDF_MAX_QUEUE', 8)),
+}
+ADMISSION_QUEUE_TIMEOUT_SECONDS = env_int('ADMISSION_QUEUE_TIMEOUT_SECONDS', 15)
+ADMISSION_RETRY_AFTER_SECONDS = 2
+
+# Лимит на устройство (token bucket): в среднем N запросов в минуту к тяжёлым
+# роутам, но не больше BURST подряд. 0 - без ограничения
+DEVICE_RATE_LIMIT_PER_MINUTE = env_int('DEVICE_RATE_LIMIT_PER_MINUTE', 120)
+DEVICE_RATE_LIMIT_BURST = env_int('DEVICE_RATE_LIMIT_BURST', 30)
+DEVICE_RATE_LIMIT_MAX_KEYS = 10000
+
+
+class AdmissionGate:
+    """Ограничение одновременных запросов к роуту с ограниченной очередью ожидания"""
+
+    def __init__(self, name, max_concurrent, max_queue, queue_timeout):
+        self.name = name
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """True - можно выполнять запрос (обязателен release), False - отказ"""
+        with self._condition:
+            if self.active < self.max_concurrent:
+                self.active += 1
+                self.admitted += 1
+                return True
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                return False
+
+            self.waiting += 1
+            try:
+                deadline = time.monotonic() + self.queue_timeout
+                while self.active >= self.max_concurrent:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timed_out += 1
+                        return False
+                    self._condition.wait(remaining)
+                self.active += 1
+                self.admitted += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def stats(self):
+        with self._condition:
+            return {
+                'active': self.active,
+                'waiting': self.waiting,
+                'max_concurrent': self.max_concurrent,
+                'max_queue': self.max_queue,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out
+            }
+
+
+class DeviceRateLimiter:
+    """Token bucket на каждое устройство (давно неактивные вытесняются)"""
+
+    def __init__(self, rate_per_minute, burst, max_keys):
+        self.rate_per_second = rate_per_minute / 60
+        self.burst = max(1, burst)
+        self.max_keys = max_keys
+        self.limited = 0
+        self._buckets = OrderedDict()  # key -> (токены, время обновления)
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.rate_per_second > 0
+
+    def check(self, key):
+        """0 - запрос разрешён, иначе через сколько секунд появится токен"""
+        if not self.enabled:
+            return 0
+
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate_per_second)
+            if tokens >= 1:
+                tokens -= 1
+                retry_after = 0
+            else:
+                retry_after = (1 - tokens) / self.rate_per_second
+                self.limited += 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'per_minute': self.rate_per_second * 60,
+                'burst': self.burst,
+                'tracked': len(self._buckets),
+                'limited': self.limited
+            }
+
+
+admission_gates = {
+    name: AdmissionGate(name, max_concurrent, max_queue, ADMISSION_QUEUE_TIMEOUT_SECONDS)
+    for name, (max_concurrent, max_queue) in ADMISSION_LIMITS.items()
+}
+device_rate_limiter = DeviceRateLimiter(DEVICE_RATE_LIMIT_PER_MINUTE, DEVICE_RATE_LIMIT_BURST, DEVICE_RATE_LIMIT_MAX_KEYS)
+
+
+def get_request_rate_limit_key():
+    """Ключ лимита: device_id из запроса или member_id, иначе IP клиента"""
+    data = request.get_json(silent=True) if request.is_json else None
+    if not isinstance(data, dict):
+        data = {}
+
+    device_id = normalize_device_id(
+        request.args.get('device_id') or data.get('device_id') or request.headers.get('X-Device-Id')
+    )
+    if not device_id:
+        device_id = get_device_id_from_member_id(data.get('member_id'))
+    if not device_id:
+        members = data.get('members')
+        if isinstance(members, list) and members and isinstance(members[0], dict):
+            device_id = get_device_id_from_member_id(members[0].get('id'))
+    if device_id:
+        return f"device:{device_id}"
+
+    client_ip = request.headers.get('CF-Connecting-IP')
+    if not client_ip:
+        client_ip = request.access_route[0] if request.access_route else request.remote_addr
+    return f"ip:{client_ip}"
+
+
+def make_overload_response(error, status, retry_after):
+    response = make_response_json({'success': False, 'error': error}, status)
+    response.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+    return response
+
+
+def admission_controlled(gate_name):
+    """Лимит на устройство, затем место в пуле роута; иначе 429/503 с Retry-After"""
+    gate = admission_gates[gate_name]
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            retry_after = device_rate_limiter.check(get_request_rate_limit_key())
+            if retry_after:
+                return make_overload_response('Слишком много запросов, повторите позже', 429, retry_after)
+
+            if not gate.acquire():
+                logger.warning(f"Перегрузка {gate_name}: запрос отклонён")
+                return make_overload_response('Сервер перегружен, повторите запрос позже', 503, ADMISSION_RETRY_AFTER_SECONDS)
+            try:
+                return view(*args, **kwargs)
+            finally:
+                gate.release()
+        return wrapper
+    return decorator
+
+
+def get_admission_info():
+    return {
+        'gates': {name: gate.stats() for name, gate in admission_gates.items()},
+        'device_rate_limit': device_rate_limiter.stats()
+    }
+
 
 # ========================================
 # ОБЩИЕ РОУТЫ
@@ -645,18 +3367,101 @@ def health_check():
     return make_response_json({
         'status': 'ok',
         'service': 'combined_server',
-        'face_recognition': True,
-        'pdf_generation': True,
-        'members_count': len(face_encodings_db)
+        'role': SERVICE_ROLE,
+        'face_recognition': subsystem_enabled('face'),
+        'pdf_generation': subsystem_enabled('pdf'),
+        'subsystems': get_subsystems_info(),
+        'admission': get_admission_info(),
+        'members_count': len(get_gallery_snapshot()),
+        'gallery_persistence': get_gallery_storage_info(),
+        'pdf_cache': pdf_result_cache.stats() if subsystem_enabled('pdf') else None,
+        'export_storage': get_export_storage().stats() if subsystem_enabled('pdf') else None,
+        'temp_dir': scratch_area.stats(),
+        'pdf_fonts': get_pdf_fonts_info()
     })
 
 
+def is_metrics_request_allowed():
+    if METRICS_TOKEN:
+        token = request.headers.get('Authorization', '')
+        return hmac.compare_digest(token.encode('utf-8'), f'Bearer {METRICS_TOKEN}'.encode('utf-8'))
+    # Через ngrok, туннель или router запрос тоже приходит с 127.0.0.1,
+    # но с заголовком прокси - такие без токена не пускаем
+    if request.remote_addr not in LOOPBACK_ADDRESSES:
+        return False
+    return not any(header in request.headers for header in PROXY_HEADERS)
+
+
+@app.route('/api/metrics', methods=['GET'])
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Метрики в формате Prometheus (с Bearer-токеном или локально без токена)"""
+    if not is_metrics_request_allowed():
+        return make_response_json({'success': False, 'error': 'Требуется авторизация'}, 401)
+
+    body = metrics.render().encode('utf-8')
+    return Response(
+        body,
+        mimetype='text/plain; version=0.0.4; charset=utf-8',
+        headers={'Content-Length': str(len(body))}
+    )
+
+
+@app.route('/api/admin/profile', methods=['GET', 'POST'])
+def profile_threads():
+    """
+    Профиль всех потоков за seconds секунд (по умолчанию 10).
+    interval_ms - период сэмплирования, idle=1 - не отбрасывать ожидающие потоки.
+    """
+    if not is_admin_request():
+        return make_response_json({'success': False, 'error': 'Не найдено'}, 404)
+
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        interval_ms = float(request.args.get('interval_ms', PROFILER_DEFAULT_INTERVAL_MS))
+    except ValueError:
+        return make_response_json({'success': False, 'error': 'Некорректные параметры'}, 400)
+    # float() принимает nan и inf - их, как и неположительные значения, отклоняем
+    if not (math.isfinite(seconds) and math.isfinite(interval_ms)) or seconds <= 0 or interval_ms <= 0:
+        return make_response_json({'success': False, 'error': 'Некорректные параметры'}, 400)
+    seconds = min(seconds, PROFILER_MAX_SECONDS)
+    interval_ms = max(interval_ms, 1)
+
+    if not _thread_profile_lock.acquire(blocking=False):
+        return make_response_json({'success': False, 'error': 'Профилирование уже идёт'}, 409)
+    try:
+        sampler = StackSampler(interval_ms / 1000, include_idle=request.args.get('idle') == '1')
+        sampler.start()
+        time.sleep(seconds)
+        sampler.stop()
+    finally:
+        _thread_profile_lock.release()
+
+    logger.info("Профиль потоков: %.1f с, %s сэмплов", sampler.duration, sampler.samples)
+    return make_profile_response(sampler.collapsed(), f"profile-{int(time.time())}")
+
+
+@app.route('/api/admin/profiles/<profile_id>', methods=['GET'])
+def get_request_profile(profile_id):
+    """Профиль отдельного запроса (X-Profile-Id из его ответа)"""
+    if not is_admin_request():
+        return make_response_json({'success': False, 'error': 'Не найдено'}, 404)
+
+    with _request_profiles_lock:
+        collapsed = request_profiles.get(profile_id)
+    if collapsed is None:
+        return make_response_json({'success': False, 'error': 'Профиль не найден'}, 404)
+    return make_profile_response(collapsed, f"request-{profile_id}")
+
+
 # ========================================
 # FACE RECOGNITION - Роуты
 # ========================================
 
 @app.route('/api/register_face', methods=['POST'])
 @app.route('/register_face', methods=['POST'])
+@requires_subsystem('face')
+@admission_controlled('register_face')
 def register_face():
     """
     Регистрация эталонного фото члена семьи
@@ -702,7 +3507,8 @@ def register_face():
             }, 400)
 
         # Получаем кодировку лица (num_jitters для точности)
-        face_encodings = face_recognition.face_encodings(image, face_locations, num_jitters=NUM_JITTERS)
+        with metrics.time_stage('face_encoding'):
+            face_encodings = face_recognition.face_encodings(image, face_locations, num_jitters=NUM_JITTERS)
 
         if len(face_encodings) == 0:
             return make_response_json({
@@ -711,12 +3517,28 @@ def register_face():
             }, 400)
 
         image_hash = get_face_image_sha256(image)
-        duplicate = find_existing_face_duplicate(
-            member_id=member_id,
-            member_name=member_name,
-            image_hash=image_hash,
-            face_encoding=face_encodings[0]
-        )
+
+        # Проверка на дубликат и запись - одной транзакцией,
+        # чтобы параллельная регистрация того же лица не проскочила
+        with gallery_transaction() as gallery:
+            with metrics.time_stage('duplicate_check'):
+                duplicate = find_existing_face_duplicate(
+                    member_id=member_id,
+                    member_name=member_name,
+                    image_hash=image_hash,
+                    face_encoding=face_encodings[0],
+                    gallery=gallery
+                )
+            if duplicate is None:
+                # Сохраняем кодировку
+                gallery[member_id] = {
+                    'name': member_name,
+                    'encoding': to_stored_encoding(face_encodings[0]),
+                    'image_hash': image_hash
+                }
+                if gallery_store is not None:
+                    gallery_store.upsert(member_id, gallery[member_id])
+
         if duplicate is not None:
             logger.info(
                 "Дубликат регистрации лица отклонен: requested_id=%s, existing_id=%s, reason=%s",
@@ -732,21 +3554,13 @@ def register_face():
                 'duplicate_reason': duplicate['reason']
             })
 
-        # Сохраняем кодировку
-        face_encodings_db[member_id] = {
-            'name': member_name,
-            'encoding': face_encodings[0],
-            'image_hash': image_hash
-        }
-
-        # Сохраняем эталонное фото
-        photo_path = os.path.join(REFERENCE_PHOTOS_DIR, f"{member_id}.jpg")
-        Image.fromarray(image).save(photo_path)
+        # Сохраняем эталонное фото (в фоне)
+        save_reference_photo_async(member_id, image, face_locations[0])
 
-        # Сохраняем в файл
-        save_encodings()
+        # Сохраняем в файл (отложенно)
+        mark_gallery_changed()
 
-        logger.info(f"Зарегистрировано лицо для {member_name} (ID: {member_id})")
+        logger.info("Зарегистрировано лицо для %s (ID: %s)", member_name, member_id)
 
         return make_response_json({
             'success': True,
@@ -764,6 +3578,8 @@ def register_face():
 
 @app.route('/api/recognize_face', methods=['POST'])
 @app.route('/recognize_face', methods=['POST'])
+@requires_subsystem('face')
+@admission_controlled('recognize_face')
 def recognize_face():
     """
     Распознавание лица на фото
@@ -792,7 +3608,9 @@ def recognize_face():
                 'error': 'Некорректный device_id'
             }, 400)
 
-        if len(face_encodings_db) == 0:
+        # Один снимок базы и его индекс на весь запрос
+        gallery, index = get_gallery_state()
+        if len(gallery) == 0:
             return make_response_json({
                 'success': False,
                 'error': 'Нет зарегистрированных лиц'
@@ -816,14 +3634,13 @@ def recognize_face():
             }, 400)
 
         # Получаем кодировки всех лиц на фото
-        face_encodings = face_recognition.face_encodings(image, face_locations, num_jitters=NUM_JITTERS)
+        with metrics.time_stage('face_encoding'):
+            face_encodings = face_recognition.face_encodings(image, face_locations, num_jitters=NUM_JITTERS)
 
-        # Результаты распознавания
-        results = []
-
-        # Получаем известные кодировки (с учетом scope по устройству, если передан device_id)
-        known_faces = get_known_faces_for_device_scope(device_id)
-        if len(known_faces) == 0:
+        # Область поиска (с учетом scope по устройству, если передан device_id)
+        scope_rows = index.scope_rows(device_id)
+        known_count = len(index) if scope_rows is None else len(scope_rows)
+        if known_count == 0:
             return make_response_json({
                 'success': False,
                 'error': 'Нет зарегистрированных лиц для текущего пользователя'
@@ -833,46 +3650,12 @@ def recognize_face():
             logger.info(
                 "Распознавание с ограничением device_id=%s: %s лиц из %s",
                 device_id,
-                len(known_faces),
-                len(face_encodings_db)
+                known_count,
+                len(gallery)
             )
 
-        known_encodings = [info['encoding'] for _, info in known_faces]
-        known_ids = [str(member_id) for member_id, _ in known_faces]
-        known_names = [info['name'] for _, info in known_faces]
-
         # Проверяем каждое лицо на фото
-        for face_encoding, face_location in zip(face_encodings, face_locations):
-            # Сравниваем с известными лицами
-            matches = face_recognition.compare_faces(
-                known_encodings,
-                face_encoding,
-                tolerance=threshold
-            )
-
-            # Вычисляем расстояния
-            face_distances = face_recognition.face_distance(known_encodings, face_encoding)
-
-            if True in matches:
-                # Находим лучшее совпадение
-                best_match_index = np.argmin(face_distances)
-
-                if matches[best_match_index]:
-                    member_id = known_ids[best_match_index]
-                    member_name = known_names[best_match_index]
-                    confidence = 1 - face_distances[best_match_index]
-
-                    results.append({
-                        'member_id': member_id,
-                        'member_name': member_name,
-                        'confidence': float(confidence),
-                        'location': {
-                            'top': face_location[0],
-                            'right': face_location[1],
-                            'bottom': face_location[2],
-                            'left': face_location[3]
-                        }
-                    })
+        results = match_face_encodings(index, scope_rows, face_encodings, face_locations, threshold)
 
         if len(results) == 0:
             return make_response_json({
@@ -881,7 +3664,7 @@ def recognize_face():
                 'faces_found': len(face_locations)
             })
 
-        logger.info(f"Распознано {len(results)} лиц")
+        logger.info("Распознано %s лиц", len(results))
 
         return make_response_json({
             'success': True,
@@ -900,27 +3683,29 @@ def recognize_face():
 
 @app.route('/api/delete_face/<member_id>', methods=['DELETE'])
 @app.route('/delete_face/<member_id>', methods=['DELETE'])
+@requires_subsystem('face')
 def delete_face(member_id):
     """Удаление эталонного фото члена семьи"""
     try:
-        if str(member_id) not in face_encodings_db:
+        # Удаляем из базы
+        with gallery_transaction() as gallery:
+            found = gallery.pop(str(member_id), None) is not None
+            if found and gallery_store is not None:
+                gallery_store.delete_members([member_id])
+
+        if not found:
             return make_response_json({
                 'success': False,
                 'error': 'Член семьи не найден'
             }, 404)
 
-        # Удаляем из базы
-        del face_encodings_db[str(member_id)]
-
         # Удаляем файл фото
-        photo_path = os.path.join(REFERENCE_PHOTOS_DIR, f"{member_id}.jpg")
-        if os.path.exists(photo_path):
-            os.remove(photo_path)
+        delete_reference_photos_async([member_id])
 
-        # Сохраняем изменения
-        save_encodings()
+        # Сохраняем изменения (отложенно)
+        mark_gallery_changed()
 
-        logger.info(f"Удалено лицо для ID: {member_id}")
+        logger.info("Удалено лицо для ID: %s", member_id)
 
         return make_response_json({
             'success': True,
@@ -935,23 +3720,70 @@ def delete_face(member_id):
         }, 500)
 
 
-@app.route('/api/list_faces', methods=['GET'])
-@app.route('/list_faces', methods=['GET'])
-def list_faces():
-    """Получение списка зарегистрированных лиц"""
-    try:
+@app.route('/api/list_faces', methods=['GET'])
+@app.route('/list_faces', methods=['GET'])
+@requires_subsystem('face')
+def list_faces():
+    """
+    Получение списка зарегистрированных лиц
+
+    Параметры (все необязательные, без них - весь список):
+    - device_id: только лица устройства
+    - limit, cursor: постраничная выдача (cursor - next_cursor прошлой страницы)
+    - since: gallery_version прошлой синхронизации - вернуть только
+      добавленные (added) и удалённые (deleted) с тех пор лица
+    """
+    try:
+        raw_device_id = request.args.get('device_id')
+        device_id = normalize_device_id(raw_device_id)
+        if raw_device_id is not None and not device_id:
+            return make_response_json({
+                'success': False,
+                'error': 'Некорректный device_id'
+            }, 400)
+
+        since = request.args.get('since')
+        if since is not None:
+            return list_face_changes(since, device_id)
+
+        limit = None
+        raw_limit = request.args.get('limit')
+        if raw_limit is not None:
+            if not raw_limit.isdigit() or int(raw_limit) == 0:
+                return make_response_json({
+                    'success': False,
+                    'error': 'Некорректный limit'
+                }, 400)
+            limit = min(int(raw_limit), LIST_FACES_MAX_LIMIT)
+
+        after = None
+        cursor = request.args.get('cursor')
+        if cursor:
+            try:
+                after = decode_list_cursor(cursor)
+            except Exception:
+                return make_response_json({
+                    'success': False,
+                    'error': 'Некорректный cursor'
+                }, 400)
+
+        # Версию берём до чтения базы: изменения между ними придут в следующем since
+        gallery_version = gallery_changelog.token()
+        rows, has_more = list_gallery_members(device_id, after, limit)
         faces = [
             {
                 'member_id': member_id,
-                'member_name': info['name']
+                'member_name': name
             }
-            for member_id, info in face_encodings_db.items()
+            for member_id, name in rows
         ]
 
         return make_response_json({
             'success': True,
             'count': len(faces),
-            'faces': faces
+            'faces': faces,
+            'gallery_version': gallery_version,
+            'next_cursor': encode_list_cursor(rows[-1][0]) if has_more else None
         })
 
     except Exception as e:
@@ -962,11 +3794,45 @@ def list_faces():
         }, 500)
 
 
+def list_face_changes(since, device_id):
+    """Ответ list_faces?since=...: изменения базы после версии since"""
+    version = gallery_changelog.parse_token(since)
+    changes = gallery_changelog.changed_since(version) if version is not None else None
+    if changes is None:
+        # Журнал не покрывает since (перезапуск, переполнение) - нужна полная выгрузка
+        return make_response_json({
+            'success': True,
+            'full_resync': True,
+            'gallery_version': gallery_changelog.token()
+        })
+
+    current_version, changed_ids = changes
+    gallery = get_gallery_snapshot()
+    added, deleted = [], []
+    for member_id in sorted(changed_ids):
+        if device_id and get_device_id_from_member_id(member_id) != device_id:
+            continue
+        info = gallery.get(member_id)
+        if info is not None:
+            added.append({'member_id': member_id, 'member_name': info['name']})
+        else:
+            deleted.append(member_id)
+
+    return make_response_json({
+        'success': True,
+        'full_resync': False,
+        'gallery_version': gallery_changelog.token(current_version),
+        'count': len(added),
+        'added': added,
+        'deleted': deleted
+    })
+
+
 @app.route('/api/clear_all', methods=['DELETE'])
 @app.route('/clear_all', methods=['DELETE'])
+@requires_subsystem('face')
 def clear_all():
     """Очистка базы распознавания лиц (глобально или по device_id)"""
-    global face_encodings_db
     try:
         raw_device_id = request.args.get('device_id')
         if raw_device_id is None and request.is_json:
@@ -981,20 +3847,21 @@ def clear_all():
             }, 400)
 
         if not device_id:
-            count = len(face_encodings_db)
-
             # Очищаем базу в памяти
-            face_encodings_db = {}
-
-            # Удаляем файл кодировок
-            if os.path.exists(ENCODINGS_FILE):
-                os.remove(ENCODINGS_FILE)
+            with gallery_transaction() as gallery:
+                count = len(gallery)
+                gallery.clear()
+                if gallery_store is not None:
+                    gallery_store.clear()
+
+            # Пустая база должна записаться последней: flush() дождётся уже
+            # идущего сохранения старого снимка и перезапишет файл пустым
+            mark_gallery_changed()
+            if gallery_store is None:
+                gallery_persister.flush()
 
             # Удаляем все эталонные фото
-            for filename in os.listdir(REFERENCE_PHOTOS_DIR):
-                filepath = os.path.join(REFERENCE_PHOTOS_DIR, filename)
-                if os.path.isfile(filepath):
-                    os.remove(filepath)
+            clear_reference_photos_async()
 
             logger.info(f"База очищена глобально. Удалено {count} лиц")
 
@@ -1004,17 +3871,20 @@ def clear_all():
                 'deleted_count': count
             })
 
-        known_faces = get_known_faces_for_device_scope(device_id)
-        member_ids_to_remove = [str(member_id) for member_id, _ in known_faces]
+        with gallery_transaction() as gallery:
+            if gallery_store is not None:
+                member_ids_to_remove = gallery_store.delete_device(device_id)
+            else:
+                known_faces = get_known_faces_for_device_scope(device_id, gallery)
+                member_ids_to_remove = [str(member_id) for member_id, _ in known_faces]
+
+            for member_id in member_ids_to_remove:
+                gallery.pop(member_id, None)
 
-        for member_id in member_ids_to_remove:
-            if member_id in face_encodings_db:
-                del face_encodings_db[member_id]
-            photo_path = os.path.join(REFERENCE_PHOTOS_DIR, f"{member_id}.jpg")
-            if os.path.exists(photo_path):
-                os.remove(photo_path)
+        # Эталонные фото устройства лежат в одной папке
+        delete_device_reference_photos_async(device_id, member_ids_to_remove)
 
-        save_encodings()
+        mark_gallery_changed()
 
         deleted_count = len(member_ids_to_remove)
         logger.info(
@@ -1042,81 +3912,274 @@ def clear_all():
 # PDF GENERATION - Роуты
 # ========================================
 
+def resolve_page_size(page_format):
+    """Размер страницы по названию формата из приложения"""
+    if page_format == 'A4':
+        return pagesizes.A4
+    if page_format == 'A4_LANDSCAPE':
+        return pagesizes.landscape(pagesizes.A4)
+    if page_format == 'A3':
+        return pagesizes.A3
+    if page_format == 'A3_LANDSCAPE':
+        return pagesizes.landscape(pagesizes.A3)
+    return pagesizes.landscape(pagesizes.A4)
+
+
+@metrics.timed('pdf_render')
+def render_family_tree_pdf(output, members, pagesize, photo_quality=DEFAULT_PHOTO_QUALITY):
+    """Рисует PDF в файл (путь) или в файловый объект"""
+    ensure_pdf_fonts()
+
+    c = canvas.Canvas(output, pagesize=pagesize)
+    width, height = pagesize
+
+    draw_family_tree(c, members, width, height, photo_quality)
+
+    with metrics.time_stage('pdf_save'):
+        c.save()
+
+
+def estimate_photo_bytes(photo_quality):
+    """Примерный размер одного фото в PDF для уровня качества"""
+    tier = PHOTO_QUALITY_TIERS[photo_quality]
+    if tier is None:
+        return 0
+    if tier['format'] == 'JPEG':
+        pixels = PDF_PHOTO_SIZE / 72 * tier['dpi']
+    else:
+        pixels = PDF_PHOTO_SIZE * tier['oversample']
+    return int(pixels * pixels * tier['bytes_per_pixel'])
+
+
+def resolve_photo_quality(data, members):
+    """
+    Выбирает уровень качества фото.
+
+    show_photos=false отключает фото. Если передан target_size_kb, уровень
+    понижается, пока оценка размера PDF не уложится в заданный объём.
+    """
+    if data.get('show_photos') is False:
+        return 'none'
+
+    requested = str(data.get('photo_quality') or DEFAULT_PHOTO_QUALITY).strip().lower()
+    requested = PHOTO_QUALITY_ALIASES.get(requested, requested)
+    if requested not in PHOTO_QUALITY_TIERS:
+        requested = DEFAULT_PHOTO_QUALITY
+
+    try:
+        target_bytes = int(data.get('target_size_kb') or 0) * 1024
+    except (TypeError, ValueError):
+        target_bytes = 0
+    if target_bytes <= 0:
+        return requested
+
+    photos_count = sum(1 for member in members if member.get('photoBase64'))
+    if photos_count == 0:
+        return requested
+
+    budget = target_bytes - PDF_BASE_SIZE_ESTIMATE_BYTES
+    for photo_quality in PHOTO_QUALITY_ORDER[PHOTO_QUALITY_ORDER.index(requested):]:
+        if estimate_photo_bytes(photo_quality) * photos_count <= budget:
+            return photo_quality
+    return 'none'
+
+
+def wants_pdf_stream(data):
+    """
+    Клиент просит PDF байтами, а не JSON.
+    Включается полем delivery='stream' или заголовком Accept: application/pdf.
+    """
+    if str(data.get('delivery', '')).strip().lower() == 'stream':
+        return True
+    accept = request.accept_mimetypes
+    return accept['application/pdf'] > accept['application/json']
+
+
+def stream_pdf_response(buffer, filename, size):
+    """Отдаёт PDF из буфера кусками с явным Content-Length"""
+    buffer.seek(0)
+
+    def generate():
+        try:
+            while True:
+                chunk = buffer.read(PDF_STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            buffer.close()
+
+    return Response(
+        generate(),
+        mimetype='application/pdf',
+        headers={
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'Content-Length': str(size)
+        },
+        direct_passthrough=True
+    )
+
+
+PDF_DIGEST_MEMBER_FIELDS = (
+    'id', 'firstName', 'lastName', 'patronymic', 'birthDate', 'role', 'fatherId', 'motherId'
+)
+
+
+def compute_export_digest(members, page_format, photo_quality=DEFAULT_PHOTO_QUALITY):
+    """
+    Хэш содержимого экспорта: нормализованный список членов семьи,
+    формат страницы, качество фото, версия шаблона и дата (она печатается в футере).
+    Фото входят в хэш своим sha256, а не целиком.
+    """
+    normalized = []
+    for member in members:
+        item = {}
+        for field in PDF_DIGEST_MEMBER_FIELDS:
+            value = member.get(field)
+            item[field] = value.strip() if isinstance(value, str) else value
+        photo = member.get('photoBase64')
+        item['photo'] = hashlib.sha256(photo.encode('utf-8')).hexdigest() if photo else ''
+        normalized.append(item)
+
+    snapshot = {
+        'template': PDF_TEMPLATE_VERSION,
+        'format': page_format,
+        'photo_quality': photo_quality,
+        'date': datetime.now().strftime("%Y%m%d"),
+        'members': normalized
+    }
+    payload = json.dumps(snapshot, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def make_export_link_response(storage_fields, filename, pdf_size, cached):
+    """Ответ со ссылкой на экспорт в хранилище"""
+    response = {
+        'success': True,
+        'filename': filename,
+        'size': pdf_size,
+        'cached': cached
+    }
+    response.update(storage_fields)
+    return make_response_json(response)
+
+
 @app.route('/api/generate_pdf', methods=['POST'])
 @app.route('/generate_pdf', methods=['POST'])
+@requires_subsystem('pdf')
+@admission_controlled('generate_pdf')
 def generate_pdf():
+    filepath = None
+    pdf_file = None
     try:
         data = request.json
         members = data.get('members', [])
         page_format = data.get('format', 'A4_LANDSCAPE')
-        use_drive = data.get('use_drive', True)  # По умолчанию загружать в Drive
+        use_drive = data.get('use_drive', True)  # По умолчанию - ссылка на хранилище, а не base64
+        stream_response = wants_pdf_stream(data)
+        use_storage = use_drive and not stream_response
 
         if not members:
             return make_response_json({'success': False, 'error': 'Нет данных'}, 400)
 
-        if page_format == 'A4':
-            pagesize = A4
-        elif page_format == 'A4_LANDSCAPE':
-            pagesize = landscape(A4)
-        elif page_format == 'A3':
-            pagesize = A3
-        elif page_format == 'A3_LANDSCAPE':
-            pagesize = landscape(A3)
-        else:
-            pagesize = landscape(A4)
+        pagesize = resolve_page_size(page_format)
+        photo_quality = resolve_photo_quality(data, members)
 
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"family_tree_{timestamp}.pdf"
-        filepath = os.path.join(TEMP_DIR, filename)
 
-        c = canvas.Canvas(filepath, pagesize=pagesize)
-        width, height = pagesize
-
-        draw_family_tree(c, members, width, height)
-
-        c.save()
+        # Повторный экспорт того же дерева - берём готовый PDF из кэша
+        export_digest = compute_export_digest(members, page_format, photo_quality)
+        cached = pdf_result_cache.get(export_digest)
+        if cached is not None:
+            # Открываем сразу: параллельный put_file может вытеснить запись,
+            # а открытый файл остаётся читаемым. Уже удалённый файл - промах кэша
+            try:
+                pdf_file = open(cached[0], 'rb')
+            except FileNotFoundError:
+                cached = None
+        from_cache = cached is not None
+
+        storage = get_export_storage() if use_storage else None
+
+        cache_key = None
+        pdf_path_is_temp = False
+        if from_cache:
+            pdf_path, cache_meta = cached
+            cache_key = export_digest
+            filename = cache_meta.get('filename', filename)
+            pdf_size = os.fstat(pdf_file.fileno()).st_size
+            logger.info("PDF взят из кэша: %s", export_digest[:12])
+
+            # Этот PDF уже лежит в хранилище - отдаём прежнюю ссылку
+            stored = cache_meta.get('storage')
+            if storage and stored and stored['backend'] == storage.name and storage.has(export_digest):
+                return make_export_link_response(stored['response'], filename, pdf_size, cached=True)
+        elif pdf_result_cache.enabled or use_storage:
+            # Для кэша и для хранилища нужен файл на диске. Кэш получает жёсткую
+            # ссылку, запрос работает со своим файлом - вытеснение его не заденет
+            filepath = scratch_area.new_path('family_tree', '.pdf')
+            render_family_tree_pdf(filepath, members, pagesize, photo_quality)
+            if pdf_result_cache.put_file(export_digest, filepath, meta={'filename': filename}, link=True):
+                cache_key = export_digest
+            pdf_path = filepath
+            pdf_path_is_temp = True
+            pdf_size = os.path.getsize(pdf_path)
+        else:
+            pdf_path = None
 
-        # Получаем размер файла
-        pdf_size = os.path.getsize(filepath)
-        logger.info(f"PDF создан: {filename}, размер: {pdf_size} байт")
+        if pdf_path is not None:
+            logger.info("PDF готов: %s, размер: %s байт, фото: %s", filename, pdf_size, photo_quality)
+        
+        # Сохраняем в хранилище и отвечаем ссылкой
+        if storage is not None:
+            try:
+                storage_fields = storage.store(
+                    export_digest, pdf_path, filename, move=pdf_path_is_temp, cache_key=cache_key
+                )
+            except FileNotFoundError:
+                # Файл кэша вытеснен до копирования в хранилище - отдаём из открытого файла
+                storage_fields = None
+
+            if storage_fields:
+                # Ссылку на незавершённую загрузку не запоминаем - её запишет очередь загрузок
+                if cache_key and storage_fields.get('upload_state') not in DriveUploadQueue.ACTIVE_STATES:
+                    pdf_result_cache.update_meta(
+                        cache_key, storage={'backend': storage.name, 'response': storage_fields}
+                    )
+                return make_export_link_response(storage_fields, filename, pdf_size, cached=from_cache)
+
+            logger.warning(f"Хранилище {storage.name} не приняло PDF, возвращаем base64")
+
+        if pdf_file is not None:
+            buffer, pdf_file = pdf_file, None
+        elif pdf_path is not None:
+            buffer = open(pdf_path, 'rb')
+        else:
+            # Кэш выключен и хранилище не нужно - рисуем в память
+            # (большие PDF SpooledTemporaryFile сам сбросит во временный файл)
+            buffer = tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_MAX_MEMORY_BYTES)
+            render_family_tree_pdf(buffer, members, pagesize, photo_quality)
+            pdf_size = buffer.tell()
+            logger.info("PDF создан в памяти: %s, размер: %s байт", filename, pdf_size)
 
-        # Пробуем загрузить в Google Drive
-        if use_drive and GOOGLE_DRIVE_AVAILABLE:
-            drive_result = upload_to_google_drive(filepath, filename)
-            
-            if drive_result:
-                # Успешно загружено в Drive
-                drive_id = drive_result['drive_id']
-                # Прокси ссылка через наш сервер (обходит перехват Android)
-                proxy_download_url = f"/download_pdf/{drive_id}"
-                
-                return make_response_json({
-                    'success': True,
-                    'filename': filename,
-                    'download_url': proxy_download_url,  # Прокси через сервер
-                    'direct_drive_url': drive_result['download_url'],  # Прямая ссылка Drive
-                    'drive_id': drive_id,
-                    'view_url': drive_result.get('view_url'),
-                    'size': pdf_size,
-                    'storage': 'google_drive'
-                })
-            else:
-                logger.warning("Google Drive загрузка не удалась, возвращаем base64")
+        if stream_response:
+            return stream_pdf_response(buffer, filename, pdf_size)
 
         # Fallback: возвращаем как base64
-        with open(filepath, 'rb') as f:
-            pdf_data = f.read()
-
-        pdf_base64 = base64.b64encode(pdf_data).decode('utf-8')
+        with buffer:
+            buffer.seek(0)
+            pdf_base64 = base64.b64encode(buffer.read()).decode('ascii')
 
-        logger.info(f"Возвращаем PDF как base64: {len(pdf_base64)} символов")
+        logger.info("Возвращаем PDF как base64: %s символов", len(pdf_base64))
 
         return make_response_json({
             'success': True,
             'filename': filename,
             'pdf_base64': pdf_base64,
             'size': pdf_size,
-            'storage': 'base64'
+            'storage': 'base64',
+            'cached': from_cache
         })
 
     except Exception as e:
@@ -1125,15 +4188,159 @@ def generate_pdf():
         traceback.print_exc()
         return make_response_json({'success': False, 'error': str(e)}, 500)
 
+    finally:
+        # Файл кэша, не переданный в ответ, и файл задания больше не нужны
+        if pdf_file is not None:
+            pdf_file.close()
+        if filepath is not None:
+            scratch_area.release(filepath)
+
+
+@app.route('/api/exports/<export_id>', methods=['GET'])
+@app.route('/exports/<export_id>', methods=['GET'])
+@requires_subsystem('pdf')
+def download_export(export_id):
+    """Скачивание экспорта из текущего хранилища"""
+    try:
+        response = None
+        if EXPORT_ID_PATTERN.match(export_id):
+            response = get_export_storage().serve(export_id)
+        if response is None:
+            return make_response_json({'success': False, 'error': 'Экспорт не найден'}, 404)
+        return response
+
+    except Exception as e:
+        logger.error(f"Ошибка скачивания экспорта: {e}")
+        return make_response_json({'success': False, 'error': str(e)}, 500)
+
+
+@app.route('/api/exports/<export_id>/status', methods=['GET'])
+@app.route('/exports/<export_id>/status', methods=['GET'])
+@requires_subsystem('pdf')
+def export_status(export_id):
+    """Состояние экспорта (для Drive - состояние фоновой загрузки)"""
+    storage = get_export_storage()
+    job = drive_upload_queue.get_job(export_id) if storage.name == GoogleDriveStorage.name else None
+
+    if job is None:
+        if not EXPORT_ID_PATTERN.match(export_id) or storage.name == GoogleDriveStorage.name or not storage.has(export_id):
+            return make_response_json({'success': False, 'error': 'Экспорт не найден'}, 404)
+        return make_response_json({
+            'success': True,
+            'export_id': export_id,
+            'upload_state': 'done',
+            'download_url': f"/exports/{export_id}",
+            'storage': storage.name
+        })
+
+    result = {
+        'success': True,
+        'export_id': export_id,
+        'filename': job['filename'],
+        'upload_state': job['state'],
+        'attempts': job['attempts'],
+        'download_url': f"/exports/{export_id}",
+        'storage': 'local'
+    }
+    if job['state'] == 'done':
+        result.update(drive_link_fields(job['drive']))
+    return make_response_json(result)
+
+
+def parse_range_header(range_header, total_size):
+    """
+    Разбирает заголовок Range (поддерживается один диапазон байт).
+
+    Возвращает (start, end) включительно или None, если заголовка нет
+    или он не понят (тогда отдаётся весь файл).
+    ValueError - диапазон за пределами файла (ответ 416).
+    """
+    if not range_header:
+        return None
+
+    match = re.match(r'^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$', range_header)
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+
+    first, last = match.group(1), match.group(2)
+    if not first:
+        # bytes=-N - последние N байт
+        suffix_length = int(last)
+        if suffix_length == 0:
+            raise ValueError('Пустой диапазон')
+        return max(0, total_size - suffix_length), total_size - 1
+
+    start = int(first)
+    end = int(last) if last else total_size - 1
+    if start >= total_size or end < start:
+        raise ValueError('Диапазон вне файла')
+    return start, min(end, total_size - 1)
+
+
+def tee_into_drive_cache(chunks, drive_id, filename, total_size):
+    """
+    Пропускает куски клиенту и параллельно пишет их во временный файл.
+    Если файл скачан полностью - он попадает в локальный кэш.
+    """
+    temp_file = tempfile.NamedTemporaryFile(dir=DRIVE_CACHE_DIR, suffix='.part', delete=False)
+    written = 0
+    try:
+        with temp_file:
+            for chunk in chunks:
+                temp_file.write(chunk)
+                written += len(chunk)
+                yield chunk
+        if written == total_size:
+            drive_download_cache.put_file(
+                drive_id, temp_file.name, meta={'filename': filename, 'mimetype': 'application/pdf'}, move=True
+            )
+    finally:
+        if os.path.exists(temp_file.name):
+            os.remove(temp_file.name)
+
+
+def iter_drive_file_chunks(service, drive_id, start, end, chunk_size=DRIVE_PROXY_CHUNK_SIZE):
+    """
+    Скачивает файл из Drive кусками по Range-запросам и отдаёт их по мере прихода.
+    service - клиент Drive (или заглушка с тем же интерфейсом files()).
+    """
+    offset = start
+    while offset <= end:
+        chunk_end = min(offset + chunk_size - 1, end)
+        media_request = service.files().get_media(fileId=drive_id)
+        media_request.headers['Range'] = f'bytes={offset}-{chunk_end}'
+        with metrics.time_stage('drive_download'):
+            chunk = media_request.execute()
+        if not chunk:
+            break
+        yield chunk
+        offset += len(chunk)
+
 
 @app.route('/api/download_pdf/<drive_id>', methods=['GET'])
 @app.route('/download_pdf/<drive_id>', methods=['GET'])
+@requires_subsystem('drive')
 def download_pdf_proxy(drive_id):
     """
     Прокси для скачивания PDF из Google Drive.
     Файл скачивается через сервер, что обходит перехват Android приложением.
+    Сначала проверяется локальный кэш; из Drive куски сразу уходят клиенту.
+    Поддерживается Range для докачки.
     """
     try:
+        cached = drive_download_cache.get(drive_id)
+        if cached:
+            cached_path, cache_meta = cached
+            # send_file сам обрабатывает Range и If-None-Match
+            return send_file(
+                cached_path,
+                mimetype=cache_meta.get('mimetype', 'application/pdf'),
+                as_attachment=True,
+                download_name=cache_meta.get('filename', f'{drive_id}.pdf'),
+                conditional=True,
+                etag=drive_id
+            )
+
         service = get_google_drive_service()
         
         if not service:
@@ -1142,32 +4349,42 @@ def download_pdf_proxy(drive_id):
         # Получаем метаданные файла
         file_metadata = service.files().get(fileId=drive_id, fields='name, mimeType, size').execute()
         filename = file_metadata.get('name', 'download.pdf')
-        
-        # Скачиваем файл из Google Drive
-        from googleapiclient.http import MediaIoBaseDownload
-        
-        request = service.files().get_media(fileId=drive_id)
-        file_buffer = io.BytesIO()
-        downloader = MediaIoBaseDownload(file_buffer, request)
-        
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
-        
-        file_buffer.seek(0)
-        pdf_data = file_buffer.read()
-        
-        logger.info(f"Проксирование PDF: {filename}, размер: {len(pdf_data)} байт")
-        
-        # Возвращаем файл напрямую
+        total_size = int(file_metadata.get('size') or 0)
+
+        try:
+            byte_range = parse_range_header(request.headers.get('Range'), total_size)
+        except ValueError:
+            return Response(
+                status=416,
+                headers={'Content-Range': f'bytes */{total_size}', 'Accept-Ranges': 'bytes'}
+            )
+
+        headers = {
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'Accept-Ranges': 'bytes'
+        }
+        if byte_range is None:
+            status = 200
+            start, end = 0, total_size - 1
+        else:
+            status = 206
+            start, end = byte_range
+            headers['Content-Range'] = f'bytes {start}-{end}/{total_size}'
+        headers['Content-Length'] = str(end - start + 1 if total_size else 0)
+
+        logger.info("Проксирование PDF: %s, байты %s-%s из %s", filename, start, end, total_size)
+
+        chunks = iter_drive_file_chunks(service, drive_id, start, end) if total_size else iter(())
+        if status == 200 and total_size and drive_download_cache.enabled:
+            chunks = tee_into_drive_cache(chunks, drive_id, filename, total_size)
+
+        # Возвращаем файл потоком
         return Response(
-            pdf_data,
+            chunks,
+            status=status,
             mimetype='application/pdf',
-            headers={
-                'Content-Disposition': f'attachment; filename="{filename}"',
-                'Content-Length': str(len(pdf_data)),
-                'Content-Type': 'application/pdf'
-            }
+            headers=headers,
+            direct_passthrough=True
         )
         
     except Exception as e:
@@ -1177,13 +4394,11 @@ def download_pdf_proxy(drive_id):
         return make_response_json({'success': False, 'error': str(e)}, 500)
 
 
-
-
 # ========================================
 # PDF - Функции (ПОЛНЫЕ из pdf_server.py)
 # ========================================
 
-def draw_family_tree(c, members, width, height):
+def draw_family_tree(c, members, width, height, photo_quality=DEFAULT_PHOTO_QUALITY):
     """Рисует семейное древо"""
 
     # Красивый градиентный фон
@@ -1193,7 +4408,8 @@ def draw_family_tree(c, members, width, height):
     header_height = draw_header(c, width, height)
 
     # Группируем по поколениям
-    generations = group_by_generation(members)
+    with metrics.time_stage('pdf_grouping'):
+        generations = group_by_generation(members)
 
     gen_order = [
         ('grandparents', 'Бабушки и Дедушки'),
@@ -1210,6 +4426,10 @@ def draw_family_tree(c, members, width, height):
     if not active_gens:
         return
 
+    # Порядок карточек внутри поколений - меньше пересечений линий
+    with metrics.time_stage('pdf_layout'):
+        order_generations_by_barycenter(generations, [key for key, _ in active_gens], members)
+
     # Параметры
     card_width = 130
     card_height = 145
@@ -1247,7 +4467,7 @@ def draw_family_tree(c, members, width, height):
             x = start_x + i * (card_width + card_gap_x)
             y = current_y - card_height
 
-            draw_member_card(c, member, x, y, card_width, card_height)
+            draw_member_card(c, member, x, y, card_width, card_height, photo_quality)
 
             member_id = member.get('id')
             card_positions[member_id] = {
@@ -1459,7 +4679,7 @@ def draw_gen_label(c, name, width, y):
     c.drawCentredString(width / 2, y - 3, name)
 
 
-def draw_member_card(c, member, x, y, w, h):
+def draw_member_card(c, member, x, y, w, h, photo_quality=DEFAULT_PHOTO_QUALITY):
     """Карточка члена семьи в стиле старинной рамки"""
 
     # Тень
@@ -1499,14 +4719,14 @@ def draw_member_card(c, member, x, y, w, h):
     curr_y = y + h - 15
 
     # Фото (уменьшено для лучшего размещения)
-    photo_size = 45
+    photo_size = PDF_PHOTO_SIZE
     photo_x = x + (w - photo_size) / 2
     photo_y = curr_y - photo_size
 
     photo_data = member.get('photoBase64')
-    if photo_data:
+    if photo_data and PHOTO_QUALITY_TIERS.get(photo_quality):
         try:
-            draw_photo(c, photo_data, photo_x, photo_y, photo_size)
+            draw_photo(c, photo_data, photo_x, photo_y, photo_size, photo_quality)
         except Exception as e:
             logger.warning(f"Фото ошибка: {e}")
             draw_avatar(c, photo_x, photo_y, photo_size)
@@ -1551,14 +4771,16 @@ def draw_member_card(c, member, x, y, w, h):
         c.drawCentredString(x + w/2, curr_y, f"✦ {birth} ✦")
 
 
-def draw_photo(c, photo_data, x, y, size):
+@metrics.timed('photo_processing')
+def draw_photo(c, photo_data, x, y, size, photo_quality=DEFAULT_PHOTO_QUALITY):
     """Рисует круглое фото"""
+    tier = PHOTO_QUALITY_TIERS[photo_quality]
+
     if ',' in photo_data:
         photo_data = photo_data.split(',')[1]
 
     img_data = base64.b64decode(photo_data)
     img = Image.open(io.BytesIO(img_data))
-    img = img.convert('RGBA')
 
     # Делаем квадратное изображение (обрезаем по центру)
     width_img, height_img = img.size
@@ -1567,8 +4789,15 @@ def draw_photo(c, photo_data, x, y, size):
     top = (height_img - min_side) // 2
     img = img.crop((left, top, left + min_side, top + min_side))
 
+    if tier['format'] == 'JPEG':
+        draw_photo_thumbnail(c, img, x, y, size, tier)
+        return
+
+    img = img.convert('RGBA')
+
     # Масштабируем
-    img = img.resize((int(size * 3), int(size * 3)), Image.LANCZOS)
+    pixels = int(size * tier['oversample'])
+    img = img.resize((pixels, pixels), Image.LANCZOS)
 
     # Создаём круглую маску
     mask = Image.new('L', img.size, 0)
@@ -1581,26 +4810,47 @@ def draw_photo(c, photo_data, x, y, size):
     output.paste(img, (0, 0))
     output.putalpha(mask)
 
-    # Сохраняем
-    temp_path = os.path.join(TEMP_DIR, f"photo_{hash(photo_data) % 10000}.png")
-    output.save(temp_path, 'PNG')
+    draw_photo_frame(c, x, y, size)
+
+    # Рисуем фото (из памяти, без временного PNG на диске)
+    c.drawImage(reportlab_utils.ImageReader(output), x, y, size, size, mask='auto')
+
+
+def draw_photo_thumbnail(c, img, x, y, size, tier):
+    """
+    Фото как JPEG-миниатюра под печатное разрешение.
+    Круглая форма задаётся обрезкой (clip path), а не альфа-каналом.
+    """
+    pixels = max(1, int(round(size / 72 * tier['dpi'])))
+    if img.mode != 'RGB':
+        # Прозрачные области - на белый фон (в JPEG нет альфа-канала)
+        rgba = img.convert('RGBA')
+        img = Image.new('RGB', rgba.size, WHITE_RGB)
+        img.paste(rgba, mask=rgba.split()[3])
+    img = img.resize((pixels, pixels), Image.LANCZOS)
+
+    jpeg_buffer = io.BytesIO()
+    img.save(jpeg_buffer, 'JPEG', quality=tier['jpeg_quality'], optimize=True)
+    jpeg_buffer.seek(0)
+
+    draw_photo_frame(c, x, y, size)
+
+    c.saveState()
+    clip = c.beginPath()
+    clip.circle(x + size/2, y + size/2, size/2)
+    c.clipPath(clip, stroke=0, fill=0)
+    c.drawImage(reportlab_utils.ImageReader(jpeg_buffer), x, y, size, size)
+    c.restoreState()
+
 
-    # Рисуем фиолетовую рамку
+def draw_photo_frame(c, x, y, size):
+    """Фиолетовая рамка и белый фон под фото"""
     c.setFillColorRGB(*PURPLE)
     c.circle(x + size/2, y + size/2, size/2 + 3, fill=1, stroke=0)
 
-    # Белый фон под фото
     c.setFillColorRGB(*WHITE)
     c.circle(x + size/2, y + size/2, size/2, fill=1, stroke=0)
 
-    # Рисуем фото
-    c.drawImage(temp_path, x, y, size, size, mask='auto')
-
-    try:
-        os.remove(temp_path)
-    except:
-        pass
-
 
 def draw_avatar(c, x, y, size):
     """Плейсхолдер"""
@@ -1624,58 +4874,102 @@ def draw_avatar(c, x, y, size):
 
 
 def draw_connections(c, positions, members):
-    """Линии связей"""
+    """
+    Линии связей.
+
+    Дети с одинаковыми родителями соединяются общей шиной: вертикаль от
+    каждого родителя, одна горизонталь на всю семью и вертикали к детям.
+    Все линии уходят в PDF одним path-объектом, точки соединения - вторым.
+    """
+    units = collect_family_units(positions, members)
+    if not units:
+        return
+
+    lines = c.beginPath()
+    dots = c.beginPath()
+
+    for unit, bus_y in zip(units, assign_bus_lanes(units, positions)):
+        parents = [positions[parent_id] for parent_id in unit['parents']]
+        children = [positions[child_id] for child_id in unit['children']]
+
+        xs = [p['x_center'] for p in parents] + [ch['x_center'] for ch in children]
+        # Шина семьи
+        lines.moveTo(min(xs), bus_y)
+        lines.lineTo(max(xs), bus_y)
+
+        # Вертикали от родителей
+        for parent in parents:
+            lines.moveTo(parent['x_center'], parent['y_bottom'])
+            lines.lineTo(parent['x_center'], bus_y)
+
+        # Вертикали к детям
+        for child in children:
+            lines.moveTo(child['x_center'], bus_y)
+            lines.lineTo(child['x_center'], child['y_top'])
+            dots.circle(child['x_center'], child['y_top'], 4)
+
+    c.saveState()
     c.setStrokeColorRGB(*LINE_COLOR)
     c.setLineWidth(2)
+    c.setLineCap(1)
+    c.drawPath(lines, stroke=1, fill=0)
+
+    # Точки соединения
+    c.setFillColorRGB(*PURPLE)
+    c.drawPath(dots, stroke=0, fill=1)
+    c.restoreState()
 
-    drawn_pairs = set()
+
+def collect_family_units(positions, members):
+    """Группирует детей по набору родителей, присутствующих на листе"""
+    units = {}
 
     for member in members:
         member_id = member.get('id')
-        father_id = member.get('fatherId')
-        mother_id = member.get('motherId')
-
         if member_id not in positions:
             continue
 
-        child = positions[member_id]
+        parent_ids = []
+        for parent_id in (member.get('fatherId'), member.get('motherId')):
+            if parent_id and parent_id != member_id and parent_id in positions and parent_id not in parent_ids:
+                parent_ids.append(parent_id)
+        if not parent_ids:
+            continue
 
-        # К отцу
-        if father_id and father_id in positions:
-            pair = tuple(sorted([member_id, father_id]))
-            if pair not in drawn_pairs:
-                parent = positions[father_id]
-                draw_tree_line(c, parent['x_center'], parent['y_bottom'],
-                              child['x_center'], child['y_top'])
-                drawn_pairs.add(pair)
+        key = tuple(sorted(parent_ids, key=str))
+        unit = units.setdefault(key, {'parents': parent_ids, 'children': []})
+        if member_id not in unit['children']:
+            unit['children'].append(member_id)
 
-        # К матери
-        if mother_id and mother_id in positions:
-            pair = tuple(sorted([member_id, mother_id]))
-            if pair not in drawn_pairs:
-                parent = positions[mother_id]
-                draw_tree_line(c, parent['x_center'], parent['y_bottom'],
-                              child['x_center'], child['y_top'])
-                drawn_pairs.add(pair)
+    return list(units.values())
 
 
-def draw_tree_line(c, x1, y1, x2, y2):
-    """Рисует линию древа"""
-    mid_y = (y1 + y2) / 2
+def assign_bus_lanes(units, positions):
+    """
+    Вычисляет высоту шины для каждой семьи.
 
-    c.setStrokeColorRGB(*LINE_COLOR)
-    c.setLineWidth(2)
+    Семьи в одном промежутке между поколениями получают соседние "полосы",
+    чтобы шины разных семей не сливались в одну линию.
+    """
+    gaps = {}
+    for index, unit in enumerate(units):
+        parents_bottom = min(positions[p]['y_bottom'] for p in unit['parents'])
+        children_top = max(positions[ch]['y_top'] for ch in unit['children'])
+        gap_key = (round(parents_bottom, 1), round(children_top, 1))
+        gaps.setdefault(gap_key, []).append(index)
 
-    # Вертикальная от родителя
-    c.line(x1, y1, x1, mid_y)
-    # Горизонтальная
-    c.line(x1, mid_y, x2, mid_y)
-    # Вертикальная к ребёнку
-    c.line(x2, mid_y, x2, y2)
+    bus_levels = [0] * len(units)
+    for (parents_bottom, children_top), unit_indexes in gaps.items():
+        mid_y = (parents_bottom + children_top) / 2
+        lanes = len(unit_indexes)
+        lane_gap = min(BUS_LANE_GAP, abs(parents_bottom - children_top) / (lanes + 1))
 
-    # Точка соединения
-    c.setFillColorRGB(*PURPLE)
-    c.circle(x2, y2, 4, fill=1, stroke=0)
+        # Упорядочиваем полосы слева направо, чтобы вертикали не пересекали чужие шины
+        unit_indexes.sort(key=lambda i: min(positions[p]['x_center'] for p in units[i]['parents']))
+        for lane, unit_index in enumerate(unit_indexes):
+            bus_levels[unit_index] = mid_y + (lanes - 1) / 2 * lane_gap - lane * lane_gap
+
+    return bus_levels
 
 
 def draw_footer(c, width):
@@ -1794,6 +5088,84 @@ def find_couples(gen_members, all_members):
     return couples
 
 
+def build_generation_blocks(gen_members, all_members):
+    """Разбивает поколение на блоки: пары (муж+жена) остаются рядом"""
+    couples = set(find_couples(gen_members, all_members))
+    blocks = []
+    i = 0
+    while i < len(gen_members):
+        member = gen_members[i]
+        if i + 1 < len(gen_members):
+            pair = (member.get('id'), gen_members[i + 1].get('id'))
+            if pair in couples:
+                blocks.append([member, gen_members[i + 1]])
+                i += 2
+                continue
+        blocks.append([member])
+        i += 1
+    return blocks
+
+
+def order_generations_by_barycenter(generations, gen_keys, all_members, sweeps=BARYCENTER_SWEEPS):
+    """
+    Упорядочивает карточки внутри поколений эвристикой барицентров.
+
+    Проходы чередуются: сверху вниз блок ставится по среднему положению
+    родителей, снизу вверх - по среднему положению детей. Пары не разрываются.
+    """
+    if len(gen_keys) < 2:
+        return
+
+    parents_of = {}
+    children_of = {}
+    for member in all_members:
+        member_id = member.get('id')
+        for parent_id in (member.get('fatherId'), member.get('motherId')):
+            if parent_id and parent_id != member_id:
+                parents_of.setdefault(member_id, []).append(parent_id)
+                children_of.setdefault(parent_id, []).append(member_id)
+
+    blocks = {key: build_generation_blocks(generations[key], all_members) for key in gen_keys}
+
+    def slot_positions():
+        # Относительная координата X центра карточки (все карточки одной ширины)
+        slots = {}
+        for key in gen_keys:
+            flat = [m for block in blocks[key] for m in block]
+            offset = (len(flat) - 1) / 2
+            for i, member in enumerate(flat):
+                slots[member.get('id')] = i - offset
+        return slots
+
+    for sweep in range(sweeps):
+        downward = sweep % 2 == 0
+        keys = gen_keys if downward else list(reversed(gen_keys))
+        neighbours = parents_of if downward else children_of
+
+        for key in keys[1:]:
+            if len(blocks[key]) < 2:
+                continue
+            slots = slot_positions()
+            own_ids = {m.get('id') for block in blocks[key] for m in block}
+
+            def barycenter(block):
+                linked = [
+                    slots[n]
+                    for m in block
+                    for n in neighbours.get(m.get('id'), [])
+                    if n in slots and n not in own_ids
+                ]
+                if linked:
+                    return sum(linked) / len(linked)
+                # Без связей блок остаётся на месте
+                return sum(slots[m.get('id')] for m in block) / len(block)
+
+            blocks[key].sort(key=barycenter)
+
+    for key in gen_keys:
+        generations[key] = [m for block in blocks[key] for m in block]
+
+
 def get_gender_order(role):
     """Возвращает порядок: 1 - мужской, 2 - женский, 3 - другое"""
     male_roles = {'GRANDFATHER', 'FATHER', 'SON', 'BROTHER', 'UNCLE', 'NEPHEW', 'GRANDSON'}
@@ -1807,18 +5179,295 @@ def get_gender_order(role):
 
 
 # ========================================
-# MAIN
+# РОЛИ ПРОЦЕССОВ И МАРШРУТИЗАЦИЯ
 # ========================================
 
-if __name__ == '__main__':
+class WorkerRouter:
+    """
+    WSGI-приложение роли router.
+
+    По URL находит роут Flask-приложения и его подсистему (requires_subsystem)
+    и проксирует запрос в воркер этой роли (роуты без подсистемы - в воркер
+    ROUTER_DEFAULT_ROLE). У каждой роли свой лимит запросов
+    в работе (потоки воркера + очередь): всплеск экспортов не занимает потоки
+    router, нужные распознаванию, и наоборот. Сверх лимита - сразу 503.
+    """
+
+    HOP_BY_HOP_HEADERS = frozenset((
+        'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+        'te', 'trailers', 'transfer-encoding', 'upgrade'
+    ))
+    HEALTH_PATHS = ('/api/health', '/health')
+
+    def __init__(self, flask_app, workers):
+        self.flask_app = flask_app
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._in_flight = {role: 0 for role in workers}
+        self._rejected = {role: 0 for role in workers}
+
+    def resolve_role(self, path, method):
+        try:
+            endpoint, _ = self.flask_app.url_map.bind('localhost').match(path, method=method)
+        except HTTPException:
+            return None
+        view = self.flask_app.view_functions.get(endpoint)
+        return SUBSYSTEM_ROLES.get(getattr(view, 'subsystem', None), ROUTER_DEFAULT_ROLE)
+
+    @staticmethod
+    def _is_chunked(environ):
+        return not environ.get('CONTENT_LENGTH') and 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower()
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO') or '/'
+        if path in self.HEALTH_PATHS:
+            return self._health(start_response)
+
+        role = self.resolve_role(path, environ['REQUEST_METHOD'])
+        if role is None:
+            return self._json(start_response, 404, {'success': False, 'error': 'Не найдено'})
+
+        # Тело chunked можно переслать, только если сервер сам отмечает его конец
+        if self._is_chunked(environ) and not environ.get('wsgi.input_terminated'):
+            return self._json(start_response, 411, {
+                'success': False,
+                'error': 'Нужен заголовок Content-Length'
+            })
+
+        if not self._acquire(role):
+            return self._json(start_response, 503, {
+                'success': False,
+                'error': 'Сервер перегружен, повторите запрос позже'
+            }, [('Retry-After', '1')])
+
+        try:
+            return self._proxy(environ, start_response, role)
+        except Exception:
+            self._release(role)
+            raise
+
+    def _acquire(self, role):
+        config = self.workers[role]
+        with self._lock:
+            if self._in_flight[role] >= config['threads'] + config['queue']:
+                self._rejected[role] += 1
+                return False
+            self._in_flight[role] += 1
+            return True
+
+    def _release(self, role):
+        with self._lock:
+            self._in_flight[role] -= 1
+
+    def _proxy(self, environ, start_response, role):
+        url = quote(environ.get('PATH_INFO') or '/', safe="/:@!$&'()*+,;=-._~", encoding='latin-1')
+        if environ.get('QUERY_STRING'):
+            url += '?' + environ['QUERY_STRING']
+
+        headers = {
+            key[5:].replace('_', '-').title(): value
+            for key, value in environ.items()
+            if key.startswith('HTTP_') and key[5:].replace('_', '-').lower() not in self.HOP_BY_HOP_HEADERS
+        }
+        if environ.get('CONTENT_TYPE'):
+            headers['Content-Type'] = environ['CONTENT_TYPE']
+        body = None
+        if environ.get('CONTENT_LENGTH'):
+            headers['Content-Length'] = environ['CONTENT_LENGTH']
+            body = environ['wsgi.input']
+        elif self._is_chunked(environ):
+            # Без Content-Length http.client сам отправит тело воркеру chunked
+            body = self._iter_body(environ['wsgi.input'])
+        headers['X-Forwarded-For'] = environ.get('REMOTE_ADDR', '')
+        headers['X-Forwarded-Proto'] = environ.get('wsgi.url_scheme', 'http')
+
+        connection = http.client.HTTPConnection('127.0.0.1', self.workers[role]['port'], timeout=ROUTER_PROXY_TIMEOUT)
+        try:
+            connection.request(environ['REQUEST_METHOD'], url, body=body, headers=headers)
+            upstream = connection.getresponse()
+        except OSError as e:
+            connection.close()
+            self._release(role)
+            logger.error(f"Воркер {role} недоступен: {e}")
+            return self._json(start_response, 502, {
+                'success': False,
+                'error': 'Сервис временно недоступен'
+            }, [('Retry-After', str(WORKER_RESTART_DELAY_SECONDS))])
+
+        response_headers = [
+            (name, value) for name, value in upstream.getheaders()
+            if name.lower() not in self.HOP_BY_HOP_HEADERS
+        ]
+        start_response(f"{upstream.status} {upstream.reason}", response_headers)
+        return self._stream(upstream, connection, role)
+
+    @staticmethod
+    def _iter_body(stream):
+        while True:
+            chunk = stream.read(ROUTER_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def _stream(self, upstream, connection, role):
+        # Слот освобождается, когда ответ дочитан или клиент отключился
+        try:
+            while True:
+                chunk = upstream.read(ROUTER_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            connection.close()
+            self._release(role)
+
+    def _health(self, start_response):
+        workers = {}
+        for role, config in self.workers.items():
+            connection = http.client.HTTPConnection('127.0.0.1', config['port'], timeout=3)
+            try:
+                connection.request('GET', '/api/health')
+                workers[role] = json.loads(connection.getresponse().read().decode('utf-8'))
+            except Exception as e:
+                workers[role] = {'status': 'unavailable', 'error': str(e)}
+            finally:
+                connection.close()
+            with self._lock:
+                workers[role]['router'] = {
+                    'in_flight': self._in_flight[role],
+                    'limit': config['threads'] + config['queue'],
+                    'rejected': self._rejected[role]
+                }
+
+        statuses = [worker.get('status') for worker in workers.values()]
+        return self._json(start_response, 200 if 'ok' in statuses else 503, {
+            'status': 'ok' if all(status == 'ok' for status in statuses) else 'degraded',
+            'service': 'combined_server',
+            'role': 'router',
+            'workers': workers
+        })
+
+    def _json(self, start_response, status, payload, extra_headers=()):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        start_response(f"{status} {HTTPStatus(status).phrase}", [
+            ('Content-Type', 'application/json; charset=utf-8'),
+            ('Content-Length', str(len(body))),
+            *extra_headers
+        ])
+        return [body]
+
+
+class WorkerProcess:
+    """Процесс-воркер роли router: запуск, перезапуск после падения, остановка"""
+
+    def __init__(self, role, port):
+        self.role = role
+        self.port = port
+        self.restarts = 0
+        self._process = None
+        self._stopping = False
+        # Проверка _stopping и запуск процесса - одна операция для stop()
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._supervise, name=f'worker-{self.role}', daemon=True).start()
+
+    def _supervise(self):
+        env = dict(
+            os.environ,
+            SERVICE_ROLE=self.role,
+            SERVICE_SUBSYSTEMS=','.join(ROLE_SUBSYSTEMS[self.role]),
+            API_HOST='127.0.0.1',
+            API_PORT=str(self.port)
+        )
+        while True:
+            with self._lock:
+                if self._stopping:
+                    break
+                self._process = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+            logger.info(f"Воркер {self.role} запущен (pid={self._process.pid}, порт {self.port})")
+            return_code = self._process.wait()
+            if self._stopping:
+                break
+            self.restarts += 1
+            logger.error(f"Воркер {self.role} завершился с кодом {return_code}, перезапуск")
+            time.sleep(WORKER_RESTART_DELAY_SECONDS)
+
+    def stop(self):
+        with self._lock:
+            self._stopping = True
+            process = self._process
+        if process is None or process.poll() is not None:
+            return
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def run_router():
+    """Роль router: воркеры face и pdf в отдельных процессах + маршрутизатор"""
+    workers = [WorkerProcess(role, config['port']) for role, config in WORKER_CONFIG.items()]
+    for worker in workers:
+        worker.start()
+
+    def stop_workers():
+        for worker in workers:
+            worker.stop()
+
+    atexit.register(stop_workers)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    router = WorkerRouter(app, WORKER_CONFIG)
+    logger.info("=" * 50)
+    logger.info(f"Router запущен на {API_HOST}:{API_PORT}")
+    for role, config in WORKER_CONFIG.items():
+        logger.info(f"Воркер {role}: порт {config['port']}, потоков {config['threads']}, очередь {config['queue']}")
+    logger.info("=" * 50)
+
+    try:
+        from waitress import serve
+        serve(router, host=API_HOST, port=API_PORT, threads=ROUTER_THREADS)
+    except ImportError:
+        from werkzeug.serving import run_simple
+        logger.warning("Waitress не установлен, используем werkzeug dev-server")
+        run_simple(API_HOST, API_PORT, router, threaded=True)
+
+
+def run_worker():
+    """Роли combined, face и pdf: Flask-приложение в своём пуле потоков"""
+    if SERVICE_ROLE == 'combined':
+        # Запрос в очереди admission_controlled занимает поток waitress -
+        # потоков должно хватать и на очереди, и на лёгкие роуты
+        admission_threads = sum(max_concurrent + max_queue for max_concurrent, max_queue in ADMISSION_LIMITS.values())
+        threads = max(COMBINED_THREADS, admission_threads + 4)
+    else:
+        threads = WORKER_CONFIG[SERVICE_ROLE]['threads']
+
     # Загружаем сохраненные кодировки при запуске
-    load_encodings()
+    if subsystem_enabled('face'):
+        load_encodings()
+
+    # SIGTERM -> обычный выход, чтобы сработал финальный flush базы лиц
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    if subsystem_enabled('pdf'):
+        # Фоновая очистка TEMP_DIR
+        scratch_area.start_reaper()
+
+        # Возобновляем незавершённые загрузки в Google Drive
+        if get_export_storage().name == GoogleDriveStorage.name and DRIVE_UPLOAD_ASYNC:
+            drive_upload_queue.start()
+
+    if SUBSYSTEM_PRELOAD:
+        preload_subsystems()
 
     # Запускаем сервер
     logger.info("=" * 50)
-    logger.info(f"Combined Server запущен на {API_HOST}:{API_PORT}")
-    logger.info("Face Recognition + PDF Generation")
-    logger.info(f"Загружено {len(face_encodings_db)} лиц")
+    logger.info(f"Combined Server запущен на {API_HOST}:{API_PORT} (роль {SERVICE_ROLE}, потоков {threads})")
+    logger.info(f"Подсистемы: {', '.join(name for name in ALL_SUBSYSTEMS if subsystem_enabled(name))}")
+    logger.info(f"Загружено {len(get_gallery_snapshot())} лиц")
     logger.info(f"CUDA: {'включен' if USE_CUDA else 'выключен'}")
     logger.info(f"CORS origins: {', '.join(CORS_ORIGINS)}")
     logger.info(f"MAX_CONTENT_LENGTH: {MAX_CONTENT_LENGTH_MB} MB")
@@ -1829,9 +5478,19 @@ if __name__ == '__main__':
     try:
         from waitress import serve
         logger.info("Запуск через Waitress (production mode)")
-        serve(app, host=API_HOST, port=API_PORT, threads=8)
+        serve(app, host=API_HOST, port=API_PORT, threads=threads)
     except ImportError:
         logger.warning("Waitress не установлен, используем Flask dev-server")
         logger.warning("Для лучшей работы с ngrok: pip install waitress")
         app.run(host=API_HOST, port=API_PORT, debug=False)
 
+
+# ========================================
+# MAIN
+# ========================================
+
+if __name__ == '__main__':
+    if SERVICE_ROLE == 'router':
+        run_router()
+    else:
+        run_worker()